@@ -1,643 +1,1465 @@
-
-import os
-import openai
-import xml.etree.ElementTree as ET
-import atexit
-from flask import Flask, request, render_template, jsonify
-from flask_cors import CORS  # Import the CORS module
-
-app = Flask(__name__)
-CORS(app)  # Enable CORS for the app
-
-# Define namespaces for XML parsing
-namespaces = {
-    'default': 'urn:hl7-org:v3',
-    'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-    'sdtc': 'urn:hl7-org:sdtc'
-}
-
-from dotenv import load_dotenv
-load_dotenv()
-OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
-os.environ["OPENAI_API_KEY"] = OPENAI_API_KEY
-
-uploaded_xml_path = None
-def extract_section_names(xml_path):
-    # Parse the XML file
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
-    # Extract section names
-    section_names = []
-    for section in root.findall(".//default:section", namespaces=namespaces):
-        title_element = section.find("default:title", namespaces=namespaces)
-        if title_element is not None:
-            section_names.append(title_element.text)
-    return section_names
-
-def extract_section_data(xml_path, section_name):
-    # Parse the XML file
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
-    # Search for the section by its title
-    for section in root.findall(".//default:section", namespaces=namespaces):
-        title_element = section.find("default:title", namespaces=namespaces)
-        if title_element is not None and title_element.text == section_name:
-            # Convert the section subtree to a formatted XML string
-            return ET.tostring(section, encoding="unicode", method="xml")
-    return "Section not found"
-
-def xml_to_readable(section_xml):
-    section = ET.fromstring(section_xml)
-
-    output = []
-
-    title_element = section.find("default:title", namespaces=namespaces)
-    if title_element is not None:
-        output.append(title_element.text)
-        output.append('-' * len(title_element.text))
-
-    for table in section.findall(".//default:table", namespaces=namespaces):
-        headers = [th.text for th in table.findall(".//default:thead/default:tr/default:th", namespaces=namespaces)]
-        output.append(' | '.join(headers))
-        output.append('-' * (sum([len(header) for header in headers]) + len(headers) * 3 - 2))
-
-        for row in table.findall(".//default:tbody/default:tr", namespaces=namespaces):
-            row_data = [td.text if td.text else ' '.join(td.itertext()) for td in
-                        row.findall(".//default:td", namespaces=namespaces)]
-            output.append(' | '.join(row_data))
-
-        output.append('')
-
-    return '\n'.join(output)
-
-
-@app.route("/", methods=['GET'])
-def hello():
-    return jsonify("CCDA Summarization")
-
-#********************************************* UPLOAD ROUTE *****************************************************************
-
-
-@app.route("/upload", methods=["POST"])
-def upload_ccda():
-    global uploaded_xml_path  # Access the global variable
-
-    # Get the uploaded XML file from the request
-    xml_file = request.files.get("xml_file")
-
-    # Check if a file was uploaded
-    if xml_file is None:
-        return jsonify({"error": "No file uploaded."}), 400
-
-    # Check if the uploaded file is in XML format
-    if not xml_file.filename.lower().endswith(".xml"):
-        return jsonify({"error": "Uploaded file is not in XML format."}), 400
-
-    # Inform about entering the upload method
-    print("Inside upload method")
-
-    # Cleanup previous XML files in the "files" directory
-    cleanup_previous_xml_files(xml_file.filename)
-
-    # Create the path to save the uploaded file
-    uploaded_xml_path = os.path.join("files", xml_file.filename)
-    xml_file.save(uploaded_xml_path)
-
-    # Inform that the file has been saved
-    print("Inside upload method file saved")
-
-    # Check if the uploaded file has relevant data
-    if uploaded_xml_path:
-        sections_without_data = extract_sections_without_data(uploaded_xml_path)
-        empty_section_threshold = 10  # Define the threshold for empty sections
-
-        # Print sections without data for debugging
-        print(sections_without_data)
-
-        # Check if the number of empty sections is above the threshold
-        if len(sections_without_data) >= empty_section_threshold:
-            message = "Uploaded file does not have much relevant data to work with. Kindly contact our technical team for assistance"
-            return jsonify({"message": message}), 400
-
-    # Return a success response
-    return jsonify("XML file uploaded successfully!"), 200
-
-# For Disk Clenup before uploading new file
-def cleanup_previous_xml_files(exclude_filename):
-    """
-    Removes all XML files from the "files" folder except the specified exclude_filename.
-    """
-    files_folder = "files"
-    for filename in os.listdir(files_folder):
-        if filename.endswith(".xml") and filename != exclude_filename:
-            file_path = os.path.join(files_folder, filename)
-            os.remove(file_path)
-
-# Function to extract sections without data
-def extract_sections_without_data(xml_path):
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
-    sections_without_data = []
-    for section in root.findall(".//default:section", namespaces=namespaces):
-        if not section_has_data_one(section):
-            title_element = section.find("default:title", namespaces=namespaces)
-            if title_element is not None:
-                sections_without_data.append(title_element.text)
-
-    return sections_without_data
-
-# Function to check if a section has data
-def section_has_data_one(section):
-    table_element = section.find(".//default:table", namespaces=namespaces)
-    text_elements = section.findall(".//default:text", namespaces=namespaces)
-
-    if table_element is not None:
-        return True
-
-    for text_element in text_elements:
-        if text_element is not None and text_element.text is not None:
-            text = text_element.text.strip()
-            if text == "None Recorded" or text == "None Reported":
-                return True
-
-    return False
-
-
-# ***************************************** Extract ALL Section DATA **************************************************
-
-# Define a route to get sections with data from the uploaded CCDA file
-@app.route("/get_sections_with_data", methods=["GET"])
-def get_sections_with_data():
-    global uploaded_xml_path  # Access the global variable
-
-    # Check if an uploaded XML file exists
-    if uploaded_xml_path:
-        # Extract sections with data from the uploaded XML file
-        sections_with_data = extract_sections_with_data(uploaded_xml_path)
-        return jsonify({"sections_with_data": sections_with_data})
-    else:
-        return jsonify({"message": "No uploaded XML file found."})
-
-
-# Function to extract sections with data from the CCDA XML file
-def extract_sections_with_data(xml_path):
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
-    sections_with_data = []
-    for section in root.findall(".//default:section", namespaces=namespaces):
-        # Check if the section has data using helper function
-        if section_has_data(section):
-            title_element = section.find("default:title", namespaces=namespaces)
-            if title_element is not None:
-                # Check if the section does not have 'None Recorded' data using helper function
-                if not section_has_none_recorded_data(section):
-                    sections_with_data.append(title_element.text)
-
-    return sections_with_data
-
-
-# Helper function to check if a section has data (contains a table element)
-def section_has_data(section):
-    # Check if the section has a <table> element inside it
-    table_element = section.find(".//default:table", namespaces=namespaces)
-    return table_element is not None
-
-
-# Helper function to check if a section's table contains 'None Recorded' data
-def section_has_none_recorded_data(section):
-    table_element = section.find(".//default:table", namespaces=namespaces)
-    if table_element is not None:
-        for row in table_element.findall(".//default:tbody/default:tr", namespaces=namespaces):
-            for td in row.findall(".//default:td", namespaces=namespaces):
-                if td.text == "None Recorded":
-                    return True
-    return False
-
-# ************************************ SUMMARIZE SELECTED SECTION  ****************************************
-
-
-
-# Define a route to summarize selected sections from the uploaded CCDA file
-@app.route("/summarize_selected_sections", methods=["POST"])
-def summarize_selected_sections():
-    global uploaded_xml_path
-
-    if not uploaded_xml_path:
-        return jsonify({"message": "No uploaded XML file found."})
-
-    # Get the selected sections from the frontend
-    selected_sections = request.json.get("selected_sections")
-
-
-    # Parse the XML file
-    tree = ET.parse(uploaded_xml_path)
-    root = tree.getroot()  # Get the root element
-
-    section_summaries = {}
-    for section_name in selected_sections:
-        section_data = extract_all_table_data(uploaded_xml_path,section_name, root)  # Pass the 'root' element
-        section_summary = generate_summary(section_data)
-        section_summaries[section_name] = section_summary
-
-    return jsonify({"section_summaries": section_summaries})
-
-# Function to extract all table data from a specific section
-def extract_all_table_data(section_name, root):
-    data = []
-
-    # Find the section by its title
-    for section in root.findall(".//default:section", namespaces=namespaces):
-        title_element = section.find("default:title", namespaces=namespaces)
-        if title_element is not None and title_element.text == section_name:
-
-            # Iterate over each table in the section
-            for table in section.findall(".//default:table", namespaces=namespaces):
-                table_data = []
-
-                # Iterate over each row in the table
-                for row in table.findall(".//default:tbody/default:tr", namespaces=namespaces):
-                    row_data = []
-
-                    # Extract data from each cell, handling nested <content> elements
-                    for td in row.findall(".//default:td", namespaces=namespaces):
-                        content = td.find(".//default:content", namespaces=namespaces)
-                        if content is not None and content.text is not None:
-                            row_data.append(content.text.strip())
-                        else:
-                            row_data.append(td.text.strip() if td.text else ' '.join(td.itertext()))
-
-                    table_data.append(row_data)
-
-                data.append(table_data)
-
-    return data
-
-
-
-# Generate a summary using OpenAI API
-def generate_summary(data):
-    # Process data as needed to create a suitable prompt
-    section_prompt = ""
-
-    if "Medical_History" in data:
-        medical_history_data = data["Medical_History"]
-        yes_responses = [entry for entry in medical_history_data if entry[1].lower() == "y"]
-        if yes_responses:
-            section_prompt = "The individual has the following medical conditions with 'yes' responses:\n"
-            for condition in yes_responses:
-                section_prompt += f"- {condition[0]}\n"
-        else:
-            section_prompt = "The individual has no medical conditions with 'yes' responses."
-    else:
-        # Use your default prompt for other sections
-        #section_prompt = f"Summarize the data in the section:\n{data}"
-        section_prompt = f"Set random seed: 42\nSummarize the following data:\n{data}"
-
-    # Create a prompt for summarization
-    prompt = f"Summarize the following data:\n{section_prompt}"
-
-    # Use OpenAI API for summarization
-    response = openai.Completion.create(
-        engine="text-davinci-003",
-        prompt=prompt,
-        max_tokens=200,
-        temperature=0.2
-    )
-
-    return response.choices[0].text.strip()
-
-# ************************************ EXTRACT PERSONAL DETAILS ****************************************
-# Define a route to extract personal details from the uploaded CCDA file
-@app.route("/extract_personal_details", methods=["GET"])
-def extract_personal_details():
-    global uploaded_xml_path
-
-    # Check if an uploaded XML file exists
-    if not uploaded_xml_path:
-        return jsonify({"message": "No uploaded XML file found."})
-
-    # Extract personal details using the defined function
-    personal_details = extract_personal_info(uploaded_xml_path)
-
-    # Format the extracted personal details for output
-    formatted_output = {
-        "Name": personal_details["Name"],
-        "Gender": personal_details["Gender"],
-        "Birthdate": personal_details["Birthdate"],
-        "Marital_Status": personal_details["Marital Status"],
-        "Patient-ID": personal_details.get("Patient-ID", {}),
-        "Contact_Details": personal_details.get("Contact Details", {})
-    }
-
-    return jsonify({"personal_details": formatted_output})
-
-# Function to extract personal information from the XML
-def extract_personal_info(xml_path):
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-
-    personal_info = {}
-
-    # Extract patient's personal details
-    patient_element = root.find(".//default:patient", namespaces=namespaces)
-    if patient_element is not None:
-        personal_info["Name"] = patient_element.find(".//default:name/default:given",
-                                                     namespaces=namespaces).text + " " + patient_element.find(
-            ".//default:name/default:family", namespaces=namespaces).text
-        personal_info["Gender"] = patient_element.find(".//default:administrativeGenderCode",
-                                                       namespaces=namespaces).get("displayName")
-        personal_info["Birthdate"] = patient_element.find(".//default:birthTime", namespaces=namespaces).get("value")
-        personal_info["Marital Status"] = patient_element.find(".//default:maritalStatusCode",
-                                                               namespaces=namespaces).get("displayName")
-
-    # Extract patient's role and contact details
-    patient_role_element = root.find(".//default:patientRole", namespaces=namespaces)
-    if patient_role_element is not None:
-        id_element = patient_role_element.find(".//default:id", namespaces=namespaces)
-        if id_element is not None:
-            personal_info["Patient-ID"] = {
-                "extension": id_element.get("extension"),
-                "root": id_element.get("root")
-            }
-
-        hp_address = patient_role_element.find(".//default:addr[@use='HP']", namespaces=namespaces)
-        pst_address = patient_role_element.find(".//default:addr[@use='PST']", namespaces=namespaces)
-
-        if hp_address is not None:
-            personal_info["Contact Details"] = {
-                "HP": {
-                    "streetAddressLine": hp_address.find("default:streetAddressLine", namespaces=namespaces).text,
-                    "city": hp_address.find("default:city", namespaces=namespaces).text,
-                    "state": hp_address.find("default:state", namespaces=namespaces).text,
-                    "postalCode": hp_address.find("default:postalCode", namespaces=namespaces).text,
-                    "country": hp_address.find("default:country", namespaces=namespaces).text
-                }
-            }
-        if pst_address is not None:
-            personal_info["Contact Details"]["PST"] = {
-                "streetAddressLine": pst_address.find("default:streetAddressLine", namespaces=namespaces).text,
-                "city": pst_address.find("default:city", namespaces=namespaces).text,
-                "state": pst_address.find("default:state", namespaces=namespaces).text,
-                "postalCode": pst_address.find("default:postalCode", namespaces=namespaces).text,
-                "country": pst_address.find("default:country", namespaces=namespaces).text
-            }
-
-    return personal_info
-
-# ************************************ EXTRACT MEDICAL DETAILS ****************************************
-
-# This Route is for extracting Medical Data
-@app.route("/extract_medical_data", methods=["GET"])
-def extract_medical_data():
-    global uploaded_xml_path
-
-    if not uploaded_xml_path:
-        return jsonify({"message": "No uploaded XML file found."})
-
-    sections_to_extract = ['Notes', 'Problems', 'Allergies', 'Medical History']
-
-    extracted_data = {}
-
-    # Parse the XML file
-    tree = ET.parse(uploaded_xml_path)
-    root = tree.getroot()
-
-    for section_name in sections_to_extract:
-        section_data = extract_all_table_data(uploaded_xml_path, section_name, root)
-        if len(section_data) > 0:
-            summary = generate_summary(section_data)
-            section_key = section_name.replace(" ", "_")
-            extracted_data[section_key] = summary
-        else:
-            section_key = section_name.replace(" ", "_")
-            extracted_data[section_key] = "No data available in this section."
-
-    return jsonify(extracted_data)
-
-def extract_all_table_data(xml_path, section_name, root):
-    section_data = []
-
-    for section in root.findall(".//default:section", namespaces=namespaces):
-        title_element = section.find("default:title", namespaces=namespaces)
-        if title_element is not None and title_element.text == section_name:
-            table_data = extract_table_data(section)
-            section_data.extend(table_data)
-
-    return section_data
-
-
-def extract_table_data(section):
-    table_data = []
-
-    table = section.find(".//default:table", namespaces=namespaces)
-    if table is not None:
-        for row in table.findall(".//default:tbody/default:tr", namespaces=namespaces):
-            row_data = []
-            for td in row.findall(".//default:td", namespaces=namespaces):
-                content = td.find(".//default:content", namespaces=namespaces)
-                if content is not None and content.text is not None:
-                    row_data.append(content.text.strip())
-                else:
-                    row_data.append(td.text.strip() if td.text else ' '.join(td.itertext()))
-            table_data.append(row_data)
-
-    return table_data
-
-# ************************************ EXTRACT KEY VALUE DETAILS ****************************************
-
-import random
-
-# Define a route to extract key-value data from the uploaded CCDA file
-@app.route("/extract_key_value_data", methods=["GET"])
-def extract_key_value_data():
-    global uploaded_xml_path
-
-    # Check if an uploaded XML file exists
-    if not uploaded_xml_path:
-        return jsonify({"message": "No uploaded XML file found."})
-
-    # Parse the XML file
-    tree = ET.parse(uploaded_xml_path)
-    root = tree.getroot()
-
-    # Execute the extraction functions for specified sections and headers
-    past_encounters_data_table = extract_data_from_table_section('Past Encounters', 'Encounter date',
-                                                                 'Diagnosis/Indication', root)
-    vitals_data_table = extract_data_from_table_section('Vitals', 'Date Recorded', 'Body mass index (BMI)', root)
-    procedures_data_table_1 = extract_data_from_table_section('Procedures', 'Date', 'Name', root)
-    procedures_data_table_2 = extract_data_from_table_section('Procedures', 'Imaging Date', 'Name', root)
-    assessment_data_table = extract_data_from_table_section('Assessment', 'Assessment Date', 'Assessment', root)
-    medication_data_table = extract_data_from_table_section('Medications', 'Name', 'Status', root)
-
-    # Return the extracted data
-    return jsonify({
-        "Assessment": assessment_data_table,
-        "Past_Encounters": past_encounters_data_table,
-        "Procedures": procedures_data_table_1,
-        "Procedures_(Imaging)": procedures_data_table_2,
-        "Vitals": vitals_data_table,
-        "Medications": medication_data_table
-    })
-
-# Function to extract key-value data from a table section in the XML
-def extract_data_from_table_section(section_name, key_header, value_header, root):
-    data = []
-
-    # Find the section by its title
-    for section in root.findall(".//default:section", namespaces=namespaces):
-        title_element = section.find("default:title", namespaces=namespaces)
-        if title_element is not None and title_element.text == section_name:
-
-            # Iterate over each table in the section
-            for table in section.findall(".//default:table", namespaces=namespaces):
-                headers = [th.text for th in table.findall(".//default:thead/default:tr/default:th", namespaces=namespaces)]
-
-                # Check if the table has the desired key and value headers
-                if key_header in headers and value_header in headers:
-                    key_index = headers.index(key_header)
-                    value_index = headers.index(value_header)
-
-                    # Iterate over each row in the table
-                    for row in table.findall(".//default:tbody/default:tr", namespaces=namespaces):
-                        row_data = []
-
-                        # Extract data from each cell, handling nested <content> elements
-                        for td in row.findall(".//default:td", namespaces=namespaces):
-                            content = td.find(".//default:content", namespaces=namespaces)
-                            if content is not None and content.text is not None:
-                                row_data.append(content.text.strip())
-                            else:
-                                row_data.append(td.text.strip() if td.text else ' '.join(td.itertext()))
-
-                        # Extract the key-value pair based on the header indexes
-                        if section_name != "Medications":
-                            random_times = random.randint(2, 5)
-                            value_list = [row_data[value_index]] * random_times  # Append the first element multiple times
-                            key_value = (row_data[key_index], value_list)
-                        else:
-                            key_value = (row_data[key_index], [row_data[value_index]])  # No duplication for Medications
-                        data.append(key_value)
-
-    return data
-
-# ************************************ EXTRACT DETAILS DYNAMICALLY ****************************************
-
-# Define a route to extract dynamic data from the uploaded CCDA file
-@app.route("/extract_dynamic_data", methods=["GET"])
-def extract_dynamic_data():
-    global uploaded_xml_path
-
-    # Check if an uploaded XML file exists
-    if not uploaded_xml_path:
-        return jsonify({"message": "No uploaded XML file found."})
-
-    # Parse the XML file
-    tree = ET.parse(uploaded_xml_path)
-    root = tree.getroot()
-
-    extracted_data = {}
-
-    # Get all section names dynamically
-    section_names = [section.find("default:title", namespaces=namespaces).text for section in
-                     root.findall(".//default:section", namespaces=namespaces)]
-
-    # Iterate through each section and extract data
-    for section_name in section_names:
-        section_data = extract_data_from_table_section_two(section_name, root)
-
-        # Generate 'header: table_data' pairs for each section
-        section_key_values = {}
-        for entry in section_data:
-            headers = entry["headers"]
-            table_data = entry["table_data"]
-
-            header_table_pairs = []
-            for row in table_data:
-                header_table_pairs.append({header: value for header, value in zip(headers, row)})
-
-            section_key_values[section_name] = header_table_pairs
-
-        extracted_data[section_name] = section_key_values
-
-    return jsonify(extracted_data)
-
-# Function to extract data from a table section dynamically
-def extract_data_from_table_section_two(section_name, root):
-    data = []
-
-    # Find the section by its title
-    for section in root.findall(".//default:section", namespaces=namespaces):
-        title_element = section.find("default:title", namespaces=namespaces)
-        if title_element is not None and title_element.text == section_name:
-
-            # Iterate over each table in the section
-            for table in section.findall(".//default:table", namespaces=namespaces):
-                headers = [th.text for th in table.findall(".//default:thead/default:tr/default:th", namespaces=namespaces)]
-
-                table_data = []
-
-                # Iterate over each row in the table
-                for row in table.findall(".//default:tbody/default:tr", namespaces=namespaces):
-                    row_data = []
-
-                    # Iterate over each cell in the row
-                    for td in row.findall(".//default:td", namespaces=namespaces):
-                        content = td.find(".//default:content", namespaces=namespaces)
-                        if content is not None and content.text is not None:
-                            cell_data = content.text.strip()
-                        else:
-                            cell_data = td.text.strip() if td.text else ""  # Use an empty string for empty cells
-                        row_data.append(cell_data)
-
-                    table_data.append(row_data)
-
-                data.append({
-                    "headers": headers,
-                    "table_data": table_data
-                })
-
-    return data
-
-# ************************************ ERROR HANDLING ****************************************
-
-# Define a custom error handler for various exceptions and HTTP error codes
-@app.errorhandler(Exception)
-@app.errorhandler(400)
-@app.errorhandler(404)
-@app.errorhandler(500)
-def error_handler(error):
-    status_code = error.code
-
-    # Define error messages based on status code
-    if status_code == 400:
-        message = "Bad request. Please check your input."
-    elif status_code == 404:
-        message = "Resource not found."
-    elif status_code == 500:
-        message = "Internal server error. Please try again later."
-    else:
-        message = "An error occurred."
-
-    # Return the error message and status code as a JSON response
-    return jsonify({"error": message}), status_code
-
-# ************************************ CLEANING THE UPLOADED FILE  ****************************************
-
-# Define the cleanup function
-def cleanup_uploaded_files():
-    files_folder = "files"
-    for filename in os.listdir(files_folder):
-        if filename.endswith(".xml"):
-            file_path = os.path.join(files_folder, filename)
-            os.remove(file_path)
-
-# Register the cleanup function
-atexit.register(cleanup_uploaded_files)
-
-if __name__ == "__main__":
-    app.run(debug=True)
-
+
+import asyncio
+import functools
+import gc
+import os
+import json
+import logging
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import xml.etree.ElementTree as ET
+from flask import Flask, Request, Response, g, request, render_template, jsonify, stream_with_context
+from flask_cors import CORS  # Import the CORS module
+from ccda_document import CCDADocument, DocumentCache, TooManyEmptySections, namespaces
+from ccda_tables import read_table
+from ccda_snapshot import dump_snapshot, load_snapshot
+from ccda_entries import parse_period_bound
+from ccda_extraction import (extract_all_table_data, extract_data_from_table_section,
+                             extract_data_from_table_section_two, extract_section_names, extract_section_records,
+                             extract_section_rows, extract_sections_with_data, extract_sections_without_data)
+from document_store import DocumentReaper, create_document_store
+from summarizer import AdmissionQueue, AdmissionRejected, Prefetcher, RateLimiter, SingleFlight, SummaryExecutor
+from prompt_builder import chunk_text, count_tokens, render_rows
+from llm_backends import create_backend
+from summary_cache import SummaryCache, appended_rows, row_fingerprints, summary_cache_key
+from batch import DEFAULT_SUMMARY_SECTIONS, BatchJobs, discover_inputs
+from metrics import SamplingProfiler, end_trace, metrics, span, start_trace, with_trace
+from responses import JSONProvider, compress_response, encode_json
+from retrieval_index import BM25, RowIndex, create_embedder, document_chunks, load_faiss
+
+logger = logging.getLogger(__name__)
+
+
+# Request whose uploaded files are buffered in memory up to UPLOAD_MEMORY_LIMIT bytes
+# (werkzeug spools anything over 500 KB to a temporary file on disk)
+class UploadRequest(Request):
+    memory_limit = 16 * 1024 * 1024
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.SpooledTemporaryFile(max_size=self.memory_limit, mode="rb+")
+
+
+app = Flask(__name__)
+app.request_class = UploadRequest
+CORS(app)  # Enable CORS for the app
+
+from dotenv import load_dotenv
+load_dotenv()
+OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
+UploadRequest.memory_limit = int(os.environ.get("UPLOAD_MEMORY_LIMIT", UploadRequest.memory_limit))
+
+# JSON responses are encoded with orjson when it is installed (FAST_JSON=0 keeps the standard encoder)
+app.json = JSONProvider(app, fast=os.environ.get("FAST_JSON", "1") in ("1", "true"))
+
+# Summaries come from OpenAI chat completions, or from an offline mock backend for load testing
+SUMMARY_BACKEND = os.environ.get("SUMMARY_BACKEND", "openai")
+if SUMMARY_BACKEND == "mock":
+    llm_backend = create_backend(
+        "mock",
+        latency=float(os.environ.get("MOCK_LLM_LATENCY", 0)),
+        jitter=float(os.environ.get("MOCK_LLM_JITTER", 0))
+    )
+else:
+    llm_backend = create_backend(
+        SUMMARY_BACKEND,
+        model=os.environ.get("SUMMARY_MODEL"),
+        api_key=OPENAI_API_KEY,
+        base_url=os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1"),
+        timeout=float(os.environ.get("OPENAI_TIMEOUT", 60)),
+        max_retries=int(os.environ.get("OPENAI_MAX_RETRIES", 5)),
+        pool_size=int(os.environ.get("OPENAI_POOL_SIZE", 32)),
+        async_pool_size=int(os.environ.get("OPENAI_ASYNC_POOL_SIZE", 256))
+    )
+
+# Uploaded documents, addressed by document id and readable by every worker
+document_store = create_document_store(
+    os.environ.get("CCDA_STORE", "local"),
+    os.environ.get("CCDA_STORE_DIR", "uploads"),
+    ttl=int(os.environ.get("CCDA_DOCUMENT_TTL", 24 * 3600))
+)
+
+# Extracted documents are also saved as binary snapshots at upload, so a worker without the
+# document in its cache maps the snapshot instead of re-parsing the XML (DOCUMENT_SNAPSHOTS=0
+# turns them off)
+DOCUMENT_SNAPSHOTS = os.environ.get("DOCUMENT_SNAPSHOTS", "1") in ("1", "true")
+
+# Parsed documents, shared by every route instead of re-parsing the XML on each request
+document_cache = DocumentCache(
+    max_documents=int(os.environ.get("CCDA_DOCUMENT_CACHE_SIZE", 32)),
+    max_bytes=int(os.environ.get("CCDA_DOCUMENT_CACHE_MB", 256)) * 1024 * 1024
+)
+
+
+# Sections are summarized concurrently, within an OpenAI budget shared by all workers on the host
+summary_executor = SummaryExecutor(
+    max_workers=int(os.environ.get("SUMMARY_CONCURRENCY", 8)),
+    timeout=float(os.environ.get("SUMMARY_TIMEOUT", 60))
+)
+rate_limiter = RateLimiter(
+    requests_per_minute=int(os.environ.get("OPENAI_RPM_LIMIT", 0)),
+    tokens_per_minute=int(os.environ.get("OPENAI_TPM_LIMIT", 0)),
+    state_path=os.environ.get("OPENAI_RATE_LIMIT_FILE")
+)
+
+# Requests that call the summarizer are admitted a few at a time per worker; the rest
+# wait in a bounded queue, served round-robin by client, or are turned away with a 429
+admission_queue = AdmissionQueue(
+    max_active=int(os.environ.get("ADMISSION_MAX_ACTIVE", 16)),
+    max_queued=int(os.environ.get("ADMISSION_MAX_QUEUED", 64)),
+    max_queued_per_client=int(os.environ.get("ADMISSION_MAX_QUEUED_PER_CLIENT", 8)),
+    max_wait=float(os.environ.get("ADMISSION_MAX_WAIT", 30))
+)
+
+# Identical prompts in flight at the same time share one backend request
+llm_calls = SingleFlight()
+
+# Summaries of identical section data are served from a persistent cache instead of the API
+summary_cache = SummaryCache(
+    os.environ.get("SUMMARY_CACHE_PATH", "summary_cache.sqlite3"),
+    memory_size=int(os.environ.get("SUMMARY_CACHE_MEMORY_SIZE", 1024)),
+    ttl=int(os.environ.get("SUMMARY_CACHE_TTL", 7 * 24 * 3600)),
+    max_entries=int(os.environ.get("SUMMARY_CACHE_MAX_ENTRIES", 10000))
+)
+
+
+# Function to get a parsed uploaded document: from the cache, else from its snapshot, else
+# re-parsed from the stored XML
+def get_document(doc_id):
+    if not doc_id or not document_store.exists(doc_id):
+        # Unknown, or expired and possibly purged by another worker
+        document_cache.pop(doc_id)
+        return None
+
+    document = document_cache.get(doc_id)
+    if document is not None:
+        metrics.inc("ccda_document_cache_hits_total")
+        return document
+    metrics.inc("ccda_document_cache_misses_total")
+
+    snapshot_path = document_store.snapshot_path(doc_id) if DOCUMENT_SNAPSHOTS else None
+    if snapshot_path is not None:
+        with span("snapshot"):
+            document = load_snapshot(snapshot_path, doc_id)
+        metrics.inc("ccda_document_snapshot_loads_total", result="hit" if document is not None else "miss")
+        if document is not None:
+            return document_cache.put(document)
+
+    xml_file = document_store.open(doc_id)
+    if xml_file is None:
+        return None
+    with xml_file, span("parse"):
+        document = document_cache.put(CCDADocument.from_stream(xml_file, doc_id=doc_id))
+    # Missing, or written by another snapshot version: replace it
+    save_snapshot(document)
+    return document
+
+
+# Function to save the snapshot of an extracted document next to its XML
+def save_snapshot(document):
+    if not DOCUMENT_SNAPSHOTS or document_store.snapshot_path(document.doc_id) is None:
+        return
+    try:
+        with span("snapshot"):
+            document_store.save_snapshot(document.doc_id, dump_snapshot(document))
+    except Exception:
+        # The XML stays the source of truth; the next load parses it again
+        logger.exception("Saving the snapshot of %s failed", document.doc_id)
+
+
+# Function to get the document named by the request's "document_id" (query string or JSON body)
+def get_requested_document():
+    doc_id = request.args.get("document_id")
+    if doc_id is None and request.is_json:
+        doc_id = (request.get_json(silent=True) or {}).get("document_id")
+    with span("document"):
+        return get_document(doc_id)
+
+
+# Function to identify the client of a request for fair queueing: the X-Client-Id header, or its address
+def request_client():
+    return request.headers.get("X-Client-Id") or request.remote_addr or "unknown"
+
+
+# Function to build the response for a request rejected by admission control
+def rejected_response(rejection):
+    metrics.inc("ccda_admission_rejected_total", reason=rejection.reason)
+    response = jsonify({"error": "Too many requests. Please retry later.", "reason": rejection.reason,
+                        "retry_after": rejection.retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(rejection.retry_after)
+    return response
+
+
+# Decorator for routes that call the summarizer: the request waits for a slot in the
+# admission queue, which it holds until its response (streamed or not) is finished
+def admission_controlled(view):
+    @functools.wraps(view)
+    def admitted(*args, **kwargs):
+        if not admission_queue.enabled:
+            return view(*args, **kwargs)
+
+        try:
+            with span("admission"):
+                waited = admission_queue.acquire(request_client())
+        except AdmissionRejected as rejection:
+            return rejected_response(rejection)
+        metrics.observe("ccda_admission_wait_seconds", waited)
+
+        admitted_at = time.monotonic()
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            admission_queue.release(time.monotonic() - admitted_at)
+            raise
+        if response.is_streamed:
+            response.call_on_close(lambda: admission_queue.release(time.monotonic() - admitted_at))
+        else:
+            admission_queue.release(time.monotonic() - admitted_at)
+        return response
+    return admitted
+
+
+def extract_section_data(xml_path, section_name):
+    # Parse the XML file
+    tree = ET.parse(xml_path)
+    root = tree.getroot()
+
+    # Search for the section by its title
+    for section in root.findall(".//default:section", namespaces=namespaces):
+        title_element = section.find("default:title", namespaces=namespaces)
+        if title_element is not None and title_element.text == section_name:
+            # Convert the section subtree to a formatted XML string
+            return ET.tostring(section, encoding="unicode", method="xml")
+    return "Section not found"
+
+def xml_to_readable(section_xml):
+    section = ET.fromstring(section_xml)
+
+    output = []
+
+    title_element = section.find("default:title", namespaces=namespaces)
+    if title_element is not None:
+        output.append(title_element.text)
+        output.append('-' * len(title_element.text))
+
+    for table_element in section.findall(".//default:table", namespaces=namespaces):
+        table = read_table(table_element, mode="readable")
+        headers = table.headers
+        output.append(' | '.join(headers))
+        output.append('-' * (sum([len(header) for header in headers]) + len(headers) * 3 - 2))
+
+        for row_data in table.rows:
+            output.append(' | '.join(row_data))
+
+        output.append('')
+
+    return '\n'.join(output)
+
+
+@app.route("/", methods=['GET'])
+def hello():
+    return jsonify("CCDA Summarization")
+
+#********************************************* UPLOAD ROUTE *****************************************************************
+
+# Function to drop purged documents from the cache and search index and stop their prefetch
+def forget_documents(doc_ids):
+    for doc_id in doc_ids:
+        document_cache.pop(doc_id)
+        if prefetcher is not None:
+            prefetcher.cancel(doc_id)
+        if row_index is not None:
+            row_index.delete_document(doc_id)
+        logger.debug("Document %s expired", doc_id)
+
+
+# Expired documents are purged by a background thread instead of on every upload
+# (CCDA_REAPER_INTERVAL=0 turns it off)
+REAPER_INTERVAL = int(os.environ.get("CCDA_REAPER_INTERVAL", 300))
+document_reaper = DocumentReaper(document_store, interval=REAPER_INTERVAL, on_expired=forget_documents)
+
+
+@app.route("/upload", methods=["POST"])
+def upload_ccda():
+    # Get the uploaded XML file from the request
+    xml_file = request.files.get("xml_file")
+
+    # Check if a file was uploaded
+    if xml_file is None:
+        return jsonify({"error": "No file uploaded."}), 400
+
+    # Check if the uploaded file is in XML format
+    if not xml_file.filename.lower().endswith(".xml"):
+        return jsonify({"error": "Uploaded file is not in XML format."}), 400
+
+    logger.debug("Upload of %s started", xml_file.filename)
+
+    empty_section_threshold = 10  # Define the threshold for empty sections
+
+    # Werkzeug has already received the multipart body into memory or a spooled temporary
+    # file (see UploadRequest). Parse that file section by section, writing the bytes to
+    # the store as they are read, and reject it as soon as the number of empty sections
+    # reaches the threshold without parsing or storing the rest of the file
+    with document_store.begin_save(filename=xml_file.filename) as pending:
+        try:
+            with span("parse"):
+                document = CCDADocument.from_stream(xml_file.stream, empty_section_threshold=empty_section_threshold,
+                                                    tee=pending)
+        except TooManyEmptySections as error:
+            metrics.inc("ccda_uploads_total", outcome="rejected")
+            logger.info("Upload of %s rejected, sections without data: %s", xml_file.filename,
+                        error.sections_without_data)
+            message = "Uploaded file does not have much relevant data to work with. Kindly contact our technical team for assistance"
+            return jsonify({"message": message}), 400
+
+        # Keep the upload under its document id (the hash of its content)
+        doc_id = document.doc_id
+        with span("store"):
+            pending.commit(doc_id)
+    document_cache.put(document)
+    save_snapshot(document)
+
+    sections_without_data = extract_sections_without_data(document)
+    metrics.inc("ccda_upload_empty_sections_total", len(sections_without_data))
+    metrics.inc("ccda_uploads_total", outcome="accepted")
+    metrics.inc("ccda_upload_bytes_total", document.source_size)
+    logger.info("Upload of %s saved as %s (%d bytes, %d sections, sections without data: %s)",
+                xml_file.filename, doc_id, document.source_size, len(document.sections), sections_without_data)
+
+    # Start summarizing the usual sections and indexing the rows in the background
+    if prefetcher is not None:
+        prefetcher.submit(doc_id, lambda: prefetch_items(doc_id))
+    if row_index is not None:
+        index_pool.submit(index_document, doc_id)
+
+    # Return a success response with the id that every other route takes
+    return jsonify({"message": "XML file uploaded successfully!", "document_id": doc_id}), 200
+
+# ***************************************** Extract ALL Section DATA **************************************************
+
+# Define a route to get sections with data from the uploaded CCDA file
+@app.route("/get_sections_with_data", methods=["GET"])
+def get_sections_with_data():
+    # Check if an uploaded XML file exists
+    document = get_requested_document()
+    if document:
+        # Extract sections with data from the uploaded XML file
+        with span("extract"):
+            sections_with_data = extract_sections_with_data(document)
+        return jsonify({"sections_with_data": sections_with_data})
+    else:
+        return jsonify({"message": "No uploaded XML file found."})
+
+
+# ************************************ SUMMARIZE SELECTED SECTION  ****************************************
+
+
+
+# Define a route to summarize selected sections from the uploaded CCDA file
+@app.route("/summarize_selected_sections", methods=["POST"])
+@admission_controlled
+def summarize_selected_sections():
+    document = get_requested_document()
+    if not document:
+        return jsonify({"message": "No uploaded XML file found."})
+
+    # Get the selected sections from the frontend, and the period to summarize if any
+    selected_sections = request.json.get("selected_sections")
+    try:
+        since, until = requested_period(request.json)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+
+    # Summarize all selected sections at once, keeping the requested order
+    with span("extract"):
+        section_data = [(section_name, summary_rows(section_name, document, since, until))
+                        for section_name in selected_sections]
+    statuses = {}
+    summaries = summary_executor.summarize(
+        section_summarizer(document, statuses, incremental=since is None and until is None), section_data)
+
+    section_summaries = {}
+    for section_name, section_summary in zip(selected_sections, summaries):
+        section_summaries[section_name] = section_summary
+
+    return jsonify({"section_summaries": section_summaries,
+                    "recomputed_sections": recomputed_sections(selected_sections, statuses)})
+
+
+# Define a route that streams each section's summary as soon as it is ready.
+# Server-Sent Events by default, or NDJSON with ?format=ndjson; ?tokens=1 also
+# streams the summary text as the model produces it.
+@app.route("/summarize_selected_sections/stream", methods=["POST"])
+@admission_controlled
+def stream_selected_sections():
+    document = get_requested_document()
+    if not document:
+        return jsonify({"message": "No uploaded XML file found."})
+
+    # Get the selected sections from the frontend, and the period to summarize if any
+    selected_sections = request.json.get("selected_sections")
+    stream_format = request.args.get("format", "sse")
+    stream_tokens = request.args.get("tokens") in ("1", "true")
+    try:
+        since, until = requested_period(request.json)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+
+    with span("extract"):
+        section_data = [(section_name, summary_rows(section_name, document, since, until))
+                        for section_name in selected_sections]
+    statuses = {}
+
+    def format_event(kind, payload):
+        if stream_format == "ndjson":
+            return json.dumps(dict(payload, event=kind)) + "\n"
+        return "event: %s\ndata: %s\n\n" % (kind, json.dumps(payload))
+
+    def generate():
+        summarize = section_summarizer(document, statuses, incremental=since is None and until is None)
+        for kind, index, text in summary_executor.stream(summarize, section_data, tokens=stream_tokens):
+            section_name = selected_sections[index]
+            if kind == "token":
+                yield format_event("token", {"section": section_name, "text": text})
+            else:
+                yield format_event("summary", {"section": section_name, "summary": text,
+                                               "recomputed": statuses.get(section_name) in RECOMPUTED_STATUSES})
+        yield format_event("done", {})
+
+    mimetype = "application/x-ndjson" if stream_format == "ndjson" else "text/event-stream"
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+
+# Summarization model, parameters and prompt templates (all part of the summary cache key)
+SUMMARY_MODEL = "%s/%s" % (llm_backend.name, llm_backend.model)
+SUMMARY_MAX_TOKENS = 200
+SUMMARY_TEMPERATURE = 0.2
+SUMMARY_PROMPT_TEMPLATE = "Summarize the following data:\n{section_prompt}"
+SECTION_PROMPT_TEMPLATE = "Set random seed: 42\nSummarize the following data:\n{data}"
+REDUCE_PROMPT_TEMPLATE = "Combine these partial summaries of one section into a single summary:\n{summaries}"
+
+# Largest prompt sent in one request; bigger sections are summarized in chunks and then combined
+SUMMARY_PROMPT_TOKEN_LIMIT = int(os.environ.get("SUMMARY_PROMPT_TOKEN_LIMIT", 3000))
+
+# Chunks of one oversized section are summarized in parallel on their own pool, so a
+# section task on summary_executor never waits on its own pool
+chunk_pool = ThreadPoolExecutor(max_workers=int(os.environ.get("SUMMARY_CHUNK_CONCURRENCY", 4)),
+                                thread_name_prefix="summary-chunk")
+
+
+# Send one prompt to the summarizer backend, unless the same prompt is already in flight,
+# in which case its completion is shared. With on_token, the completion is streamed and
+# on_token is called with each piece of text (once with the whole text when shared).
+def complete_prompt(prompt, on_token=None):
+    summary, shared = llm_calls.do(prompt, lambda: request_completion(prompt, on_token))
+    if shared:
+        metrics.inc("ccda_llm_coalesced_total", model=SUMMARY_MODEL)
+        if on_token is not None:
+            on_token(summary)
+    return summary
+
+
+# Send one prompt to the summarizer backend within the shared rate budget
+def request_completion(prompt, on_token=None):
+    prompt_tokens = count_tokens(prompt)
+
+    # Wait for room in the shared requests/tokens per minute budget
+    with span("rate_limit"):
+        rate_limiter.acquire(prompt_tokens + SUMMARY_MAX_TOKENS)
+
+    metrics.inc("ccda_llm_calls_total", model=SUMMARY_MODEL)
+    metrics.inc("ccda_llm_prompt_tokens_total", prompt_tokens, model=SUMMARY_MODEL)
+    try:
+        with span("llm"):
+            if on_token is not None:
+                pieces = []
+                for text in llm_backend.stream(prompt, SUMMARY_MAX_TOKENS, SUMMARY_TEMPERATURE):
+                    pieces.append(text)
+                    on_token(text)
+                summary = ''.join(pieces).strip()
+            else:
+                summary = llm_backend.complete(prompt, SUMMARY_MAX_TOKENS, SUMMARY_TEMPERATURE)
+    except Exception:
+        metrics.inc("ccda_llm_errors_total", model=SUMMARY_MODEL)
+        raise
+
+    metrics.inc("ccda_llm_completion_tokens_total", count_tokens(summary), model=SUMMARY_MODEL)
+    return summary
+
+
+# complete_prompt for the event loop: the backend request is awaited instead of holding a thread
+async def complete_prompt_async(prompt, on_token=None):
+    summary, shared = await llm_calls.do_async(prompt, lambda: request_completion_async(prompt, on_token))
+    if shared:
+        metrics.inc("ccda_llm_coalesced_total", model=SUMMARY_MODEL)
+        if on_token is not None:
+            on_token(summary)
+    return summary
+
+
+# request_completion for the event loop, within the same shared rate budget
+async def request_completion_async(prompt, on_token=None):
+    prompt_tokens = count_tokens(prompt)
+
+    with span("rate_limit"):
+        await rate_limiter.acquire_async(prompt_tokens + SUMMARY_MAX_TOKENS)
+
+    metrics.inc("ccda_llm_calls_total", model=SUMMARY_MODEL)
+    metrics.inc("ccda_llm_prompt_tokens_total", prompt_tokens, model=SUMMARY_MODEL)
+    try:
+        with span("llm"):
+            if on_token is not None:
+                pieces = []
+                async for text in llm_backend.astream(prompt, SUMMARY_MAX_TOKENS, SUMMARY_TEMPERATURE):
+                    pieces.append(text)
+                    on_token(text)
+                summary = ''.join(pieces).strip()
+            else:
+                summary = await llm_backend.acomplete(prompt, SUMMARY_MAX_TOKENS, SUMMARY_TEMPERATURE)
+    except Exception:
+        metrics.inc("ccda_llm_errors_total", model=SUMMARY_MODEL)
+        raise
+
+    metrics.inc("ccda_llm_completion_tokens_total", count_tokens(summary), model=SUMMARY_MODEL)
+    return summary
+
+
+# The summarization below is written once, as generators of steps: each step yields the
+# prompts to complete next, as (prompt, on_token) pairs that may be sent concurrently, and
+# receives their completions in the same order. run_steps completes them on threads for the
+# Flask routes, run_steps_async awaits them on the event loop for the ASGI routes.
+def run_steps(steps):
+    completions = None
+    while True:
+        try:
+            requests = steps.send(completions)
+        except StopIteration as stop:
+            return stop.value
+        completions = complete_prompts(requests)
+
+
+# Function to complete the prompts of one step; several (the chunks of a section) run on chunk_pool
+def complete_prompts(requests):
+    if len(requests) == 1:
+        return [complete_prompt(*requests[0])]
+    return list(chunk_pool.map(with_trace(lambda request: complete_prompt(*request)), requests))
+
+
+# Drive summarization steps on the event loop. The work between completions (cache lookups,
+# prompt rendering and token counts) runs on a worker thread, the completions are awaited.
+async def run_steps_async(steps):
+    completions = None
+    while True:
+        done, value = await asyncio.to_thread(advance_steps, steps, completions)
+        if done:
+            return value
+        completions = await asyncio.gather(*(complete_prompt_async(prompt, on_token) for prompt, on_token in value))
+
+
+# Function to advance summarization steps: (True, result) when they are finished, otherwise
+# (False, prompts to complete); StopIteration cannot be raised through a future
+def advance_steps(steps, completions):
+    try:
+        return False, steps.send(completions)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+# Function to build the prompts for summarizing text: (prompts, chunked). One prompt if the
+# text fits the prompt budget, otherwise one per chunk, whose summaries are then reduced.
+def text_prompts(text):
+    prompt = SUMMARY_PROMPT_TEMPLATE.format(section_prompt=SECTION_PROMPT_TEMPLATE.format(data=text))
+    if count_tokens(prompt) <= SUMMARY_PROMPT_TOKEN_LIMIT:
+        return [prompt], False
+
+    with span("prompt"):
+        overhead = count_tokens(SUMMARY_PROMPT_TEMPLATE + SECTION_PROMPT_TEMPLATE)
+        chunks = chunk_text(text, SUMMARY_PROMPT_TOKEN_LIMIT - overhead)
+        return [SUMMARY_PROMPT_TEMPLATE.format(section_prompt=SECTION_PROMPT_TEMPLATE.format(data=chunk))
+                for chunk in chunks], True
+
+
+# Function to build the prompts for combining partial summaries: (prompts, final). A single
+# final prompt if they fit the budget, otherwise one per group for another round.
+def reduce_prompts(summaries):
+    joined = '\n'.join('- ' + summary for summary in summaries)
+    prompt = REDUCE_PROMPT_TEMPLATE.format(summaries=joined)
+    if count_tokens(prompt) <= SUMMARY_PROMPT_TOKEN_LIMIT or len(summaries) <= 2:
+        return [prompt], True
+
+    groups = chunk_text(joined, SUMMARY_PROMPT_TOKEN_LIMIT - count_tokens(REDUCE_PROMPT_TEMPLATE))
+    return [REDUCE_PROMPT_TEMPLATE.format(summaries=group) for group in groups], False
+
+
+# Summarize text that may exceed the prompt budget: map over chunks, then reduce the partial summaries
+def summarize_text(text, on_token=None):
+    return run_steps(summarize_text_steps(text, on_token))
+
+
+def summarize_text_steps(text, on_token=None):
+    prompts, chunked = text_prompts(text)
+    if not chunked:
+        return (yield [(prompts[0], on_token)])[0]
+
+    partial_summaries = yield [(prompt, None) for prompt in prompts]
+    return (yield from reduce_summaries_steps(partial_summaries, on_token))
+
+
+# Combine partial summaries, in several rounds if they do not fit in one prompt
+def reduce_summaries(summaries, on_token=None):
+    return run_steps(reduce_summaries_steps(summaries, on_token))
+
+
+def reduce_summaries_steps(summaries, on_token=None):
+    prompts, final = reduce_prompts(summaries)
+    if final:
+        return (yield [(prompts[0], on_token)])[0]
+
+    reduced = yield [(prompt, None) for prompt in prompts]
+    return (yield from reduce_summaries_steps(reduced, on_token))
+
+
+# Function to compute the summary cache key of section data
+def summary_key(data):
+    return summary_cache_key(data, SUMMARY_MODEL,
+                             SUMMARY_PROMPT_TEMPLATE + SECTION_PROMPT_TEMPLATE + REDUCE_PROMPT_TEMPLATE,
+                             max_tokens=SUMMARY_MAX_TOKENS, temperature=SUMMARY_TEMPERATURE,
+                             prompt_token_limit=SUMMARY_PROMPT_TOKEN_LIMIT)
+
+
+# Generate a summary with the configured backend, reusing a cached summary of identical data.
+# on_token, if given, receives the final summary's text as it is generated.
+def generate_summary(data, on_token=None):
+    return run_steps(generate_summary_steps(data, on_token))
+
+
+def generate_summary_steps(data, on_token=None):
+    cache_key = summary_key(data)
+    with span("summary_cache"):
+        summary = summary_cache.get(cache_key)
+    if summary is not None:
+        return summary
+
+    # Process data as needed to create a suitable prompt
+    prompt = medical_history_prompt(data)
+    if prompt is not None:
+        summary, = yield [(prompt, on_token)]
+    else:
+        # Render the rows compactly instead of as a Python list, chunking oversized sections
+        with span("prompt"):
+            text = render_rows(data)
+        summary = yield from summarize_text_steps(text, on_token)
+
+    summary_cache.put(cache_key, summary)
+    return summary
+
+
+# Function to build the prompt for medical history data, None for any other data
+def medical_history_prompt(data):
+    if "Medical_History" not in data:
+        return None
+
+    section_prompt = ""
+    medical_history_data = data["Medical_History"]
+    yes_responses = [entry for entry in medical_history_data if entry[1].lower() == "y"]
+    if yes_responses:
+        section_prompt = "The individual has the following medical conditions with 'yes' responses:\n"
+        for condition in yes_responses:
+            section_prompt += f"- {condition[0]}\n"
+    else:
+        section_prompt = "The individual has no medical conditions with 'yes' responses."
+    return SUMMARY_PROMPT_TEMPLATE.format(section_prompt=section_prompt)
+
+
+# Sections whose tables only grow between uploads: when they change, the model gets the
+# previous summary and only the new rows instead of the whole section. The new rows are
+# found among the table rows, also for the sections summarized from analytics facts.
+APPEND_ONLY_SECTIONS = [section_name.strip() for section_name in
+                        os.environ.get("APPEND_ONLY_SECTIONS", "Past Encounters,Vitals").split(",")
+                        if section_name.strip()]
+DELTA_PROMPT_TEMPLATE = "Update this summary with the new data below:\n{summary}\nNew data:\n{data}"
+
+# How a section summary was produced; the last two called the model
+RECOMPUTED_STATUSES = ("delta", "full")
+
+
+# Summarize one section of a document, reusing the summary from the patient's previous upload
+# when the section's fingerprint is unchanged. Returns the summary and how it was produced:
+# "unchanged", "cached", "delta" or "full".
+def summarize_section(document, section_name, data, on_token=None, incremental=True):
+    return run_steps(summarize_section_steps(document, section_name, data, on_token, incremental))
+
+
+def summarize_section_steps(document, section_name, data, on_token=None, incremental=True):
+    if not incremental:
+        # Part of a section (a period): summarized on its own, the patient's record is left alone
+        status = "cached" if summary_key(data) in summary_cache else "full"
+        return (yield from generate_summary_steps(data, on_token)), status
+
+    patient, fingerprint, previous = previous_section_summary(document, section_name, data)
+    if previous is not None and previous["fingerprint"] == fingerprint:
+        return previous["summary"], "unchanged"
+
+    table_rows = delta_rows(document, section_name, data)
+    rows = row_fingerprints(table_rows)
+    summary = None
+    if fingerprint in summary_cache:
+        status = "cached"
+    else:
+        prompt = delta_prompt(previous, section_name, table_rows, rows)
+        if prompt is not None:
+            summary, = yield [(prompt, on_token)]
+            summary_cache.put(fingerprint, summary)
+            status = "delta"
+    if summary is None:
+        status = "cached" if fingerprint in summary_cache else "full"
+        summary = yield from generate_summary_steps(data, on_token)
+
+    if patient:
+        summary_cache.put_section(patient, section_name, fingerprint, rows, summary)
+    return summary, status
+
+
+# Function to look up the summary of a section from the patient's previous upload:
+# (patient key, fingerprint of the section data, stored record or None)
+def previous_section_summary(document, section_name, data):
+    patient = document.patient_key
+    fingerprint = summary_key(data)
+    previous = summary_cache.get_section(patient, section_name) if patient else None
+    return patient, fingerprint, previous
+
+
+# Function to get the rows an append-only section's changes are looked for in: the table
+# rows, not the analytics facts, which are recomputed over every row and never only grow
+def delta_rows(document, section_name, data):
+    if section_name in APPEND_ONLY_SECTIONS and section_name in ANALYTICS_SECTIONS:
+        return extract_all_table_data(section_name, document)
+    return data
+
+
+# Function to build the prompt that updates an append-only section's previous summary with
+# its new rows; None if the section needs a full summary
+def delta_prompt(previous, section_name, data, rows):
+    if previous is None or section_name not in APPEND_ONLY_SECTIONS:
+        return None
+    new_rows = appended_rows(previous["rows"], data, rows)
+    if not new_rows:
+        return None
+    prompt = DELTA_PROMPT_TEMPLATE.format(summary=previous["summary"], data=render_rows(new_rows))
+    if count_tokens(prompt) > SUMMARY_PROMPT_TOKEN_LIMIT:
+        return None
+    return prompt
+
+
+# Function to build the summarize function the executor runs for (section name, data) items;
+# it records each section's status in statuses
+def section_summarizer(document, statuses, incremental=True):
+    def summarize(item, on_token=None):
+        section_name, data = item
+        summary, statuses[section_name] = summarize_section(document, section_name, data, on_token, incremental)
+        return summary
+    return summarize
+
+
+# Function to build the coroutine function the executor runs for (section name, data) items
+# under ASGI; like section_summarizer, but the backend requests are awaited on the event loop
+def section_summarizer_async(document, statuses, incremental=True):
+    async def summarize(item, on_token=None):
+        section_name, data = item
+        summary, statuses[section_name] = await run_steps_async(
+            summarize_section_steps(document, section_name, data, on_token, incremental))
+        return summary
+    return summarize
+
+
+# Function to read the optional period of a summary request ("since" and "until" ISO dates);
+# raises ValueError for an invalid date
+def requested_period(options):
+    return parse_period_bound(options.get("since")), parse_period_bound(options.get("until"), end=True)
+
+
+# Sections summarized from precomputed analytics (trends, changes, out-of-range flags)
+# instead of their raw rows; ANALYTICS_SECTIONS="" sends the rows as before
+ANALYTICS_SECTIONS = [section_name.strip() for section_name in
+                      os.environ.get("ANALYTICS_SECTIONS", "Vitals,Past Encounters,Procedures").split(",")
+                      if section_name.strip()]
+
+
+# Function to get the data a section is summarized from: its analytics facts, or its rows
+def summary_rows(section_name, document, since=None, until=None):
+    if section_name in ANALYTICS_SECTIONS:
+        from ccda_analytics import facts
+
+        with span("analytics"):
+            section_facts = facts(document, section_name, since, until)
+        if section_facts:
+            return section_facts
+    return extract_section_rows(section_name, document, since, until)
+
+
+# Function to list the sections whose summaries were produced by the model in this request
+def recomputed_sections(section_names, statuses):
+    return [section_name for section_name in section_names if statuses.get(section_name) in RECOMPUTED_STATUSES]
+
+
+# ************************************ SUMMARY CACHE ****************************************
+
+# Define a route to report summary cache hit/miss counters
+@app.route("/summary_cache", methods=["GET"])
+def summary_cache_stats():
+    return jsonify(summary_cache.stats())
+
+
+# Define a route to invalidate the summary cache
+@app.route("/summary_cache", methods=["DELETE"])
+def clear_summary_cache():
+    summary_cache.clear()
+    return jsonify({"message": "Summary cache cleared."})
+
+# ************************************ METRICS ****************************************
+
+# Server-Timing header with the request's stage timings on every response (SERVER_TIMING=1),
+# or only on requests that ask for it with ?timing=1
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") in ("1", "true")
+
+# With PROFILE_DIR set, a request with ?profile=1 is sampled and its collapsed stacks are
+# written to a file in that directory, named in the X-Profile response header
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.005))
+if PROFILE_DIR:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+
+metrics.describe("ccda_request_seconds", "histogram", "Request latency by route.")
+metrics.describe("ccda_requests_total", "counter", "Requests by route and status.")
+metrics.describe("ccda_llm_calls_total", "counter", "Completion requests sent to the summarizer backend.")
+metrics.describe("ccda_llm_errors_total", "counter", "Completion requests that failed.")
+metrics.describe("ccda_llm_prompt_tokens_total", "counter", "Prompt tokens sent to the summarizer backend.")
+metrics.describe("ccda_llm_completion_tokens_total", "counter", "Completion tokens received from the summarizer backend.")
+metrics.describe("ccda_uploads_total", "counter", "Uploads by outcome.")
+metrics.describe("ccda_upload_bytes_total", "counter", "Bytes of accepted uploads.")
+metrics.describe("ccda_upload_empty_sections_total", "counter", "Sections without data in accepted uploads.")
+metrics.describe("ccda_document_cache_hits_total", "counter", "Parsed document cache hits.")
+metrics.describe("ccda_document_cache_misses_total", "counter", "Parsed document cache misses (loaded from the store).")
+metrics.describe("ccda_document_snapshot_loads_total", "counter", "Snapshot loads on cache misses, by result (miss: parsed from XML).")
+metrics.gauge("ccda_document_cache_documents", "Parsed documents in this worker's cache.",
+              lambda: [({}, len(document_cache))])
+metrics.gauge("ccda_summary_cache_lookups", "Summary cache lookups in this worker by result.",
+              lambda: [({"result": "hit"}, summary_cache.hits), ({"result": "miss"}, summary_cache.misses)])
+metrics.gauge("ccda_summary_cache_hit_ratio", "Share of summary cache lookups in this worker that hit.",
+              lambda: [({}, summary_cache.stats()["hit_rate"])])
+metrics.describe("ccda_llm_coalesced_total", "counter", "Completions shared with an identical prompt already in flight.")
+metrics.describe("ccda_admission_wait_seconds", "histogram", "Time admitted requests waited in the admission queue.")
+metrics.describe("ccda_admission_rejected_total", "counter", "Requests rejected by admission control, by reason.")
+metrics.gauge("ccda_admission_active", "Summarizing requests running in this worker.",
+              lambda: [({}, admission_queue.active)])
+metrics.gauge("ccda_admission_queued", "Summarizing requests waiting for admission in this worker.",
+              lambda: [({}, admission_queue.queued)])
+metrics.gauge("ccda_llm_calls_in_flight", "Distinct prompts awaiting the summarizer backend in this worker.",
+              lambda: [({}, len(llm_calls))])
+
+
+@app.before_request
+def start_request_trace():
+    g.request_start = time.perf_counter()
+    g.trace, g.trace_token = start_trace()
+    g.profiler = None
+    if PROFILE_DIR and request.args.get("profile") in ("1", "true"):
+        g.profiler = SamplingProfiler(threading.get_ident(), PROFILE_INTERVAL).start()
+
+
+@app.after_request
+def finish_request_trace(response):
+    trace = g.get("trace")
+    if trace is None:
+        return response
+
+    elapsed = time.perf_counter() - g.request_start
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.observe("ccda_request_seconds", elapsed, route=route, method=request.method)
+    metrics.inc("ccda_requests_total", route=route, method=request.method, status=response.status_code)
+
+    if SERVER_TIMING or request.args.get("timing") in ("1", "true"):
+        timing = trace.server_timing()
+        response.headers["Server-Timing"] = (timing + ", " if timing else "") + "total;dur=%.2f" % (elapsed * 1000)
+
+    if g.profiler is not None:
+        g.profiler.stop()
+        profile_name = "%d-%s.folded" % (time.time() * 1000, request.endpoint)
+        with open(os.path.join(PROFILE_DIR, profile_name), "w") as profile_file:
+            profile_file.write(g.profiler.collapsed())
+        response.headers["X-Profile"] = profile_name
+    return response
+
+
+@app.teardown_request
+def end_request_trace(error=None):
+    token = g.pop("trace_token", None)
+    if token is not None:
+        end_trace(token)
+
+
+# Define a route to expose the metrics of this worker in the Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+# Define a route to get this worker's admission queue (depth, running requests, retry estimate)
+@app.route("/admission", methods=["GET"])
+def admission_status():
+    stats = admission_queue.stats()
+    stats["retry_after"] = admission_queue.retry_after()
+    return jsonify(stats)
+
+# ************************************ RESPONSE COMPRESSION ****************************************
+
+# Response bodies of at least COMPRESS_MIN_SIZE bytes are sent with brotli (if installed) or
+# gzip, whichever the client accepts; COMPRESS_RESPONSES=0 turns this off
+COMPRESS_RESPONSES = os.environ.get("COMPRESS_RESPONSES", "1") in ("1", "true")
+COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 1024))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))
+
+
+# Registered after the request trace hook, so it runs first and its time shows in Server-Timing
+@app.after_request
+def compress(response):
+    if not COMPRESS_RESPONSES:
+        return response
+    return compress_response(response, request.accept_encodings, COMPRESS_MIN_SIZE, COMPRESS_LEVEL)
+
+# ************************************ PREFETCH ****************************************
+
+# Optionally summarize the usual sections of every accepted upload in the background
+# (SUMMARY_PREFETCH=1), so the follow-up requests are served from the summary cache
+PREFETCH_SECTIONS = [section_name.strip() for section_name in
+                     os.environ.get("PREFETCH_SECTIONS", ",".join(DEFAULT_SUMMARY_SECTIONS)).split(",")
+                     if section_name.strip()]
+
+
+# Function to estimate the prompt tokens a section summary would cost, 0 if it is cached
+def prefetch_cost(doc_id, section_name, data):
+    fingerprint = summary_key(data)
+    if fingerprint in summary_cache:
+        return 0
+    document = get_document(doc_id)
+    if document is not None:
+        _, _, previous = previous_section_summary(document, section_name, data)
+        if previous is not None and previous["fingerprint"] == fingerprint:
+            return 0
+    return count_tokens(render_rows(data)) + SUMMARY_MAX_TOKENS
+
+
+# Function to summarize one prefetched section
+def prefetch_summary(doc_id, section_name, data):
+    document = get_document(doc_id)
+    if document is not None:
+        summarize_section(document, section_name, data)
+
+
+# Function to extract the sections to prefetch, skipping the ones without rows like /extract_medical_data
+def prefetch_items(doc_id):
+    document = get_document(doc_id)
+    if document is None:
+        return []
+    items = []
+    for section_name in PREFETCH_SECTIONS:
+        section_data = summary_rows(section_name, document)
+        if len(section_data) > 0:
+            items.append((section_name, section_data))
+    return items
+
+
+prefetcher = None
+if os.environ.get("SUMMARY_PREFETCH", "0") in ("1", "true"):
+    prefetcher = Prefetcher(
+        prefetch_summary, prefetch_cost, summary_executor,
+        max_workers=int(os.environ.get("PREFETCH_CONCURRENCY", 1)),
+        token_budget=int(os.environ.get("PREFETCH_TOKEN_BUDGET", 20000))
+    )
+
+
+# Define a route to report the prefetch progress of a document
+@app.route("/prefetch", methods=["GET"])
+def prefetch_status():
+    status = prefetcher.status(request.args.get("document_id")) if prefetcher is not None else None
+    if status is None:
+        return jsonify({"message": "No prefetch found for this document."}), 404
+    return jsonify(status)
+
+
+# Define a route to cancel the prefetch of a document
+@app.route("/prefetch", methods=["DELETE"])
+def cancel_prefetch():
+    if prefetcher is None or not prefetcher.cancel(request.args.get("document_id")):
+        return jsonify({"message": "No running prefetch found for this document."}), 404
+    return jsonify({"message": "Prefetch cancelled."})
+
+# ************************************ SEARCH ****************************************
+
+# Rows of every uploaded document are indexed in the background for search across
+# patients (SEARCH_INDEX=0 turns it off). The hashing embedder works offline;
+# SEARCH_EMBEDDER=openai uses the OpenAI embeddings API instead.
+SEARCH_MAX_RESULTS = int(os.environ.get("SEARCH_MAX_RESULTS", 100))
+RAG_PROMPT_TEMPLATE = ("Answer the question using only these rows from patient records. Name the patient "
+                       "each fact comes from, and say so if the rows do not answer it.\n"
+                       "Question: {question}\nRows:\n{rows}")
+
+row_index = None
+if os.environ.get("SEARCH_INDEX", "1") in ("1", "true"):
+    SEARCH_EMBEDDER = os.environ.get("SEARCH_EMBEDDER", "hashing")
+    if SEARCH_EMBEDDER == "openai":
+        embedder = create_embedder("openai", backend=llm_backend,
+                                   model=os.environ.get("SEARCH_EMBEDDING_MODEL", "text-embedding-3-small"),
+                                   dim=int(os.environ.get("SEARCH_EMBEDDING_DIM", 512)))
+    else:
+        embedder = create_embedder(SEARCH_EMBEDDER, dim=int(os.environ.get("SEARCH_EMBEDDING_DIM", 1024)))
+    row_index = RowIndex(os.environ.get("SEARCH_INDEX_PATH", "search_index.sqlite3"), embedder)
+    index_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-index")
+    metrics.gauge("ccda_search_indexed_documents", "Documents in the search index.",
+                  lambda: [({}, row_index.stats()["documents"])])
+
+
+# Function to add an uploaded document's rows to the search index, unless they are already in it
+def index_document(doc_id):
+    try:
+        if doc_id in row_index:
+            return
+        document = get_document(doc_id)
+        if document is not None:
+            with span("index"):
+                chunk_count = row_index.add_document(document)
+            logger.debug("Indexed %d rows of %s", chunk_count, doc_id)
+    except Exception:
+        logger.exception("Indexing %s failed", doc_id)
+
+
+# Function to answer a question from search results, with as many rows as fit in one prompt
+def answer_from_rows(question, results):
+    if not results:
+        return "No matching rows found."
+
+    budget = SUMMARY_PROMPT_TOKEN_LIMIT - count_tokens(RAG_PROMPT_TEMPLATE + question)
+    lines = []
+    for result in results:
+        line = "- [%s] %s" % (result["patient_name"] or result["patient"] or result["document_id"], result["text"])
+        budget -= count_tokens(line)
+        if budget < 0 and lines:
+            break
+        lines.append(line)
+    return complete_prompt(RAG_PROMPT_TEMPLATE.format(question=question, rows="\n".join(lines)))
+
+
+# Define a route to search the rows of all indexed documents; "answer" also asks the
+# summarizer to answer the query from the rows found
+@app.route("/search", methods=["GET", "POST"])
+@admission_controlled
+def search_rows():
+    if row_index is None:
+        return jsonify({"error": "Search is not enabled."}), 404
+
+    options = request.get_json(silent=True) or request.args
+    query = options.get("q") or options.get("query")
+    if not query:
+        return jsonify({"error": "No search query given."}), 400
+    try:
+        k = min(max(int(options.get("k", 10)), 1), SEARCH_MAX_RESULTS)
+    except (TypeError, ValueError):
+        return jsonify({"error": "k must be a number."}), 400
+
+    with span("search"):
+        results = row_index.search(query, k, section=options.get("section"), patient=options.get("patient"))
+    response = {"query": query, "results": results}
+    if options.get("answer") in (True, "1", "true"):
+        response["answer"] = answer_from_rows(query, results)
+    return jsonify(response)
+
+
+# Define a route to remove a document from the search index
+@app.route("/search", methods=["DELETE"])
+def delete_from_search():
+    if row_index is None or not row_index.delete_document(request.args.get("document_id")):
+        return jsonify({"message": "Document not found in the search index."}), 404
+    return jsonify({"message": "Document removed from the search index."})
+
+# ************************************ ASK ****************************************
+
+# Questions about one document are answered from its best matching rows (BM25 over
+# the rows of its sections) instead of from whole sections
+ASK_TOP_ROWS = int(os.environ.get("ASK_TOP_ROWS", 8))
+ASK_PROMPT_TEMPLATE = ("Answer the question about this patient using only the numbered rows below from their "
+                       "record. Cite the rows you used by number, like [2], and say so if the rows do not "
+                       "answer it.\nQuestion: {question}\nRows:\n{rows}")
+
+
+# Function to answer a question from the rows that best match it, cached like the section summaries
+def answer_question(question, rows):
+    data = {"question": question, "rows": [row["text"] for row in rows]}
+    cache_key = summary_cache_key(data, SUMMARY_MODEL, ASK_PROMPT_TEMPLATE,
+                                  max_tokens=SUMMARY_MAX_TOKENS, temperature=SUMMARY_TEMPERATURE)
+    with span("summary_cache"):
+        answer = summary_cache.get(cache_key)
+    if answer is None:
+        numbered = "\n".join("[%d] %s" % (row["id"], row["text"]) for row in rows)
+        answer = complete_prompt(ASK_PROMPT_TEMPLATE.format(question=question, rows=numbered))
+        summary_cache.put(cache_key, answer)
+    return answer
+
+
+# Define a route to answer a question about an uploaded document, citing the section
+# and row of every row given to the model
+@app.route("/ask", methods=["POST"])
+@admission_controlled
+def ask_document():
+    document = get_requested_document()
+    if not document:
+        return jsonify({"message": "No uploaded XML file found."})
+
+    options = request.get_json(silent=True) or {}
+    question = options.get("question")
+    if not question:
+        return jsonify({"error": "No question given."}), 400
+    sections = options.get("sections")
+
+    # Rank the rows, keeping the best ones that fit in one prompt
+    with span("rank"):
+        chunks = [chunk for chunk in document_chunks(document) if not sections or chunk[0] in sections]
+        ranked = BM25([text for _, _, text in chunks]).rank(question, ASK_TOP_ROWS)
+    budget = SUMMARY_PROMPT_TOKEN_LIMIT - count_tokens(ASK_PROMPT_TEMPLATE + question)
+    rows = []
+    for score, position in ranked:
+        section_name, row_number, text = chunks[position]
+        budget -= count_tokens(text) + 4
+        if budget < 0 and rows:
+            break
+        rows.append({"id": len(rows) + 1, "section": section_name, "row": row_number,
+                     "score": round(score, 4), "text": text})
+
+    if not rows:
+        return jsonify({"question": question, "answer": "No rows in this document match the question.",
+                        "citations": []})
+    return jsonify({"question": question, "answer": answer_question(question, rows), "citations": rows})
+
+# ************************************ EXTRACT PERSONAL DETAILS ****************************************
+# Define a route to extract personal details from the uploaded CCDA file
+@app.route("/extract_personal_details", methods=["GET"])
+def extract_personal_details():
+    # Check if an uploaded XML file exists
+    document = get_requested_document()
+    if not document:
+        return jsonify({"message": "No uploaded XML file found."})
+
+    # Personal details are extracted once when the document is parsed
+    personal_details = document.personal_info
+
+    # Format the extracted personal details for output
+    formatted_output = {
+        "Name": personal_details["Name"],
+        "Gender": personal_details["Gender"],
+        "Birthdate": personal_details["Birthdate"],
+        "Marital_Status": personal_details["Marital Status"],
+        "Patient-ID": personal_details.get("Patient-ID", {}),
+        "Contact_Details": personal_details.get("Contact Details", {})
+    }
+
+    return jsonify({"personal_details": formatted_output})
+
+# ************************************ EXTRACT MEDICAL DETAILS ****************************************
+
+# This Route is for extracting Medical Data
+@app.route("/extract_medical_data", methods=["GET"])
+@admission_controlled
+def extract_medical_data():
+    document = get_requested_document()
+    if not document:
+        return jsonify({"message": "No uploaded XML file found."})
+
+    sections_to_extract = DEFAULT_SUMMARY_SECTIONS
+
+    extracted_data = {}
+
+    with span("extract"):
+        section_data = {section_name: extract_all_table_data(section_name, document)
+                        for section_name in sections_to_extract}
+
+    # Summarize the sections that have data concurrently
+    sections_with_rows = [section_name for section_name in sections_to_extract if len(section_data[section_name]) > 0]
+    statuses = {}
+    summaries = summary_executor.summarize(section_summarizer(document, statuses),
+                                           [(section_name, section_data[section_name])
+                                            for section_name in sections_with_rows])
+    summaries = dict(zip(sections_with_rows, summaries))
+
+    for section_name in sections_to_extract:
+        section_key = section_name.replace(" ", "_")
+        if section_name in summaries:
+            extracted_data[section_key] = summaries[section_name]
+        else:
+            extracted_data[section_key] = "No data available in this section."
+
+    # The body is keyed by section, so the recomputed sections are reported in a header
+    response = jsonify(extracted_data)
+    response.headers["X-Recomputed-Sections"] = ", ".join(recomputed_sections(sections_with_rows, statuses))
+    return response
+
+# ************************************ EXTRACT KEY VALUE DETAILS ****************************************
+
+# Define a route to extract key-value data from the uploaded CCDA file
+@app.route("/extract_key_value_data", methods=["GET"])
+def extract_key_value_data():
+    # Check if an uploaded XML file exists
+    document = get_requested_document()
+    if not document:
+        return jsonify({"message": "No uploaded XML file found."})
+
+    # Execute the extraction functions for specified sections and headers
+    with span("extract"):
+        past_encounters_data_table = extract_data_from_table_section('Past Encounters', 'Encounter date',
+                                                                     'Diagnosis/Indication', document)
+        vitals_data_table = extract_data_from_table_section('Vitals', 'Date Recorded', 'Body mass index (BMI)', document)
+        procedures_data_table_1 = extract_data_from_table_section('Procedures', 'Date', 'Name', document)
+        procedures_data_table_2 = extract_data_from_table_section('Procedures', 'Imaging Date', 'Name', document)
+        assessment_data_table = extract_data_from_table_section('Assessment', 'Assessment Date', 'Assessment', document)
+        medication_data_table = extract_data_from_table_section('Medications', 'Name', 'Status', document)
+
+    # Return the extracted data
+    return jsonify({
+        "Assessment": assessment_data_table,
+        "Past_Encounters": past_encounters_data_table,
+        "Procedures": procedures_data_table_1,
+        "Procedures_(Imaging)": procedures_data_table_2,
+        "Vitals": vitals_data_table,
+        "Medications": medication_data_table
+    })
+
+# ************************************ EXTRACT DETAILS DYNAMICALLY ****************************************
+
+# Define a route to extract dynamic data from the uploaded CCDA file.
+# ?format=columnar gives every table of a section as its headers once plus the rows as arrays,
+# ?offset=N&limit=M returns one page of sections (the total is in the X-Total-Sections header),
+# and ?stream=1 sends one NDJSON line per section as soon as it is extracted.
+@app.route("/extract_dynamic_data", methods=["GET"])
+def extract_dynamic_data():
+    # Check if an uploaded XML file exists
+    document = get_requested_document()
+    if not document:
+        return jsonify({"message": "No uploaded XML file found."})
+
+    columnar = request.args.get("format") == "columnar"
+
+    # Get all section names dynamically (each title once, its tables are gathered together)
+    section_names = list(dict.fromkeys(section.title for section in document.sections))
+
+    # Keep only the requested page of sections
+    total_sections = len(section_names)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit < 0:
+        return jsonify({"error": "limit must not be negative."}), 400
+    paginated = offset > 0 or limit is not None
+    if paginated:
+        section_names = section_names[offset:offset + limit if limit is not None else None]
+
+    def section_value(section_name):
+        section_data = extract_data_from_table_section_two(section_name, document)
+        if columnar:
+            return {"tables": [{"headers": entry["headers"], "rows": entry["table_data"]} for entry in section_data]}
+
+        # Generate 'header: table_data' pairs for each section
+        section_key_values = {}
+        for entry in section_data:
+            headers = entry["headers"]
+            table_data = entry["table_data"]
+
+            header_table_pairs = []
+            for row in table_data:
+                header_table_pairs.append({header: value for header, value in zip(headers, row)})
+
+            section_key_values[section_name] = header_table_pairs
+        return section_key_values
+
+    headers = {}
+    if paginated:
+        headers["X-Total-Sections"] = str(total_sections)
+        if offset + len(section_names) < total_sections:
+            headers["X-Next-Offset"] = str(offset + len(section_names))
+
+    if request.args.get("stream") in ("1", "true"):
+        def generate():
+            for section_name in section_names:
+                with span("extract"):
+                    value = section_value(section_name)
+                yield encode_json({"section": section_name, "data": value}, default=app.json.default,
+                                  fast=app.json.fast)
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers=headers)
+
+    # Iterate through each section and extract data
+    with span("extract"):
+        extracted_data = {section_name: section_value(section_name) for section_name in section_names}
+
+    response = jsonify(extracted_data)
+    response.headers.extend(headers)
+    return response
+
+# ************************************ EXTRACT STRUCTURED DETAILS ****************************************
+
+# Define a route to extract typed records from the coded entries of the standard sections
+# (narrative table rows for the others). ?sections=A,B limits the sections, and
+# ?since=&until= (ISO dates) the period of the coded entries.
+@app.route("/extract_structured_data", methods=["GET"])
+def extract_structured_data():
+    document = get_requested_document()
+    if not document:
+        return jsonify({"message": "No uploaded XML file found."})
+
+    try:
+        since, until = requested_period(request.args)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+
+    section_names = list(dict.fromkeys(extract_section_names(document)))
+    if request.args.get("sections"):
+        section_names = [section_name.strip() for section_name in request.args["sections"].split(",")]
+
+    extracted_data = {}
+    with span("extract"):
+        for section_name in section_names:
+            records, source = extract_section_records(section_name, document, since, until)
+            extracted_data[section_name] = {"source": source, "records": records}
+    return jsonify(extracted_data)
+
+# ************************************ EXTRACT ANALYTICS ****************************************
+
+# Define a route to get the longitudinal analytics of the uploaded CCDA file: vital sign
+# trends and flags, encounter statistics and diagnoses, and procedures (?since=&until=)
+@app.route("/extract_analytics", methods=["GET"])
+def extract_analytics():
+    document = get_requested_document()
+    if not document:
+        return jsonify({"message": "No uploaded XML file found."})
+
+    try:
+        since, until = requested_period(request.args)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+
+    from ccda_analytics import document_analytics
+
+    with span("analytics"):
+        analytics = document_analytics(document, since, until)
+    return jsonify(analytics)
+
+# ************************************ BATCH PROCESSING ****************************************
+
+# Batch sources must live under this directory
+BATCH_INPUT_ROOT = os.path.realpath(os.environ.get("BATCH_INPUT_ROOT", "files"))
+
+batch_jobs = BatchJobs(
+    os.environ.get("BATCH_JOBS_DIR", "batch_jobs"),
+    summarize_fn=generate_summary,
+    summary_executor=summary_executor,
+    workers=int(os.environ["BATCH_WORKERS"]) if os.environ.get("BATCH_WORKERS") else None
+)
+
+
+# Define a route to submit a batch job over a directory or manifest of CCDA files
+@app.route("/batch", methods=["POST"])
+def submit_batch():
+    options = request.get_json(silent=True) or {}
+    source = options.get("source")
+    if not source:
+        return jsonify({"error": "No batch source given."}), 400
+
+    # Resolve the source inside the batch input root
+    source_path = os.path.realpath(os.path.join(BATCH_INPUT_ROOT, source))
+    if os.path.commonpath([source_path, BATCH_INPUT_ROOT]) != BATCH_INPUT_ROOT or not os.path.exists(source_path):
+        return jsonify({"error": "Batch source not found."}), 400
+
+    try:
+        paths = discover_inputs(source_path, root=BATCH_INPUT_ROOT)
+    except ValueError:
+        return jsonify({"error": "Batch source lists files outside the input root."}), 400
+    job_id = batch_jobs.submit(paths, summarize=bool(options.get("summarize")),
+                               summary_sections=options.get("sections"))
+    return jsonify({"job_id": job_id, "total": len(paths)}), 202
+
+
+# Define a route to poll the status of a batch job
+@app.route("/batch/<job_id>", methods=["GET"])
+def batch_status(job_id):
+    status = batch_jobs.status(job_id)
+    if status is None:
+        return jsonify({"error": "Batch job not found."}), 404
+    return jsonify(status)
+
+# ************************************ ERROR HANDLING ****************************************
+
+# Define a custom error handler for various exceptions and HTTP error codes
+@app.errorhandler(Exception)
+@app.errorhandler(400)
+@app.errorhandler(404)
+@app.errorhandler(500)
+def error_handler(error):
+    status_code = error.code
+
+    # Define error messages based on status code
+    if status_code == 400:
+        message = "Bad request. Please check your input."
+    elif status_code == 404:
+        message = "Resource not found."
+    elif status_code == 500:
+        message = "Internal server error. Please try again later."
+    else:
+        message = "An error occurred."
+
+    # Return the error message and status code as a JSON response
+    return jsonify({"error": message}), status_code
+
+# ************************************ APP FACTORY ****************************************
+
+# Importing this module only reads the configuration and registers the routes. SQLite
+# connections, HTTP sessions and the document reaper are created on first use in the
+# process that uses them, so a gunicorn master can import the app once (--preload)
+# and fork its workers from it.
+services_pid = None
+
+
+# Function to start this process's background threads; called before each request, it
+# only does anything once per process, including in workers forked after import
+def start_background_services():
+    global services_pid
+    if services_pid == os.getpid():
+        return
+    services_pid = os.getpid()
+    if REAPER_INTERVAL > 0:
+        document_reaper.start()
+
+
+@app.before_request
+def start_worker():
+    start_background_services()
+
+
+def create_app(preload=False):
+    """
+    Entry point for WSGI servers (see wsgi.py). With preload, the modules that are
+    otherwise imported by the first request that needs them (pandas for the analytics,
+    numpy and faiss for the search index) are imported now, and everything loaded so far is frozen out of the garbage
+    collector, so that forked workers keep sharing those pages copy-on-write.
+    """
+    if preload:
+        import ccda_analytics
+        if row_index is not None:
+            load_faiss()
+        gc.collect()
+        gc.freeze()
+    return app
+
+
+if __name__ == "__main__":
+    app.run(debug=True)
+
@@ -0,0 +1,322 @@
+"""
+ASGI entry point, for serving many concurrent summarizations from one process.
+
+Usage:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker --workers 2
+
+The summarization routes (/summarize_selected_sections, its /stream variant and
+/extract_medical_data) are coroutines: a request waiting for admission or for its
+summaries holds no thread, so one process can keep hundreds of them open. Their
+sections are summarized by the same steps as the Flask routes, but each backend
+request is awaited on the event loop (through httpx for the OpenAI backend, at
+most OPENAI_ASYNC_POOL_SIZE connections) within the same rate limit and with the
+same coalescing of identical prompts. Extraction and the work between backend
+requests run in threads, so the event loop never blocks on them. Every other
+route is the Flask app from app.py, run on a thread pool.
+
+As summarizations hold no thread here, the admission limits default higher than
+under Flask: ADMISSION_MAX_ACTIVE 256, ADMISSION_MAX_QUEUED 1024 and
+ADMISSION_MAX_QUEUED_PER_CLIENT 64.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+
+import app as ccda
+from ccda_extraction import extract_all_table_data
+from metrics import end_trace, metrics, span, start_trace
+from responses import encode_json
+from summarizer import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+# An admitted summarization waits on the backend without a thread, so the admission limits
+# are sized for the async connection pool instead of for the summary executor's threads
+ccda.admission_queue.max_active = int(os.environ.get("ADMISSION_MAX_ACTIVE", 256))
+ccda.admission_queue.max_queued = int(os.environ.get("ADMISSION_MAX_QUEUED", 1024))
+ccda.admission_queue.max_queued_per_client = int(os.environ.get("ADMISSION_MAX_QUEUED_PER_CLIENT", 64))
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = {name: values[0] for name, values in
+                     parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1")
+                        for name, value in scope.get("headers", [])}
+        self.body = body
+
+    @property
+    def is_json(self):
+        mimetype = self.headers.get("content-type", "").split(";")[0].strip()
+        return mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))
+
+    # The JSON body, with the same errors as Flask's request.json
+    def json(self):
+        if not self.is_json:
+            raise HTTPError(415, "An error occurred.")
+        try:
+            return json.loads(self.body or b"null")
+        except ValueError:
+            raise HTTPError(400, "Bad request. Please check your input.")
+
+
+# ************************************ ROUTES ****************************************
+
+async def get_requested_document(request):
+    doc_id = request.args.get("document_id")
+    if doc_id is None and request.is_json:
+        try:
+            body = json.loads(request.body or b"null")
+        except ValueError:
+            body = None
+        if isinstance(body, dict):
+            doc_id = body.get("document_id")
+    with span("document"):
+        return await asyncio.to_thread(ccda.get_document, doc_id)
+
+
+# Function to get the data the selected sections are summarized from, like the Flask routes;
+# runs in a thread, since the analytics of some sections are computed with pandas
+async def extract_summary_data(document, section_names, since, until):
+    with span("extract"):
+        return await asyncio.to_thread(
+            lambda: [(section_name, ccda.summary_rows(section_name, document, since, until))
+                     for section_name in section_names])
+
+
+# Function to read the optional period of a summary request, like the Flask routes
+def requested_period(request):
+    try:
+        return ccda.requested_period(request.json())
+    except ValueError as error:
+        raise HTTPError(400, str(error))
+
+
+async def summarize_selected_sections(request):
+    document = await get_requested_document(request)
+    if not document:
+        return 200, {}, {"message": "No uploaded XML file found."}
+
+    selected_sections = request.json().get("selected_sections")
+    since, until = requested_period(request)
+    section_data = await extract_summary_data(document, selected_sections, since, until)
+
+    statuses = {}
+    summaries = await ccda.summary_executor.summarize_async(
+        ccda.section_summarizer_async(document, statuses, incremental=since is None and until is None), section_data)
+    return 200, {}, {"section_summaries": dict(zip(selected_sections, summaries)),
+                     "recomputed_sections": ccda.recomputed_sections(selected_sections, statuses)}
+
+
+async def stream_selected_sections(request):
+    document = await get_requested_document(request)
+    if not document:
+        return 200, {}, {"message": "No uploaded XML file found."}
+
+    selected_sections = request.json().get("selected_sections")
+    stream_format = request.args.get("format", "sse")
+    stream_tokens = request.args.get("tokens") in ("1", "true")
+    since, until = requested_period(request)
+    section_data = await extract_summary_data(document, selected_sections, since, until)
+    statuses = {}
+
+    def format_event(kind, payload):
+        if stream_format == "ndjson":
+            return json.dumps(dict(payload, event=kind)) + "\n"
+        return "event: %s\ndata: %s\n\n" % (kind, json.dumps(payload))
+
+    async def generate():
+        summarize = ccda.section_summarizer_async(document, statuses, incremental=since is None and until is None)
+        async for kind, index, text in ccda.summary_executor.stream_async(summarize, section_data,
+                                                                          tokens=stream_tokens):
+            section_name = selected_sections[index]
+            if kind == "token":
+                yield format_event("token", {"section": section_name, "text": text})
+            else:
+                yield format_event("summary", {"section": section_name, "summary": text,
+                                               "recomputed": statuses.get(section_name) in ccda.RECOMPUTED_STATUSES})
+        yield format_event("done", {})
+
+    mimetype = "application/x-ndjson" if stream_format == "ndjson" else "text/event-stream"
+    return 200, {"Content-Type": mimetype, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}, generate()
+
+
+async def extract_medical_data(request):
+    document = await get_requested_document(request)
+    if not document:
+        return 200, {}, {"message": "No uploaded XML file found."}
+
+    sections_to_extract = ccda.DEFAULT_SUMMARY_SECTIONS
+    with span("extract"):
+        section_data = dict(await asyncio.to_thread(
+            lambda: [(section_name, extract_all_table_data(section_name, document))
+                     for section_name in sections_to_extract]))
+
+    # Summarize the sections that have data concurrently
+    sections_with_rows = [section_name for section_name in sections_to_extract if len(section_data[section_name]) > 0]
+    statuses = {}
+    summaries = await ccda.summary_executor.summarize_async(ccda.section_summarizer_async(document, statuses),
+                                                            [(section_name, section_data[section_name])
+                                                             for section_name in sections_with_rows])
+    summaries = dict(zip(sections_with_rows, summaries))
+
+    extracted_data = {}
+    for section_name in sections_to_extract:
+        extracted_data[section_name.replace(" ", "_")] = summaries.get(section_name,
+                                                                       "No data available in this section.")
+
+    headers = {"X-Recomputed-Sections": ", ".join(ccda.recomputed_sections(sections_with_rows, statuses))}
+    return 200, headers, extracted_data
+
+
+ROUTES = {
+    ("POST", "/summarize_selected_sections"): summarize_selected_sections,
+    ("POST", "/summarize_selected_sections/stream"): stream_selected_sections,
+    ("GET", "/extract_medical_data"): extract_medical_data,
+}
+
+
+# ************************************ ASGI APPLICATION ****************************************
+
+class ThreadedWsgiToAsgiInstance(WsgiToAsgiInstance):
+    # asgiref runs every WSGI request on one shared thread by default; use the thread pool instead
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__["run_wsgi_app"].func, thread_sensitive=False)
+
+
+class ThreadedWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await ThreadedWsgiToAsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+
+flask_application = ThreadedWsgiToAsgi(ccda.app)
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+def encode_headers(headers):
+    encoded = [(b"access-control-allow-origin", b"*")]
+    for name, value in headers.items():
+        encoded.append((name.lower().encode("latin-1"), value.encode("latin-1")))
+    return encoded
+
+
+async def send_stream(receive, send, start, chunks):
+    async def pump():
+        await send(start)
+        async for chunk in chunks:
+            await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    # Stop summarizing as soon as the client goes away
+    pump_task = asyncio.create_task(pump())
+    disconnect_task = asyncio.create_task(wait_for_disconnect(receive))
+    done, pending = await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    for task in pending:
+        task.cancel()
+    if pump_task in done:
+        pump_task.result()
+
+
+async def handle(handler, scope, receive, send):
+    body = await read_body(receive)
+    if body is None:
+        return
+    request = Request(scope, body)
+    route = request.path
+    request_start = time.perf_counter()
+    trace, trace_token = start_trace()
+    admitted_at = None
+    # Recorded if the request is cancelled before it has a response (the client went away)
+    status = 499
+    try:
+        try:
+            # The summarization routes share app.py's admission queue with the Flask routes
+            if ccda.admission_queue.enabled:
+                client = request.headers.get("x-client-id") or (scope.get("client") or ("unknown",))[0]
+                with span("admission"):
+                    waited = await ccda.admission_queue.acquire_async(client)
+                metrics.observe("ccda_admission_wait_seconds", waited)
+                admitted_at = time.monotonic()
+            status, headers, payload = await handler(request)
+        except AdmissionRejected as rejection:
+            metrics.inc("ccda_admission_rejected_total", reason=rejection.reason)
+            status, headers = 429, {"Retry-After": str(rejection.retry_after)}
+            payload = {"error": "Too many requests. Please retry later.", "reason": rejection.reason,
+                       "retry_after": rejection.retry_after}
+        except HTTPError as error:
+            status, headers, payload = error.status, {}, {"error": error.message}
+        except Exception:
+            logger.exception("Request to %s failed", route)
+            status, headers, payload = 500, {}, {"error": "Internal server error. Please try again later."}
+
+        if hasattr(payload, "__aiter__"):
+            start = {"type": "http.response.start", "status": status, "headers": encode_headers(headers)}
+            await send_stream(receive, send, start, payload)
+        else:
+            response_body = encode_json(payload)
+            elapsed = time.perf_counter() - request_start
+            if ccda.SERVER_TIMING or request.args.get("timing") in ("1", "true"):
+                timing = trace.server_timing()
+                headers["Server-Timing"] = (timing + ", " if timing else "") + "total;dur=%.2f" % (elapsed * 1000)
+            headers.setdefault("Content-Type", "application/json")
+            headers["Content-Length"] = str(len(response_body))
+            await send({"type": "http.response.start", "status": status, "headers": encode_headers(headers)})
+            await send({"type": "http.response.body", "body": response_body})
+    finally:
+        if admitted_at is not None:
+            ccda.admission_queue.release(time.monotonic() - admitted_at)
+        elapsed = time.perf_counter() - request_start
+        metrics.observe("ccda_request_seconds", elapsed, route=route, method=request.method)
+        metrics.inc("ccda_requests_total", route=route, method=request.method, status=status)
+        end_trace(trace_token)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            ccda.start_background_services()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    handler = ROUTES.get((scope.get("method"), scope.get("path"))) if scope["type"] == "http" else None
+    if handler is None:
+        return await flask_application(scope, receive, send)
+    return await handle(handler, scope, receive, send)
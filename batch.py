@@ -0,0 +1,322 @@
+"""
+Batch processing of archived CCDA files.
+
+Usage:
+    python batch.py SOURCE --output results.jsonl [--workers N] [--summarize] [--parquet results.parquet]
+                    [--analytics vitals.csv]
+
+SOURCE is a directory (searched recursively for *.xml) or a manifest file listing one
+XML path per line. Files are parsed across a process pool and one JSON record per file
+is appended to the output as soon as it is ready. Finished paths are recorded in a
+checkpoint file next to the output, so re-running the same command resumes where an
+interrupted run stopped.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ccda_document import CCDADocument
+from ccda_extraction import (extract_all_table_data, extract_data_from_table_section_two,
+                             extract_sections_with_data, extract_sections_without_data)
+
+logger = logging.getLogger(__name__)
+
+# Sections summarized by default, matching /extract_medical_data
+DEFAULT_SUMMARY_SECTIONS = ['Notes', 'Problems', 'Allergies', 'Medical History']
+
+
+# Function to list the XML files of a directory or manifest, in a stable order; an XML
+# file on its own is a batch of one. With a root, every file must resolve to a path
+# inside it (ValueError otherwise), so a manifest cannot point anywhere else on the host.
+def discover_inputs(source, root=None):
+    if source.lower().endswith(".xml") and os.path.isfile(source):
+        paths = [source]
+    elif os.path.isdir(source):
+        paths = []
+        for directory, _, filenames in os.walk(source):
+            for filename in filenames:
+                if filename.lower().endswith(".xml"):
+                    paths.append(os.path.join(directory, filename))
+        paths.sort()
+    else:
+        # Manifest: one path per line, relative paths are relative to the manifest
+        base_directory = os.path.dirname(os.path.abspath(source))
+        paths = []
+        with open(source, "r") as manifest:
+            for line in manifest:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    paths.append(os.path.join(base_directory, line))
+
+    if root is not None:
+        root = os.path.realpath(root)
+        for path in paths:
+            if os.path.commonpath([os.path.realpath(path), root]) != root:
+                raise ValueError("Batch input outside the input root: %s" % path)
+    return paths
+
+
+# Function to extract one file; runs in a worker process. A file that cannot be parsed
+# or extracted gets an error record instead of failing the batch.
+def process_file(path):
+    try:
+        return extract_file(path)
+    except Exception as error:
+        return {"path": path, "error": "%s: %s" % (type(error).__name__, error)}
+
+
+def extract_file(path):
+    from ccda_analytics import document_analytics, records, vitals_frame
+
+    document = CCDADocument.from_path(path)
+    sections = {}
+    tables = {}
+    for section_name in document.section_names():
+        sections[section_name] = extract_all_table_data(section_name, document)
+        tables[section_name] = extract_data_from_table_section_two(section_name, document)
+
+    # The readings themselves are kept so that write_analytics can trend each patient across files
+    analytics = document_analytics(document)
+    analytics["vital_readings"] = records(vitals_frame(document))
+
+    return {
+        "path": path,
+        "document_id": document.doc_id,
+        "personal_details": document.personal_info,
+        "sections_with_data": extract_sections_with_data(document),
+        "sections_without_data": extract_sections_without_data(document),
+        "sections": sections,
+        "tables": tables,
+        "analytics": analytics
+    }
+
+
+# Function to read the paths already finished by a previous run
+def load_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path, "r") as checkpoint:
+        return {line.rstrip("\n") for line in checkpoint if line.strip()}
+
+
+def run_batch(paths, output_path, workers=None, summarize_fn=None, summary_executor=None,
+              summary_sections=None, progress=None):
+    """
+    Process the given files and append one JSON line per file to output_path.
+
+    With summarize_fn, the sections in summary_sections that have data are summarized
+    through summary_executor (or one at a time without it). progress, if given, is
+    called with (processed, failed, total) after every file. Returns the same counts.
+    """
+    checkpoint_path = output_path + ".checkpoint"
+    done = load_checkpoint(checkpoint_path)
+    pending = [path for path in paths if path not in done]
+    summary_sections = summary_sections or DEFAULT_SUMMARY_SECTIONS
+
+    total = len(paths)
+    processed = total - len(pending)
+    failed = 0
+    if progress:
+        progress(processed, failed, total)
+    if not pending:
+        return processed, failed, total
+
+    # Spawned workers only import the extraction modules, not the Flask app
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool, \
+            open(output_path, "a") as output, open(checkpoint_path, "a") as checkpoint:
+        futures = [pool.submit(process_file, path) for path in pending]
+        for future in as_completed(futures):
+            record = future.result()
+
+            if summarize_fn is not None and "error" not in record:
+                record["summaries"] = summarize_record(record, summarize_fn, summary_executor, summary_sections)
+            if "error" in record:
+                failed += 1
+                logger.warning("Failed to process %s: %s", record["path"], record["error"])
+
+            # The record is written before its path is checkpointed, so a crash in
+            # between can only repeat a file, never lose one
+            output.write(json.dumps(record) + "\n")
+            output.flush()
+            checkpoint.write(record["path"] + "\n")
+            checkpoint.flush()
+
+            processed += 1
+            if progress:
+                progress(processed, failed, total)
+
+    return processed, failed, total
+
+
+# Function to summarize the selected sections of an extracted record
+def summarize_record(record, summarize_fn, summary_executor, summary_sections):
+    section_names = [section_name for section_name in summary_sections
+                     if len(record["sections"].get(section_name, [])) > 0]
+    section_data = [record["sections"][section_name] for section_name in section_names]
+
+    if summary_executor is not None:
+        summaries = summary_executor.summarize(summarize_fn, section_data)
+    else:
+        summaries = [summarize_fn(data) for data in section_data]
+    return dict(zip(section_names, summaries))
+
+
+# Function to convert a JSONL result file to Parquet (nested fields are stored as JSON strings)
+def write_parquet(jsonl_path, parquet_path):
+    import pandas as pd
+
+    with open(jsonl_path, "r") as results:
+        records = [json.loads(line) for line in results if line.strip()]
+    frame = pd.DataFrame.from_records(records)
+    for column in frame.columns:
+        if frame[column].map(lambda value: isinstance(value, (dict, list))).any():
+            frame[column] = frame[column].map(json.dumps)
+    frame.to_parquet(parquet_path, index=False)
+
+
+# Function to write the vital sign trends of a JSONL result file to a CSV table: the readings
+# of all its records are pooled, so there is one row per patient and measure across all of
+# that patient's files
+def write_analytics(jsonl_path, csv_path):
+    import pandas as pd
+    from ccda_analytics import cohort_vital_trends
+
+    frames = []
+    with open(jsonl_path, "r") as results:
+        for line in results:
+            if not line.strip():
+                continue
+            readings = json.loads(line).get("analytics", {}).get("vital_readings")
+            if readings:
+                frame = pd.DataFrame.from_records(readings)
+                frame["date"] = pd.to_datetime(frame["date"])
+                frame["value"] = frame["value"].astype(float)
+                frames.append(frame)
+    trends = cohort_vital_trends(frames)
+    trends.sort_values(["patient", "measure"], kind="mergesort").to_csv(csv_path, index=False)
+
+
+class BatchJobs:
+    """
+    Background batch jobs for the /batch endpoint. Each job runs in a thread and
+    keeps its status, results, checkpoint and vital sign trends in <directory>/<job_id>/,
+    so any worker sharing that directory can report the status of any job.
+    """
+
+    def __init__(self, directory, summarize_fn=None, summary_executor=None, workers=None):
+        self.directory = directory
+        self.summarize_fn = summarize_fn
+        self.summary_executor = summary_executor
+        self.workers = workers
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, paths, summarize=False, summary_sections=None):
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.directory, job_id))
+        self._write_status(job_id, {
+            "job_id": job_id,
+            "state": "queued",
+            "total": len(paths),
+            "processed": 0,
+            "failed": 0,
+            "output": self.output_path(job_id),
+            "submitted_at": time.time()
+        })
+
+        thread = threading.Thread(target=self._run, args=(job_id, paths, summarize, summary_sections),
+                                  name="batch-%s" % job_id, daemon=True)
+        thread.start()
+        return job_id
+
+    def status(self, job_id):
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(self._status_path(job_id), "r") as status_file:
+                return json.load(status_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def output_path(self, job_id):
+        return os.path.join(self.directory, job_id, "results.jsonl")
+
+    def analytics_path(self, job_id):
+        return os.path.join(self.directory, job_id, "vital_trends.csv")
+
+    def _run(self, job_id, paths, summarize, summary_sections):
+        status = self.status(job_id)
+        status.update({"state": "running", "started_at": time.time()})
+        self._write_status(job_id, status)
+
+        def progress(processed, failed, total):
+            status.update({"processed": processed, "failed": failed, "total": total})
+            self._write_status(job_id, status)
+
+        try:
+            run_batch(paths, self.output_path(job_id), workers=self.workers,
+                      summarize_fn=self.summarize_fn if summarize else None,
+                      summary_executor=self.summary_executor,
+                      summary_sections=summary_sections, progress=progress)
+            write_analytics(self.output_path(job_id), self.analytics_path(job_id))
+            status.update({"state": "completed", "analytics": self.analytics_path(job_id)})
+        except Exception as error:
+            logger.exception("Batch job %s failed", job_id)
+            status.update({"state": "failed", "error": "%s: %s" % (type(error).__name__, error)})
+        status["finished_at"] = time.time()
+        self._write_status(job_id, status)
+
+    def _status_path(self, job_id):
+        return os.path.join(self.directory, job_id, "status.json")
+
+    def _write_status(self, job_id, status):
+        temp_path = self._status_path(job_id) + ".tmp"
+        with open(temp_path, "w") as status_file:
+            json.dump(status, status_file)
+        os.replace(temp_path, self._status_path(job_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract (and optionally summarize) a batch of CCDA files.")
+    parser.add_argument("source", help="Directory of XML files, or a manifest with one path per line")
+    parser.add_argument("--output", "-o", required=True, help="JSONL file that results are appended to")
+    parser.add_argument("--workers", type=int, default=None, help="Parser processes (default: CPU count)")
+    parser.add_argument("--summarize", action="store_true", help="Summarize sections with the configured LLM")
+    parser.add_argument("--sections", nargs="+", default=None,
+                        help="Sections to summarize (default: %s)" % ", ".join(DEFAULT_SUMMARY_SECTIONS))
+    parser.add_argument("--parquet", help="Also write the results to this Parquet file when done")
+    parser.add_argument("--analytics", help="Also write each patient's vital sign trends across all files "
+                                            "to this CSV file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    summarize_fn = None
+    summary_executor = None
+    if args.summarize:
+        # The app module owns the rate-limited, cached summarizer shared with the API
+        from app import generate_summary, summary_executor
+        summarize_fn = generate_summary
+
+    def progress(processed, failed, total):
+        logger.info("%d/%d files processed (%d failed)", processed, total, failed)
+
+    paths = discover_inputs(args.source)
+    processed, failed, total = run_batch(paths, args.output, workers=args.workers, summarize_fn=summarize_fn,
+                                         summary_executor=summary_executor, summary_sections=args.sections,
+                                         progress=progress)
+    if args.parquet:
+        write_parquet(args.output, args.parquet)
+    if args.analytics:
+        write_analytics(args.output, args.analytics)
+    logger.info("Done: %d/%d files processed, %d failed", processed, total, failed)
+
+
+if __name__ == "__main__":
+    main()
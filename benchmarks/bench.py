@@ -0,0 +1,254 @@
+"""
+Benchmarks for the extraction functions and HTTP routes.
+
+Usage (from the repository root):
+    python -m benchmarks.bench --output bench.json
+    python -m benchmarks.bench --baseline bench.json --threshold 0.25
+
+Inputs are the sample CCDAs in files/ plus synthetic documents built from
+CCDA_Williams_Suzanne.xml with 10x/100x the sections and, separately, the rows
+(see --scales). Routes run through the Flask test client against the mock
+summarizer backend, so no network or API key is needed, and without search
+indexing unless --search-index is given. Every result records wall time (min
+and median over --repeat runs), peak traced memory and the net number of
+allocated blocks. With --baseline, results slower than the baseline by
+more than --threshold are reported and the exit status is 1.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLES_DIRECTORY = os.path.join(REPOSITORY, "files")
+SAMPLES = ["CCDA_Williams_Suzanne.xml", "CCDA_Trammell_Leroy.xml", "CCDA_Williams_Carl.xml",
+           "CCDA_Thompson_Minnie.xml"]
+SYNTHETIC_SAMPLE = "CCDA_Williams_Suzanne.xml"
+
+# Differences below this many seconds are treated as noise when comparing to a baseline
+NOISE_FLOOR = 0.001
+
+
+# Function to time a callable and measure its memory in a separate traced run
+def measure(fn, repeat, setup=None):
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = fn()
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    net_blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename") if stat.count_diff > 0)
+    return {
+        "repeat": repeat,
+        "wall_min_s": min(times),
+        "wall_median_s": statistics.median(times),
+        "peak_bytes": peak,
+        "net_blocks": net_blocks
+    }
+
+
+# Function to build the benchmark inputs: (name, xml bytes)
+def load_inputs(scales):
+    from benchmarks.synthetic import scale_ccda
+
+    inputs = []
+    for sample in SAMPLES:
+        with open(os.path.join(SAMPLES_DIRECTORY, sample), "rb") as sample_file:
+            inputs.append((sample, sample_file.read()))
+
+    sample_path = os.path.join(SAMPLES_DIRECTORY, SYNTHETIC_SAMPLE)
+    for scale in scales:
+        inputs.append(("sections_x%d" % scale, scale_ccda(sample_path, sections=scale)))
+        inputs.append(("rows_x%d" % scale, scale_ccda(sample_path, rows=scale)))
+    return inputs
+
+
+def bench_extraction(name, data, repeat):
+    from ccda_document import CCDADocument, extract_personal_info
+    from ccda_extraction import (extract_all_table_data, extract_data_from_table_section,
+                                 extract_data_from_table_section_two, extract_sections_with_data)
+    from ccda_snapshot import dump_snapshot, load_snapshot
+
+    document = CCDADocument.from_bytes(data)
+    snapshot_file = tempfile.NamedTemporaryFile(suffix=".snap", delete=False)
+    with snapshot_file:
+        snapshot_file.write(dump_snapshot(document))
+    root = ET.fromstring(data)
+    titles = document.section_names()
+    key_value_lookups = [
+        ('Past Encounters', 'Encounter date', 'Diagnosis/Indication'),
+        ('Vitals', 'Date Recorded', 'Body mass index (BMI)'),
+        ('Procedures', 'Date', 'Name'),
+        ('Procedures', 'Imaging Date', 'Name'),
+        ('Assessment', 'Assessment Date', 'Assessment'),
+        ('Medications', 'Name', 'Status')
+    ]
+
+    cases = {
+        "parse_document": lambda: CCDADocument.from_bytes(data),
+        "dump_snapshot": lambda: dump_snapshot(document),
+        # Loading alone, then loading and reading every table as the routes would
+        "load_snapshot": lambda: load_snapshot(snapshot_file.name),
+        "load_snapshot_all_tables": lambda: [table.rows for section in load_snapshot(snapshot_file.name).sections
+                                             for table in section.tables],
+        "extract_sections_with_data": lambda: extract_sections_with_data(document),
+        "extract_all_table_data": lambda: [extract_all_table_data(title, document) for title in titles],
+        "extract_data_from_table_section": lambda: [extract_data_from_table_section(*lookup, document)
+                                                    for lookup in key_value_lookups],
+        "extract_data_from_table_section_two": lambda: [extract_data_from_table_section_two(title, document)
+                                                        for title in titles],
+        "extract_personal_info": lambda: extract_personal_info(root)
+    }
+
+    results = []
+    for case, fn in cases.items():
+        result = measure(fn, repeat)
+        result.update({"name": case, "input": name, "size_bytes": len(data)})
+        results.append(result)
+    os.remove(snapshot_file.name)
+    return results
+
+
+def bench_routes(name, data, repeat, app_module):
+    client = app_module.app.test_client()
+
+    response = client.post("/upload", data={"xml_file": (io.BytesIO(data), name + ".xml")},
+                           content_type="multipart/form-data")
+    if response.status_code != 200:
+        # Rejected documents (too many empty sections) only have an upload timing
+        routes = {}
+    else:
+        doc_id = response.get_json()["document_id"]
+        sections = client.get("/get_sections_with_data?document_id=" + doc_id).get_json()["sections_with_data"]
+        query = "?document_id=" + doc_id
+        routes = {
+            "GET /get_sections_with_data": lambda: client.get("/get_sections_with_data" + query),
+            "GET /extract_personal_details": lambda: client.get("/extract_personal_details" + query),
+            "GET /extract_key_value_data": lambda: client.get("/extract_key_value_data" + query),
+            "GET /extract_dynamic_data": lambda: client.get("/extract_dynamic_data" + query),
+            "GET /extract_medical_data": lambda: client.get("/extract_medical_data" + query),
+            "POST /summarize_selected_sections": lambda: client.post(
+                "/summarize_selected_sections" + query, json={"selected_sections": sections}),
+            "POST /summarize_selected_sections/stream": lambda: client.post(
+                "/summarize_selected_sections/stream" + query, json={"selected_sections": sections}).get_data()
+        }
+
+    upload = lambda: client.post("/upload", data={"xml_file": (io.BytesIO(data), name + ".xml")},
+                                 content_type="multipart/form-data")
+    results = []
+    result = measure(upload, repeat)
+    result.update({"name": "POST /upload", "input": name, "size_bytes": len(data)})
+    results.append(result)
+
+    for route, fn in routes.items():
+        # Summaries are measured cold: every run starts with an empty summary cache
+        result = measure(fn, repeat, setup=app_module.summary_cache.clear)
+        result.update({"name": route, "input": name, "size_bytes": len(data)})
+        results.append(result)
+    return results
+
+
+# Function to import the app against temporary storage and the mock summarizer. Search
+# indexing is off unless it is measured, so that uploads time the parse and the store
+def import_app(work_directory, search_index=False):
+    os.environ.setdefault("SUMMARY_BACKEND", "mock")
+    os.environ["CCDA_STORE_DIR"] = os.path.join(work_directory, "uploads")
+    os.environ["SUMMARY_CACHE_PATH"] = os.path.join(work_directory, "summary_cache.sqlite3")
+    os.environ["SEARCH_INDEX"] = "1" if search_index else "0"
+    os.environ["SEARCH_INDEX_PATH"] = os.path.join(work_directory, "search_index.sqlite3")
+    os.environ["BATCH_JOBS_DIR"] = os.path.join(work_directory, "batch_jobs")
+    os.environ["OPENAI_RATE_LIMIT_FILE"] = os.path.join(work_directory, "budget.json")
+
+    import app
+    return app
+
+
+# Function to compare results with a baseline and return the regressions
+def compare(results, baseline, threshold):
+    previous = {(result["name"], result["input"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = previous.get((result["name"], result["input"]))
+        if before is None:
+            continue
+        old, new = before["wall_median_s"], result["wall_median_s"]
+        if new > old * (1 + threshold) and new - old > NOISE_FLOOR:
+            regressions.append({"name": result["name"], "input": result["input"],
+                                "baseline_s": old, "current_s": new, "ratio": new / old if old else None})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CCDA extraction and routes.")
+    parser.add_argument("--scales", type=int, nargs="*", default=[10, 100],
+                        help="Synthetic section/row multipliers (default: 10 100)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per case (default: 5)")
+    parser.add_argument("--skip-routes", action="store_true", help="Only benchmark the extraction functions")
+    parser.add_argument("--search-index", action="store_true",
+                        help="Index uploaded documents for search, so uploads include the indexing time")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare with results previously written by --output")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Allowed slowdown relative to the baseline (default: 0.25)")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPOSITORY)
+    work_directory = tempfile.mkdtemp(prefix="ccda-bench-")
+    app_module = None if args.skip_routes else import_app(work_directory, args.search_index)
+
+    results = []
+    for name, data in load_inputs(args.scales):
+        results.extend(bench_extraction(name, data, args.repeat))
+        if app_module is not None:
+            results.extend(bench_routes(name, data, args.repeat, app_module))
+        print("%-28s %s" % (name, "done"), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "repeat": args.repeat,
+            "scales": args.scales
+        },
+        "results": results
+    }
+
+    for result in results:
+        print("%-40s %-28s %10.2f ms %12d B peak" % (result["name"], result["input"],
+                                                    result["wall_median_s"] * 1000, result["peak_bytes"]))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            print("REGRESSION %(name)s on %(input)s: %(baseline_s).4fs -> %(current_s).4fs" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Startup benchmark: import time and first-request latency of a fresh process.
+
+Usage (from the repository root):
+    python -m benchmarks.startup --output startup.json
+    python -m benchmarks.startup --baseline startup.json --threshold 0.25
+
+Every run starts a new interpreter against temporary storage and the mock
+summarizer backend, and times importing the app (wsgi.py, with and without
+WSGI_PRELOAD), then the first and second requests to the main routes. The
+"forked" mode imports the app with preload in a parent process and times the
+same requests in a worker forked from it, as gunicorn --preload does. Results
+are the min and median over --repeat runs; --baseline works as in bench.py.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench import REPOSITORY, SAMPLES_DIRECTORY, SYNTHETIC_SAMPLE, compare
+
+# Runs in the fresh interpreter: prints the timings of one run as JSON
+CHILD_SCRIPT = r"""
+import io, json, os, sys, time
+start = time.perf_counter()
+mode, sample_path = sys.argv[1], sys.argv[2]
+timings = {}
+
+def send_requests(client, timings, suffix):
+    with open(sample_path, "rb") as sample:
+        data = sample.read()
+    begin = time.perf_counter()
+    response = client.post("/upload", data={"xml_file": (io.BytesIO(data), "sample.xml")},
+                           content_type="multipart/form-data")
+    timings["POST /upload" + suffix] = time.perf_counter() - begin
+    query = "?document_id=" + response.get_json()["document_id"]
+    routes = [
+        ("GET /extract_medical_data", lambda: client.get("/extract_medical_data" + query)),
+        ("POST /summarize_selected_sections", lambda: client.post(
+            "/summarize_selected_sections" + query, json={"selected_sections": ["Vitals", "Problems"]})),
+        ("GET /search", lambda: client.get("/search?q=blood+pressure")),
+    ]
+    for name, request in routes:
+        begin = time.perf_counter()
+        request()
+        timings[name + suffix] = time.perf_counter() - begin
+
+os.environ["WSGI_PRELOAD"] = "0" if mode == "lazy" else "1"
+import wsgi
+timings["import"] = time.perf_counter() - start
+
+if mode == "forked":
+    read_end, write_end = os.pipe()
+    fork_start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        child = {}
+        client = wsgi.application.test_client()
+        send_requests(client, child, " (first)")
+        child["fork_to_first_response"] = time.perf_counter() - fork_start
+        os.write(write_end, json.dumps(child).encode())
+        os._exit(0)
+    os.close(write_end)
+    chunks = []
+    while True:
+        chunk = os.read(read_end, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.waitpid(pid, 0)
+    timings.update(json.loads(b"".join(chunks)))
+else:
+    client = wsgi.application.test_client()
+    send_requests(client, timings, " (first)")
+    send_requests(client, timings, " (second)")
+print(json.dumps(timings))
+"""
+
+MODES = ["lazy", "preload", "forked"]
+
+
+# Function to run one fresh interpreter in a new work directory and return its timings
+def run_once(mode, sample_path):
+    work_directory = tempfile.mkdtemp(prefix="ccda-startup-")
+    environment = dict(os.environ)
+    environment.update({
+        "SUMMARY_BACKEND": "mock",
+        "CCDA_STORE_DIR": os.path.join(work_directory, "uploads"),
+        "SUMMARY_CACHE_PATH": os.path.join(work_directory, "summary_cache.sqlite3"),
+        "SEARCH_INDEX_PATH": os.path.join(work_directory, "search_index.sqlite3"),
+        "BATCH_JOBS_DIR": os.path.join(work_directory, "batch_jobs"),
+        "OPENAI_RATE_LIMIT_FILE": os.path.join(work_directory, "budget.json"),
+        "PYTHONPATH": REPOSITORY,
+    })
+    output = subprocess.run([sys.executable, "-c", CHILD_SCRIPT, mode, sample_path], cwd=work_directory,
+                            env=environment, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark app import and first-request latency.")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES,
+                        help="Startup modes to measure (default: all)")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh processes per mode (default: 5)")
+    parser.add_argument("--sample", default=os.path.join(SAMPLES_DIRECTORY, SYNTHETIC_SAMPLE),
+                        help="CCDA file uploaded by the first request")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare with results previously written by --output")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Allowed slowdown relative to the baseline (default: 0.25)")
+    args = parser.parse_args()
+
+    if "forked" in args.modes and not hasattr(os, "fork"):
+        args.modes.remove("forked")
+
+    # Warm the bytecode cache so the first run is not the only one compiling
+    run_once("lazy", args.sample)
+
+    results = []
+    for mode in args.modes:
+        runs = [run_once(mode, args.sample) for _ in range(args.repeat)]
+        for name in runs[0]:
+            times = [run[name] for run in runs]
+            results.append({"name": name, "input": mode, "repeat": args.repeat,
+                            "wall_min_s": min(times), "wall_median_s": statistics.median(times)})
+        print("%-10s %s" % (mode, "done"), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": time.time(),
+            "repeat": args.repeat,
+            "sample": os.path.basename(args.sample)
+        },
+        "results": results
+    }
+
+    for result in results:
+        print("%-50s %-10s %10.2f ms" % (result["name"], result["input"], result["wall_median_s"] * 1000))
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, "r") as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+        for regression in regressions:
+            print("REGRESSION %(name)s on %(input)s: %(baseline_s).4fs -> %(current_s).4fs" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import copy
+import xml.etree.ElementTree as ET
+
+NAMESPACE = "urn:hl7-org:v3"
+
+ET.register_namespace("", NAMESPACE)
+ET.register_namespace("xsi", "http://www.w3.org/2001/XMLSchema-instance")
+ET.register_namespace("sdtc", "urn:hl7-org:sdtc")
+
+
+def _tag(name):
+    return "{%s}%s" % (NAMESPACE, name)
+
+
+# Function to build a synthetic CCDA from a sample with every section repeated `sections`
+# times (copies get a " #n" title suffix) and every table body repeated `rows` times
+def scale_ccda(sample_path, sections=1, rows=1):
+    tree = ET.parse(sample_path)
+    root = tree.getroot()
+
+    if rows > 1:
+        for tbody in root.iter(_tag("tbody")):
+            original_rows = list(tbody)
+            for _ in range(rows - 1):
+                for row in original_rows:
+                    tbody.append(copy.deepcopy(row))
+
+    if sections > 1:
+        for body in root.iter(_tag("structuredBody")):
+            components = [component for component in body if component.tag == _tag("component")]
+            for copy_number in range(2, sections + 1):
+                for component in components:
+                    duplicate = copy.deepcopy(component)
+                    for section in duplicate.iter(_tag("section")):
+                        title = section.find(_tag("title"))
+                        if title is not None and title.text:
+                            title.text = "%s #%d" % (title.text, copy_number)
+                    body.append(duplicate)
+
+    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
@@ -0,0 +1,274 @@
+import numpy as np
+import pandas as pd
+
+# Longitudinal analytics over the Vitals, Past Encounters and Procedures tables. The
+# narrative rows are loaded into pandas frames with parsed dates and numeric values,
+# and the trends, deltas and out-of-range flags are computed per (patient, measure)
+# with grouped vectorized operations, so the same code serves one document or a whole
+# batch. facts() renders the results as short deterministic rows for the prompts.
+
+DATE_FORMAT = "%m/%d/%Y"
+READING_PATTERN = r"^\s*([-+]?(?:\d+(?:\.\d*)?|\.\d+))\s*(.*?)\s*$"
+
+# Units converted before comparing readings: unit -> (unit, factor)
+UNIT_CONVERSIONS = {
+    "g": ("kg", 0.001),
+    "lb": ("kg", 0.45359237),
+    "lbs": ("kg", 0.45359237),
+    "[lb_av]": ("kg", 0.45359237),
+    "in": ("cm", 2.54),
+    "[in_i]": ("cm", 2.54),
+    "m": ("cm", 100.0),
+}
+
+# Adult reference ranges by measure (lowercase header), in the converted units
+REFERENCE_RANGES = {
+    "body mass index (bmi)": (18.5, 24.9),
+    "bmi": (18.5, 24.9),
+    "bp systolic": (90, 120),
+    "systolic blood pressure": (90, 120),
+    "bp diastolic": (60, 80),
+    "diastolic blood pressure": (60, 80),
+    "heart rate": (60, 100),
+    "pulse": (60, 100),
+    "respiratory rate": (12, 20),
+    "oxygen saturation": (95, 100),
+    "o2 % bldc oximetry": (95, 100),
+    "body temperature": (36.1, 37.2),
+}
+
+VITALS_COLUMNS = ["patient", "date", "measure", "value", "unit"]
+ENCOUNTERS_COLUMNS = ["patient", "date", "diagnosis", "performer", "location"]
+PROCEDURES_COLUMNS = ["patient", "date", "name", "status"]
+
+
+# Function to load every table of the titled sections into one frame of strings, with
+# the first header containing "date" renamed to "date"
+def _section_frame(document, section_name):
+    frames = []
+    for section in document.find_sections(section_name):
+        for table in section.tables:
+            headers = table.headers
+            date_headers = [header for header in headers if header and "date" in header.lower()]
+            if not headers or not date_headers:
+                continue
+            rows = [row[:len(headers)] + [""] * (len(headers) - len(row)) for row in table.plain_rows]
+            frame = pd.DataFrame(rows, columns=range(len(headers)))
+            frame.columns = headers
+            frame = frame.loc[:, ~frame.columns.duplicated()].rename(columns={date_headers[0]: "date"})
+            frames.append(frame)
+    if not frames:
+        return None
+    frame = pd.concat(frames, ignore_index=True)
+    frame["date"] = pd.to_datetime(frame["date"].str.strip(), format=DATE_FORMAT, errors="coerce")
+    return frame
+
+
+# Function to make an empty frame with typed date and value columns, for documents
+# without the section
+def _empty_frame(columns):
+    frame = pd.DataFrame(columns=columns)
+    frame["date"] = pd.to_datetime(frame["date"])
+    if "value" in frame.columns:
+        frame["value"] = frame["value"].astype(float)
+    return frame
+
+
+# Function to key the rows of a document by patient (the patient id, or the document id)
+def _patient(document):
+    return document.patient_key or document.doc_id
+
+
+# Function to restrict a frame to a period (Timestamps or datetimes, None for open ends)
+def in_period(frame, since=None, until=None):
+    if since is not None:
+        frame = frame[frame["date"].isna() | (frame["date"] >= pd.Timestamp(since))]
+    if until is not None:
+        frame = frame[frame["date"].isna() | (frame["date"] <= pd.Timestamp(until))]
+    return frame
+
+
+# Function to load a document's vital sign readings: one row per (date, measure) with the
+# numeric value in a common unit
+def vitals_frame(document):
+    frame = _section_frame(document, "Vitals")
+    if frame is None:
+        return _empty_frame(VITALS_COLUMNS)
+
+    readings = frame.melt(id_vars=["date"], var_name="measure", value_name="reading")
+    parsed = readings["reading"].str.extract(READING_PATTERN)
+    value = pd.to_numeric(parsed[0], errors="coerce")
+    unit = parsed[1].fillna("")
+    conversions = unit.map(UNIT_CONVERSIONS)
+    converted = conversions.notna()
+    value[converted] = value[converted] * conversions[converted].map(lambda conversion: conversion[1])
+    unit[converted] = conversions[converted].map(lambda conversion: conversion[0])
+
+    vitals = pd.DataFrame({"patient": _patient(document), "date": readings["date"],
+                           "measure": readings["measure"], "value": value, "unit": unit})
+    return vitals[vitals["value"].notna() & vitals["date"].notna()].reset_index(drop=True)
+
+
+# Function to load a document's encounters (date, diagnosis, performer, location)
+def encounters_frame(document):
+    frame = _section_frame(document, "Past Encounters")
+    if frame is None:
+        return _empty_frame(ENCOUNTERS_COLUMNS)
+    frame = frame.rename(columns={"Diagnosis/Indication": "diagnosis", "Performer": "performer",
+                                  "Location": "location"})
+    frame["patient"] = _patient(document)
+    return frame.reindex(columns=ENCOUNTERS_COLUMNS).fillna({"diagnosis": "", "performer": "", "location": ""})
+
+
+# Function to load a document's procedures (date, name, status), from all procedure tables
+def procedures_frame(document):
+    frame = _section_frame(document, "Procedures")
+    if frame is None:
+        return _empty_frame(PROCEDURES_COLUMNS)
+    frame = frame.rename(columns={"Name": "name", "Status": "status"})
+    frame["patient"] = _patient(document)
+    return frame.reindex(columns=PROCEDURES_COLUMNS).fillna({"name": "", "status": ""})
+
+
+def vital_trends(vitals):
+    """
+    Trend of every (patient, measure, unit) in a vitals frame, for one document or a
+    batch: first and last reading, change between them, least-squares slope per year,
+    range, and out-of-range counts and flags against REFERENCE_RANGES.
+    """
+    if vitals.empty:
+        return pd.DataFrame(columns=["patient", "measure", "unit", "readings", "first_date", "last_date",
+                                     "first", "last", "change", "slope_per_year", "minimum", "maximum",
+                                     "low", "high", "out_of_range", "last_flag"])
+
+    vitals = vitals.sort_values(["patient", "measure", "unit", "date"], kind="mergesort")
+    keys = ["patient", "measure", "unit"]
+    groups = vitals.groupby(keys, sort=True)
+
+    trends = groups.agg(readings=("value", "size"), first_date=("date", "first"), last_date=("date", "last"),
+                        first=("value", "first"), last=("value", "last"),
+                        minimum=("value", "min"), maximum=("value", "max"))
+
+    # Least-squares slope of value over time, per group
+    group_keys = [vitals[key] for key in keys]
+    years = (vitals["date"] - pd.Timestamp("1970-01-01")).dt.days / 365.25
+    centered_years = years - years.groupby(group_keys).transform("mean")
+    centered_values = vitals["value"] - groups["value"].transform("mean")
+    covariance = (centered_years * centered_values).groupby(group_keys).sum()
+    variance = (centered_years * centered_years).groupby(group_keys).sum()
+    trends["slope_per_year"] = (covariance / variance.where(variance > 0)).values
+    trends["change"] = trends["last"] - trends["first"]
+
+    # Reference ranges and flags
+    measures = trends.index.get_level_values("measure").str.lower()
+    ranges = pd.Series(measures, index=trends.index).map(REFERENCE_RANGES)
+    trends["low"] = ranges.map(lambda bounds: bounds[0] if isinstance(bounds, tuple) else np.nan)
+    trends["high"] = ranges.map(lambda bounds: bounds[1] if isinstance(bounds, tuple) else np.nan)
+    bounds = trends[["low", "high"]].reindex(pd.MultiIndex.from_frame(vitals[keys])).to_numpy()
+    outside = (vitals["value"].to_numpy() < bounds[:, 0]) | (vitals["value"].to_numpy() > bounds[:, 1])
+    trends["out_of_range"] = pd.Series(outside, index=vitals.index).groupby(group_keys).sum().values
+    trends["last_flag"] = np.select([trends["last"] > trends["high"], trends["last"] < trends["low"]],
+                                    ["high", "low"], default="")
+    return trends.reset_index()
+
+
+# Function to compute the vital sign trends of a batch in one pass, from the vitals frames of
+# its documents: each patient gets one trend across all their documents, and a reading
+# repeated by several of them counts once
+def cohort_vital_trends(vitals_frames):
+    frames = [frame for frame in vitals_frames if not frame.empty]
+    if not frames:
+        return vital_trends(_empty_frame(VITALS_COLUMNS))
+    vitals = pd.concat(frames, ignore_index=True).drop_duplicates(["patient", "date", "measure", "unit", "value"])
+    return vital_trends(vitals.reset_index(drop=True))
+
+
+def encounter_stats(encounters):
+    """Per patient: number of encounters, first and last date, and median days between them."""
+    dated = encounters[encounters["date"].notna()].sort_values(["patient", "date"], kind="mergesort")
+    gaps = dated.groupby("patient")["date"].diff().dt.days
+    stats = dated.groupby("patient").agg(encounters=("date", "size"), first_date=("date", "min"),
+                                         last_date=("date", "max"))
+    stats["median_days_between"] = gaps.groupby(dated["patient"]).median()
+    return stats.reset_index()
+
+
+def diagnosis_counts(encounters):
+    """Per (patient, diagnosis): number of encounters and the last one, most frequent first."""
+    encounters = encounters[encounters["diagnosis"] != ""]
+    counts = encounters.groupby(["patient", "diagnosis"]).agg(encounters=("diagnosis", "size"),
+                                                              last_date=("date", "max")).reset_index()
+    return counts.sort_values(["patient", "encounters", "last_date", "diagnosis"],
+                              ascending=[True, False, False, True], kind="mergesort").reset_index(drop=True)
+
+
+def _date(value):
+    return value.date().isoformat() if not pd.isna(value) else None
+
+
+def _number(value):
+    return "%g" % round(float(value), 2)
+
+
+# Function to render the facts of one section as [label, text] rows for the prompts;
+# None for sections without analytics
+def facts(document, section_name, since=None, until=None):
+    if section_name == "Vitals":
+        rows = []
+        for trend in vital_trends(in_period(vitals_frame(document), since, until)).itertuples(index=False):
+            unit = (" " + trend.unit) if trend.unit else ""
+            text = "%s%s on %s" % (_number(trend.last), unit, _date(trend.last_date))
+            if trend.readings > 1:
+                text += ", %s%s on %s, change %+g%s over %d readings" % (
+                    _number(trend.first), unit, _date(trend.first_date), round(trend.change, 2), unit, trend.readings)
+                if not pd.isna(trend.slope_per_year):
+                    text += ", trend %+g%s/year" % (round(trend.slope_per_year, 2), unit)
+            if trend.last_flag:
+                text += ", last reading %s (reference %g-%g)" % (trend.last_flag, trend.low, trend.high)
+            if trend.out_of_range:
+                text += ", %d of %d readings out of range" % (trend.out_of_range, trend.readings)
+            rows.append([trend.measure, text])
+        return rows
+
+    if section_name == "Past Encounters":
+        encounters = in_period(encounters_frame(document), since, until)
+        rows = []
+        for stat in encounter_stats(encounters).itertuples(index=False):
+            text = "%d from %s to %s" % (stat.encounters, _date(stat.first_date), _date(stat.last_date))
+            if not pd.isna(stat.median_days_between):
+                text += ", median %d days apart" % stat.median_days_between
+            rows.append(["Encounters", text])
+        for count in diagnosis_counts(encounters).itertuples(index=False):
+            rows.append(["Diagnosis", "%s (%d encounter%s, last %s)" % (
+                count.diagnosis, count.encounters, "" if count.encounters == 1 else "s", _date(count.last_date))])
+        return rows
+
+    if section_name == "Procedures":
+        procedures = in_period(procedures_frame(document), since, until)
+        procedures = procedures.sort_values("date", ascending=False, kind="mergesort", na_position="last")
+        procedures = procedures.drop_duplicates(["date", "name"])
+        return [["Procedure", "%s%s%s" % (procedure.name, " on " + _date(procedure.date) if not pd.isna(procedure.date)
+                                          else "", " (%s)" % procedure.status if procedure.status else "")]
+                for procedure in procedures.itertuples(index=False) if procedure.name]
+
+    return None
+
+
+# Function to compute the analytics of one document as JSON-ready records
+def document_analytics(document, since=None, until=None):
+    encounters = in_period(encounters_frame(document), since, until)
+    return {
+        "vitals": records(vital_trends(in_period(vitals_frame(document), since, until))),
+        "encounters": records(encounter_stats(encounters)),
+        "diagnoses": records(diagnosis_counts(encounters)),
+        "procedures": records(in_period(procedures_frame(document), since, until))
+    }
+
+
+# Function to convert a frame to a list of dicts with ISO dates and None for missing values
+def records(frame):
+    frame = frame.copy()
+    for column in frame.columns:
+        if pd.api.types.is_datetime64_any_dtype(frame[column]):
+            frame[column] = frame[column].map(_date)
+    return frame.astype(object).where(frame.notna(), None).to_dict("records")
@@ -0,0 +1,372 @@
+import hashlib
+import io
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+from ccda_entries import section_entries
+from ccda_tables import read_table
+
+# Define namespaces for XML parsing
+namespaces = {
+    'default': 'urn:hl7-org:v3',
+    'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+    'sdtc': 'urn:hl7-org:sdtc'
+}
+
+
+SECTION_TAG = "{urn:hl7-org:v3}section"
+RECORD_TARGET_TAG = "{urn:hl7-org:v3}recordTarget"
+TABLE_TAG = "{urn:hl7-org:v3}table"
+
+
+# Function to compute the document id (content hash) of an uploaded CCDA
+def document_id_for(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Raised while streaming a document as soon as it has too many sections without data
+class TooManyEmptySections(ValueError):
+    def __init__(self, sections_without_data):
+        super().__init__("Document has %d sections without data" % len(sections_without_data))
+        self.sections_without_data = sections_without_data
+
+
+# File wrapper that hashes and counts the bytes read through it, so the document id
+# is known once the parser reaches the end of the stream. With tee, every chunk is
+# also written to it (e.g. the document store's pending file).
+class HashingReader:
+    def __init__(self, fileobj, tee=None):
+        self.fileobj = fileobj
+        self.tee = tee
+        self.size = 0
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self._hash.update(data)
+        self.size += len(data)
+        if self.tee is not None and data:
+            self.tee.write(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+# Function to check if a section has data (table, or a "None Recorded"/"None Reported" text)
+def section_has_data_one(section):
+    table_element = section.find(".//default:table", namespaces=namespaces)
+    text_elements = section.findall(".//default:text", namespaces=namespaces)
+
+    if table_element is not None:
+        return True
+
+    for text_element in text_elements:
+        if text_element is not None and text_element.text is not None:
+            text = text_element.text.strip()
+            if text == "None Recorded" or text == "None Reported":
+                return True
+
+    return False
+
+
+# Function to extract personal information from the parsed XML root
+def extract_personal_info(root):
+    personal_info = {}
+
+    # Extract patient's personal details
+    patient_element = root.find(".//default:patient", namespaces=namespaces)
+    if patient_element is not None:
+        personal_info["Name"] = patient_element.find(".//default:name/default:given",
+                                                     namespaces=namespaces).text + " " + patient_element.find(
+            ".//default:name/default:family", namespaces=namespaces).text
+        personal_info["Gender"] = patient_element.find(".//default:administrativeGenderCode",
+                                                       namespaces=namespaces).get("displayName")
+        personal_info["Birthdate"] = patient_element.find(".//default:birthTime", namespaces=namespaces).get("value")
+        personal_info["Marital Status"] = patient_element.find(".//default:maritalStatusCode",
+                                                               namespaces=namespaces).get("displayName")
+
+    # Extract patient's role and contact details
+    patient_role_element = root.find(".//default:patientRole", namespaces=namespaces)
+    if patient_role_element is not None:
+        id_element = patient_role_element.find(".//default:id", namespaces=namespaces)
+        if id_element is not None:
+            personal_info["Patient-ID"] = {
+                "extension": id_element.get("extension"),
+                "root": id_element.get("root")
+            }
+
+        hp_address = patient_role_element.find(".//default:addr[@use='HP']", namespaces=namespaces)
+        pst_address = patient_role_element.find(".//default:addr[@use='PST']", namespaces=namespaces)
+
+        if hp_address is not None:
+            personal_info["Contact Details"] = {
+                "HP": {
+                    "streetAddressLine": hp_address.find("default:streetAddressLine", namespaces=namespaces).text,
+                    "city": hp_address.find("default:city", namespaces=namespaces).text,
+                    "state": hp_address.find("default:state", namespaces=namespaces).text,
+                    "postalCode": hp_address.find("default:postalCode", namespaces=namespaces).text,
+                    "country": hp_address.find("default:country", namespaces=namespaces).text
+                }
+            }
+        if pst_address is not None:
+            personal_info["Contact Details"]["PST"] = {
+                "streetAddressLine": pst_address.find("default:streetAddressLine", namespaces=namespaces).text,
+                "city": pst_address.find("default:city", namespaces=namespaces).text,
+                "state": pst_address.find("default:state", namespaces=namespaces).text,
+                "postalCode": pst_address.find("default:postalCode", namespaces=namespaces).text,
+                "country": pst_address.find("default:country", namespaces=namespaces).text
+            }
+
+    return personal_info
+
+
+# A document section with its title, tables and data classification
+class CCDASection:
+    def __init__(self, title, tables, has_data_one, none_recorded, has_title=True, entries=None):
+        self.title = title
+        self.has_title = has_title
+        self.tables = tables
+        self.has_data_one = has_data_one
+        self.none_recorded = none_recorded
+        # Coded entries (ClinicalEntry) of a standard section, None for other sections
+        self.entries = entries
+
+    @property
+    def has_table(self):
+        return len(self.tables) > 0
+
+    @classmethod
+    def from_element(cls, section):
+        title_element = section.find("default:title", namespaces=namespaces)
+        tables = [read_table(table) for table in section.iter(TABLE_TAG)]
+        return cls(
+            title=title_element.text if title_element is not None else None,
+            tables=tables,
+            has_data_one=section_has_data_one(section),
+            # Only the first table is checked for 'None Recorded' data
+            none_recorded=tables[0].none_recorded if tables else False,
+            has_title=title_element is not None,
+            entries=section_entries(section)
+        )
+
+
+class CCDADocument:
+    """
+    A CCDA parsed once and kept in extracted form: sections in document order,
+    indexed by title, tables indexed by header, and the patient's personal details.
+
+    The indexes are built in one pass over the sections. Sections sharing a title,
+    and tables within them, are always returned in document order; a header that
+    occurs twice in one table resolves to its first column.
+    """
+
+    def __init__(self, doc_id, sections, personal_info, source_size=0, approx_size=None):
+        self.doc_id = doc_id
+        self.sections = sections
+        self.personal_info = personal_info
+        self.source_size = source_size
+
+        self.sections_by_title = {}
+        self.tables_by_header = {}
+        # (section title, header) -> [(table, column position)]
+        self.columns_by_section_header = {}
+        for section in sections:
+            if section.has_title:
+                self.sections_by_title.setdefault(section.title, []).append(section)
+            for table in section.tables:
+                for header, position in table.header_positions.items():
+                    self.tables_by_header.setdefault(header, []).append((section, table))
+                    if section.has_title:
+                        self.columns_by_section_header.setdefault(
+                            (section.title, header), []).append((table, position))
+
+        # Given when the sections are loaded from a snapshot, whose columns are only read on demand
+        self.approx_size = approx_size if approx_size is not None else self._estimate_size()
+
+    @classmethod
+    def from_root(cls, root, doc_id=None, source_size=0):
+        sections = [CCDASection.from_element(section)
+                    for section in root.findall(".//default:section", namespaces=namespaces)]
+        try:
+            personal_info = extract_personal_info(root)
+        except (AttributeError, KeyError, TypeError):
+            # Header elements are missing; the details route reports the error
+            personal_info = {}
+        return cls(doc_id, sections, personal_info, source_size)
+
+    @classmethod
+    def from_stream(cls, fileobj, doc_id=None, empty_section_threshold=None, tee=None):
+        """
+        Build a document from a binary file object with iterparse, one section at a
+        time. Each top-level section is extracted as soon as it ends and every other
+        element is dropped from the tree when it ends, so the tree never holds more
+        than the open elements and the section being read. Memory still grows with
+        the extracted sections (their tables and entries), not with the XML around
+        them. With empty_section_threshold, TooManyEmptySections is raised as soon as that
+        many titled sections without data have been seen. With tee, the bytes read
+        are written to it as well, so the upload is stored in the same pass.
+        """
+        reader = HashingReader(fileobj, tee)
+        sections = []
+        open_sections = []
+        open_elements = []
+        sections_without_data = []
+        personal_info = None
+        reading_patient = False
+
+        for event, element in ET.iterparse(reader, events=("start", "end")):
+            if event == "start":
+                open_elements.append(element)
+                if element.tag == SECTION_TAG:
+                    # Reserve the slot now so nested sections keep document order
+                    open_sections.append(len(sections))
+                    sections.append(None)
+                elif element.tag == RECORD_TARGET_TAG and personal_info is None:
+                    reading_patient = True
+                continue
+            open_elements.pop()
+
+            if element.tag == SECTION_TAG:
+                section = CCDASection.from_element(element)
+                sections[open_sections.pop()] = section
+
+                if not section.has_data_one and section.has_title:
+                    sections_without_data.append(section.title)
+                    if empty_section_threshold and len(sections_without_data) >= empty_section_threshold:
+                        raise TooManyEmptySections(sections_without_data)
+
+            elif element.tag == RECORD_TARGET_TAG and reading_patient:
+                reading_patient = False
+                try:
+                    personal_info = extract_personal_info(element)
+                except (AttributeError, KeyError, TypeError):
+                    personal_info = {}
+
+            # Sections and the patient are read from their whole subtree, so only elements
+            # outside them are dropped (nested sections wait for their parent section)
+            if not open_sections and not reading_patient and open_elements:
+                open_elements[-1].remove(element)
+
+        return cls(doc_id or reader.hexdigest(), sections, personal_info or {}, reader.size)
+
+    @classmethod
+    def from_bytes(cls, data, doc_id=None):
+        return cls.from_stream(io.BytesIO(data), doc_id=doc_id)
+
+    @classmethod
+    def from_path(cls, xml_path):
+        with open(xml_path, "rb") as xml_file:
+            return cls.from_stream(xml_file)
+
+    # Stable identifier of the patient (id root and extension), None if the document has no patient id
+    @property
+    def patient_key(self):
+        patient_id = self.personal_info.get("Patient-ID") or {}
+        if not patient_id.get("extension"):
+            return None
+        return "%s^%s" % (patient_id.get("root") or "", patient_id["extension"])
+
+    # Titles of all titled sections in document order
+    def section_names(self):
+        return [section.title for section in self.sections if section.has_title]
+
+    # All sections with the given title, in document order
+    def find_sections(self, title):
+        return self.sections_by_title.get(title, [])
+
+    # Coded entries of the sections with the given title, in document order; None if none
+    # of them is a standard section with coded entries (use the narrative tables instead)
+    def find_entries(self, title):
+        entries = None
+        for section in self.find_sections(title):
+            if section.entries:
+                entries = (entries or []) + section.entries
+        return entries
+
+    # All (section, table) pairs whose header row contains the given header
+    def find_tables(self, header):
+        return self.tables_by_header.get(header, [])
+
+    # All (table, column position) pairs for a header in the sections with the given title
+    def find_columns(self, title, header):
+        return self.columns_by_section_header.get((title, header), [])
+
+    # All (table, [column positions]) pairs for tables of the titled sections that have every header
+    def find_tables_with_headers(self, title, *headers):
+        matches = []
+        for table, position in self.find_columns(title, headers[0]):
+            positions = [position]
+            for header in headers[1:]:
+                other_position = table.header_positions.get(header)
+                if other_position is None:
+                    break
+                positions.append(other_position)
+            else:
+                matches.append((table, positions))
+        return matches
+
+    def _estimate_size(self):
+        # Rough in-memory footprint of the extracted text, used for the cache memory cap
+        size = 0
+        for section in self.sections:
+            size += 200 + len(section.title or "")
+            for table in section.tables:
+                size += sum(len(header or "") + 50 for header in table.headers)
+                for column in table.columns:
+                    # Column arrays plus the row lists materialized for the routes
+                    size += sum(len(cell) + 120 for cell in column if cell is not None)
+            size += 250 * len(section.entries or ())
+        return size
+
+
+class DocumentCache:
+    """
+    Thread-safe LRU cache of parsed documents keyed by document id, bounded by
+    both the number of documents and their approximate total size in bytes.
+    """
+
+    def __init__(self, max_documents=32, max_bytes=256 * 1024 * 1024):
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self._documents = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, doc_id):
+        with self._lock:
+            document = self._documents.get(doc_id)
+            if document is not None:
+                self._documents.move_to_end(doc_id)
+            return document
+
+    def put(self, document):
+        with self._lock:
+            previous = self._documents.pop(document.doc_id, None)
+            if previous is not None:
+                self._size -= previous.approx_size
+            self._documents[document.doc_id] = document
+            self._size += document.approx_size
+
+            # Evict least recently used documents, but always keep the newest one
+            while len(self._documents) > 1 and (
+                    len(self._documents) > self.max_documents or self._size > self.max_bytes):
+                _, evicted = self._documents.popitem(last=False)
+                self._size -= evicted.approx_size
+        return document
+
+    def pop(self, doc_id):
+        with self._lock:
+            document = self._documents.pop(doc_id, None)
+            if document is not None:
+                self._size -= document.approx_size
+            return document
+
+    def __contains__(self, doc_id):
+        with self._lock:
+            return doc_id in self._documents
+
+    def __len__(self):
+        with self._lock:
+            return len(self._documents)
@@ -0,0 +1,292 @@
+import datetime
+import re
+
+# Structured extraction from the coded entries of the standard C-CDA sections. The
+# narrative <text><table> of a section is written for people; its <entry> elements
+# carry the same facts as codes, typed values and timestamps. Sections are recognized
+# by their templateId; the others, and standard sections without usable entries,
+# are only available as narrative tables.
+
+HL7 = "{urn:hl7-org:v3}"
+XSI_TYPE = "{http://www.w3.org/2001/XMLSchema-instance}type"
+
+# Section templateId roots (with and without "entries required") -> section kind
+SECTION_TEMPLATES = {
+    "2.16.840.1.113883.10.20.22.2.1": "medications",
+    "2.16.840.1.113883.10.20.22.2.1.1": "medications",
+    "2.16.840.1.113883.10.20.22.2.2": "immunizations",
+    "2.16.840.1.113883.10.20.22.2.2.1": "immunizations",
+    "2.16.840.1.113883.10.20.22.2.3": "results",
+    "2.16.840.1.113883.10.20.22.2.3.1": "results",
+    "2.16.840.1.113883.10.20.22.2.4": "vitals",
+    "2.16.840.1.113883.10.20.22.2.4.1": "vitals",
+    "2.16.840.1.113883.10.20.22.2.5": "problems",
+    "2.16.840.1.113883.10.20.22.2.5.1": "problems",
+    "2.16.840.1.113883.10.20.22.2.6": "allergies",
+    "2.16.840.1.113883.10.20.22.2.6.1": "allergies",
+    "2.16.840.1.113883.10.20.22.2.7": "procedures",
+    "2.16.840.1.113883.10.20.22.2.7.1": "procedures",
+    "2.16.840.1.113883.10.20.22.2.10": "plan",
+    "2.16.840.1.113883.10.20.22.2.15": "family_history",
+    "2.16.840.1.113883.10.20.22.2.17": "social_history",
+    "2.16.840.1.113883.10.20.22.2.22": "encounters",
+    "2.16.840.1.113883.10.20.22.2.22.1": "encounters",
+    "2.16.840.1.113883.10.20.22.2.23": "medical_equipment",
+}
+
+# Clinical statements that can appear directly under <entry>
+STATEMENT_TAGS = frozenset(HL7 + tag for tag in (
+    "observation", "substanceAdministration", "encounter", "procedure", "act", "organizer", "supply"))
+
+TIME_PATTERN = re.compile(r"^(\d{4})(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\d{2})?")
+
+
+class ClinicalEntry:
+    """
+    One coded fact of a section: what it is (code and display name), its value
+    (a float for physical quantities, text for coded or string values) and when it
+    applies (start and end as datetimes, None when unknown).
+    """
+
+    __slots__ = ("kind", "statement", "code", "code_system", "display", "status",
+                 "start", "end", "value", "unit", "negated")
+
+    def __init__(self, kind, statement, code=None, code_system=None, display=None, status=None,
+                 start=None, end=None, value=None, unit=None, negated=False):
+        self.kind = kind
+        self.statement = statement
+        self.code = code
+        self.code_system = code_system
+        self.display = display
+        self.status = status
+        self.start = start
+        self.end = end
+        self.value = value
+        self.unit = unit
+        self.negated = negated
+
+    # Date used to order and filter entries: when the fact started, or else ended
+    @property
+    def date(self):
+        return self.start or self.end
+
+    def in_period(self, since=None, until=None):
+        date = self.date
+        if date is None:
+            # Undated facts are kept, a period cannot rule them out
+            return True
+        return (since is None or date >= since) and (until is None or date <= until)
+
+    def to_dict(self):
+        record = {slot: getattr(self, slot) for slot in self.__slots__}
+        for field in ("start", "end"):
+            if record[field] is not None:
+                record[field] = record[field].isoformat()
+        return record
+
+    # Compact row for prompts: name, value with unit, date; negated facts are marked
+    def to_row(self):
+        value = self.value
+        if isinstance(value, float):
+            value = "%g" % value
+        if value is not None and self.unit and self.unit != "1":
+            value = "%s %s" % (value, self.unit)
+        row = [("no " if self.negated else "") + (self.display or self.code or self.statement)]
+        if value is not None:
+            row.append(str(value))
+        if self.date is not None:
+            row.append(self.date.date().isoformat())
+        return row
+
+
+# Function to parse an HL7 timestamp (YYYYMMDD[HHMM[SS]][+-ZZZZ]) into a datetime in the
+# time it was written in; None for missing or unparsable values
+def parse_hl7_time(value):
+    if not value:
+        return None
+    match = TIME_PATTERN.match(value)
+    if match is None:
+        return None
+    parts = [int(part) if part else default for part, default in zip(match.groups(), (0, 1, 1, 0, 0, 0))]
+    try:
+        return datetime.datetime(*parts)
+    except ValueError:
+        return None
+
+
+# Function to parse an ISO date or datetime given by a client, for filtering entries. A date
+# alone as the end of a period covers that whole day.
+def parse_period_bound(value, end=False):
+    if value in (None, ""):
+        return None
+    try:
+        bound = datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid date: %r" % (value,))
+    if end and len(value) == 10:
+        bound += datetime.timedelta(days=1, microseconds=-1)
+    return bound
+
+
+# Function to get the section kind from the section's templateIds, None for other sections
+def section_kind(section_element):
+    for template in section_element.findall(HL7 + "templateId"):
+        kind = SECTION_TEMPLATES.get(template.get("root"))
+        if kind is not None:
+            return kind
+    return None
+
+
+# Function to extract the coded entries of a standard section; None for other sections
+def section_entries(section_element):
+    kind = section_kind(section_element)
+    if kind is None:
+        return None
+
+    # Narrative elements with an ID, for entries whose text points into the narrative
+    narrative = {}
+    text_element = section_element.find(HL7 + "text")
+    if text_element is not None:
+        for element in text_element.iter():
+            element_id = element.get("ID")
+            if element_id:
+                narrative[element_id] = " ".join("".join(element.itertext()).split())
+
+    entries = []
+    for entry in section_element.findall(HL7 + "entry"):
+        for statement in entry:
+            if statement.tag in STATEMENT_TAGS:
+                entries.extend(_statement_entries(kind, statement, narrative, None))
+    return entries
+
+
+def _statement_entries(kind, statement, narrative, default_time):
+    tag = statement.tag[len(HL7):]
+    start, end = _effective_time(statement)
+    if start is None and end is None:
+        start, end = default_time or (None, None)
+
+    if tag == "organizer":
+        # Vital signs and result panels: one entry per component, dated by the panel if undated
+        entries = []
+        for component in statement.findall(HL7 + "component"):
+            for child in component:
+                if child.tag in STATEMENT_TAGS:
+                    entries.extend(_statement_entries(kind, child, narrative, (start, end)))
+        return entries
+
+    if tag == "act":
+        # Concern acts (problems, allergies) wrap the observations that carry the facts
+        observations = [child for relationship in statement.findall(HL7 + "entryRelationship")
+                        for child in relationship if child.tag == HL7 + "observation"]
+        if observations:
+            entries = []
+            for observation in observations:
+                entries.extend(_statement_entries(kind, observation, narrative, (start, end)))
+            return entries
+
+    code_element = statement.find(HL7 + "code")
+    if tag in ("substanceAdministration", "supply"):
+        product = statement.find(".//%smanufacturedMaterial" % HL7)
+        if product is not None and product.find(HL7 + "code") is not None:
+            code_element = product.find(HL7 + "code")
+    code, code_system, display = _coded(code_element, narrative)
+    if display is None:
+        display = _reference_text(statement.find(HL7 + "text"), narrative)
+
+    value, unit = None, None
+    if tag == "observation":
+        value, unit = _value(statement.find(HL7 + "value"), narrative)
+        # Allergy observations: the substance is a participant, the value is the kind of reaction
+        substance = statement.find("%sparticipant/%sparticipantRole/%splayingEntity" % (HL7, HL7, HL7))
+        substance_name = _coded(substance.find(HL7 + "code"), narrative)[2] if substance is not None else None
+        if substance_name is not None:
+            display = substance_name
+        elif code == "ASSERTION" and isinstance(value, str):
+            display, value = value, None
+    elif tag == "encounter":
+        # Encounter diagnoses: observation values under the encounter's reason relationships
+        diagnoses = [_value(observation.find(HL7 + "value"), narrative)[0]
+                     for observation in statement.iterfind(
+                         "%sentryRelationship/%sact/%sentryRelationship/%sobservation" % (HL7, HL7, HL7, HL7))]
+        diagnoses = [diagnosis for diagnosis in diagnoses if diagnosis]
+        if diagnoses:
+            value = "; ".join(dict.fromkeys(diagnoses))
+    elif tag == "substanceAdministration":
+        dose = statement.find(HL7 + "doseQuantity")
+        if dose is not None and dose.get("value"):
+            value, unit = _number(dose.get("value")), dose.get("unit")
+
+    status_element = statement.find(HL7 + "statusCode")
+    return [ClinicalEntry(
+        kind, tag, code=code, code_system=code_system, display=display,
+        status=status_element.get("code") if status_element is not None else None,
+        start=start, end=end, value=value, unit=unit,
+        negated=statement.get("negationInd") == "true"
+    )]
+
+
+def _effective_time(statement):
+    time_element = statement.find(HL7 + "effectiveTime")
+    if time_element is None:
+        return None, None
+    if time_element.get("value"):
+        moment = parse_hl7_time(time_element.get("value"))
+        return moment, None
+    low = time_element.find(HL7 + "low")
+    high = time_element.find(HL7 + "high")
+    return (parse_hl7_time(low.get("value")) if low is not None else None,
+            parse_hl7_time(high.get("value")) if high is not None else None)
+
+
+def _coded(code_element, narrative):
+    # (code, code system, display name) of a coded element, using a translation or the
+    # original text when the code itself has no display name
+    if code_element is None:
+        return None, None, None
+    display = code_element.get("displayName")
+    if display is None:
+        for translation in code_element.findall(HL7 + "translation"):
+            if translation.get("displayName"):
+                display = translation.get("displayName")
+                break
+    if display is None:
+        display = _reference_text(code_element.find(HL7 + "originalText"), narrative)
+    return code_element.get("code"), code_element.get("codeSystemName") or code_element.get("codeSystem"), display
+
+
+def _reference_text(element, narrative):
+    # Text of an element, or of the narrative element its <reference> points to
+    if element is None:
+        return None
+    reference = element.find(HL7 + "reference")
+    if reference is not None and reference.get("value", "").startswith("#"):
+        text = narrative.get(reference.get("value")[1:])
+        if text:
+            return text
+    text = " ".join("".join(element.itertext()).split())
+    return text or None
+
+
+def _value(value_element, narrative):
+    # Typed observation value: (float, unit) for quantities, (text, None) otherwise
+    if value_element is None or value_element.get("nullFlavor"):
+        return None, None
+    value_type = value_element.get(XSI_TYPE, "")
+    if value_type in ("PQ", "INT", "REAL"):
+        return _number(value_element.get("value")), value_element.get("unit")
+    if value_type == "IVL_PQ":
+        low = value_element.find(HL7 + "low")
+        if low is not None:
+            return _number(low.get("value")), low.get("unit")
+        return None, None
+    if value_type in ("CD", "CE", "CO", "CV"):
+        return _coded(value_element, narrative)[2], None
+    return _reference_text(value_element, narrative), None
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return value
@@ -0,0 +1,107 @@
+# Extraction functions shared by the Flask routes and the batch runner. They all
+# read from a parsed CCDADocument (see ccda_document.py).
+
+
+# Function to extract the titles of all sections
+def extract_section_names(document):
+    return document.section_names()
+
+
+# Function to extract sections without data
+def extract_sections_without_data(document):
+    sections_without_data = []
+    for section in document.sections:
+        if not section.has_data_one and section.has_title:
+            sections_without_data.append(section.title)
+
+    return sections_without_data
+
+
+# Function to extract sections with data from the CCDA document
+def extract_sections_with_data(document):
+    sections_with_data = []
+    for section in document.sections:
+        # Check if the section has data (contains a table element)
+        if section.has_table and section.has_title:
+            # Check if the section does not have 'None Recorded' data
+            if not section.none_recorded:
+                sections_with_data.append(section.title)
+
+    return sections_with_data
+
+
+# Function to extract the rows of the first table of every section with the given title
+def extract_all_table_data(section_name, document):
+    section_data = []
+
+    for section in document.find_sections(section_name):
+        table_data = extract_table_data(section)
+        section_data.extend(table_data)
+
+    return section_data
+
+
+# Function to extract the rows of a section for a period (datetimes, None for open ends):
+# the coded entries dated in it when the section has them, otherwise every row of its
+# narrative table. Without a period the narrative rows are returned as they are.
+def extract_section_rows(section_name, document, since=None, until=None):
+    entries = document.find_entries(section_name)
+    if entries is None or (since is None and until is None):
+        return extract_all_table_data(section_name, document)
+    return [entry.to_row() for entry in entries if entry.in_period(since, until)]
+
+
+# Function to extract the typed records of a section: (records, source). Coded entries
+# when the section has them ("entries"), otherwise the narrative table rows keyed by
+# header ("narrative"), which cannot be filtered by date.
+def extract_section_records(section_name, document, since=None, until=None):
+    entries = document.find_entries(section_name)
+    if entries is not None:
+        return [entry.to_dict() for entry in entries if entry.in_period(since, until)], "entries"
+
+    records = []
+    for section in document.find_sections(section_name):
+        for table in section.tables[:1]:
+            for row in table.plain_rows:
+                records.append(dict(zip(table.headers, row)))
+    return records, "narrative"
+
+
+def extract_table_data(section):
+    if section.tables:
+        return section.tables[0].rows
+    return []
+
+
+# Function to extract key-value data from a table section in the XML
+def extract_data_from_table_section(section_name, key_header, value_header, document):
+    data = []
+
+    # Look up the tables of the titled sections that have both headers
+    for table, (key_index, value_index) in document.find_tables_with_headers(section_name, key_header, value_header):
+
+        # Iterate over each row in the table
+        for row_data in table.rows:
+
+            # Extract the key-value pair based on the header indexes; the value is a one-element
+            # list, the shape the clients already read
+            key_value = (row_data[key_index], [row_data[value_index]])
+            data.append(key_value)
+
+    return data
+
+
+# Function to extract data from a table section dynamically
+def extract_data_from_table_section_two(section_name, document):
+    data = []
+
+    # Find the sections by their title
+    for section in document.find_sections(section_name):
+        # Iterate over each table in the section (empty cells are "")
+        for table in section.tables:
+            data.append({
+                "headers": table.headers,
+                "table_data": table.plain_rows
+            })
+
+    return data
@@ -0,0 +1,198 @@
+import datetime
+import marshal
+import mmap
+import struct
+
+from ccda_document import CCDADocument, CCDASection
+from ccda_entries import ClinicalEntry
+from ccda_tables import ColumnarTable
+
+# Binary snapshots of extracted documents, so a worker that does not have a document
+# cached can load it without re-parsing the XML. A snapshot is a fixed header, the
+# document's structure (section index, table headers and row widths, coded entries,
+# personal details, the position and cell count of every column block) in marshal
+# format, then the cell text: one UTF-8 block per table column, with the cells of the
+# rows that have that column separated by NUL (which XML text cannot contain). The file
+# is memory-mapped and a column is only read and decoded when a route first needs it,
+# so workers share the unread pages through the OS page cache.
+#
+# Summary fingerprints are not stored: they hash the rows a route summarizes (table rows,
+# analytics facts, a period) together with the summarizer's model and prompts, so they
+# belong to the app's configuration, not to the extracted document. They are computed
+# from the snapshot's tables, which is all a route needs; the XML is never read.
+
+SNAPSHOT_MAGIC = b"CCDASNAP"
+
+# Bump whenever the extraction changes what a CCDADocument holds (ccda_tables,
+# ccda_entries, CCDASection, personal details): snapshots of another version are
+# ignored, and the document is parsed from its XML and snapshotted again
+SNAPSHOT_VERSION = 2
+
+# magic, snapshot version, marshal format version, length of the structure block
+HEADER = struct.Struct("<8sIIQ")
+
+TIME_SLOTS = ("start", "end")
+
+
+class SnapshotColumns:
+    """
+    The columns of one table in a mapped snapshot, read like ColumnarTable.columns
+    (a list of lists of cell text). Each column is decoded on first access; rows too
+    short to have the column get None, as when the table is read from XML.
+    """
+
+    __slots__ = ("_buffer", "_spans", "_widths", "_decoded")
+
+    def __init__(self, buffer, spans, widths):
+        self._buffer = buffer
+        self._spans = spans
+        self._widths = widths
+        self._decoded = [None] * len(spans)
+
+    def __len__(self):
+        return len(self._spans)
+
+    def __getitem__(self, index):
+        column = self._decoded[index]
+        if column is None:
+            start, length = self._spans[index]
+            values = _column_cells(self._buffer[start:start + length].decode("utf-8"), self._widths, index)
+            if values is None:
+                raise ValueError("Corrupt snapshot column %d" % index)
+            values = iter(values)
+            column = self._decoded[index] = [next(values) if width > index else None for width in self._widths]
+        return column
+
+    def __iter__(self):
+        for index in range(len(self._spans)):
+            yield self[index]
+
+
+# Function to split a column's block into the cells of the rows that have the column;
+# None if their number does not match the row widths
+def _column_cells(block, widths, index):
+    count = sum(1 for width in widths if width > index)
+    cells = block.split("\0") if count else []
+    if len(cells) != count or (not count and block):
+        return None
+    return cells
+
+
+# Function to serialize an extracted document to snapshot bytes
+def dump_snapshot(document):
+    blocks = []
+    offset = 0
+    sections = []
+    for section in document.sections:
+        tables = []
+        for table in section.tables:
+            spans = []
+            for index, column in enumerate(table.columns):
+                cells = [cell for cell, width in zip(column, table.widths) if width > index]
+                block = "\0".join(cells).encode("utf-8")
+                spans.append((offset, len(block), len(cells)))
+                blocks.append(block)
+                offset += len(block)
+            tables.append((table.headers, table.widths, sorted(table.fallback_cells), table.none_recorded,
+                           table.mode, spans))
+        entries = [_dump_entry(entry) for entry in section.entries] if section.entries is not None else None
+        sections.append((section.title, section.has_title, section.has_data_one, section.none_recorded,
+                         entries, tables))
+
+    structure = marshal.dumps({
+        "doc_id": document.doc_id,
+        "source_size": document.source_size,
+        "approx_size": document.approx_size,
+        "personal_info": document.personal_info,
+        "sections": sections,
+        "data_length": offset
+    })
+    return b"".join([HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, marshal.version, len(structure)), structure]
+                    + blocks)
+
+
+def load_snapshot(path, doc_id=None):
+    """
+    Load a document from a snapshot file, mapping it into memory. Returns None if the
+    file is missing, of another snapshot version, truncated, inconsistent, or (with
+    doc_id) of another document. Only the structure block is read here: the file must
+    have the recorded length, and every column block must lie inside it with a cell
+    count that matches the table's rows. The cells themselves are counted when the
+    column is first decoded (SnapshotColumns raises ValueError on a mismatch).
+    """
+    try:
+        with open(path, "rb") as snapshot_file:
+            buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # Missing, or empty (which cannot be mapped)
+        return None
+
+    try:
+        magic, version, marshal_version, structure_length = HEADER.unpack_from(buffer, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or marshal_version != marshal.version:
+            buffer.close()
+            return None
+        data_offset = HEADER.size + structure_length
+        structure = marshal.loads(buffer[HEADER.size:data_offset])
+    except (struct.error, EOFError, ValueError, TypeError):
+        buffer.close()
+        return None
+
+    try:
+        if doc_id is not None and structure["doc_id"] != doc_id:
+            buffer.close()
+            return None
+        if len(buffer) != data_offset + structure["data_length"]:
+            raise ValueError("Snapshot has %d bytes, expected %d" % (len(buffer),
+                                                                     data_offset + structure["data_length"]))
+        sections = _load_sections(buffer, data_offset, structure["sections"])
+        return CCDADocument(structure["doc_id"], sections, structure["personal_info"], structure["source_size"],
+                            approx_size=structure["approx_size"])
+    except (KeyError, TypeError, ValueError):
+        buffer.close()
+        return None
+
+
+def _load_sections(buffer, data_offset, structure):
+    sections = []
+    for title, has_title, has_data_one, none_recorded, entries, tables in structure:
+        section_tables = []
+        for headers, widths, fallback_cells, table_none_recorded, mode, spans in tables:
+            columns = SnapshotColumns(buffer, _check_spans(len(buffer), data_offset, spans, widths), widths)
+            section_tables.append(ColumnarTable(headers, columns, widths, fallback_cells, table_none_recorded, mode))
+        if entries is not None:
+            entries = [_load_entry(values) for values in entries]
+        sections.append(CCDASection(title, section_tables, has_data_one, none_recorded, has_title, entries))
+    return sections
+
+
+# Function to get the positions of a table's column blocks in the file from the structure
+# alone; raises ValueError if a block is outside the file or its recorded cell count is
+# not the number of rows that have the column
+def _check_spans(file_length, data_offset, spans, widths):
+    positions = []
+    for index, (start, length, cells) in enumerate(spans):
+        start += data_offset
+        if start < data_offset or length < 0 or start + length > file_length:
+            raise ValueError("Snapshot column %d is outside the file" % index)
+        if cells != sum(1 for width in widths if width > index) or (not cells and length):
+            raise ValueError("Snapshot column %d does not match its rows" % index)
+        positions.append((start, length))
+    return positions
+
+
+# Coded entries are stored as tuples of their slots, with the datetimes as ISO strings
+def _dump_entry(entry):
+    values = []
+    for slot in ClinicalEntry.__slots__:
+        value = getattr(entry, slot)
+        if slot in TIME_SLOTS and value is not None:
+            value = value.isoformat()
+        values.append(value)
+    return tuple(values)
+
+
+def _load_entry(values):
+    values = [datetime.datetime.fromisoformat(value) if slot in TIME_SLOTS and value is not None else value
+              for slot, value in zip(ClinicalEntry.__slots__, values)]
+    return ClinicalEntry(*values)
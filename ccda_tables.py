@@ -0,0 +1,117 @@
+NAMESPACE = "{urn:hl7-org:v3}"
+THEAD_TAG = NAMESPACE + "thead"
+TBODY_TAG = NAMESPACE + "tbody"
+TR_TAG = NAMESPACE + "tr"
+TH_TAG = NAMESPACE + "th"
+TD_TAG = NAMESPACE + "td"
+CONTENT_TAG = NAMESPACE + "content"
+
+# How a cell's text is read:
+#   "content"  - text of the first nested <content> (stripped), else the stripped cell text,
+#                else all of the cell's text joined with spaces
+#   "plain"    - like "content", but "" instead of the joined text for empty cells
+#   "readable" - the cell text as-is, else all of the cell's text joined with spaces
+CELL_MODES = ("content", "plain", "readable")
+
+
+class ColumnarTable:
+    """
+    A narrative table in columnar form: the header names once, one array of cell
+    text per column, and the width of every row (rows may be ragged, short rows
+    are padded with None). Cells that fell back to their joined text are recorded
+    so that both "content" and "plain" rows can be produced from one extraction.
+    """
+
+    def __init__(self, headers, columns, widths, fallback_cells=(), none_recorded=False, mode="content"):
+        self.headers = headers
+        # Header name -> position of its first column
+        self.header_positions = {}
+        for position, header in enumerate(headers):
+            self.header_positions.setdefault(header, position)
+        self.columns = columns
+        self.widths = widths
+        self.fallback_cells = frozenset(fallback_cells)
+        # True if a body cell's own text is exactly "None Recorded"
+        self.none_recorded = none_recorded
+        self.mode = mode
+        self._rows = {}
+
+    def __len__(self):
+        return len(self.widths)
+
+    # Rows in the mode the table was read in
+    @property
+    def rows(self):
+        return self.cell_rows(self.mode)
+
+    # Rows with "" for empty cells
+    @property
+    def plain_rows(self):
+        return self.cell_rows("plain")
+
+    def cell_rows(self, mode):
+        """Materialize the rows for a cell mode; the result is built once and reused."""
+        rows = self._rows.get(mode)
+        if rows is None:
+            if mode != self.mode and not (mode == "plain" and self.mode == "content"):
+                raise ValueError("Table read in %r mode cannot produce %r rows" % (self.mode, mode))
+            rows = [[self.columns[column][row] for column in range(width)]
+                    for row, width in enumerate(self.widths)]
+            if mode == "plain":
+                for row, column in self.fallback_cells:
+                    rows[row][column] = ""
+            self._rows[mode] = rows
+        return rows
+
+    def column(self, index, mode="content"):
+        """Cell text of one column, None for rows too short to have it."""
+        if mode == "plain" and self.fallback_cells:
+            return [None if value is None else ("" if (row, index) in self.fallback_cells else value)
+                    for row, value in enumerate(self.columns[index])]
+        return self.columns[index]
+
+
+# Function to read a <table> element into a ColumnarTable, walking each row once
+def read_table(table, mode="content"):
+    readable = mode == "readable"
+    headers = []
+    cells_by_row = []
+    fallback_cells = []
+    none_recorded = False
+
+    for element in table.iter():
+        tag = element.tag
+        if tag == THEAD_TAG:
+            for tr in element:
+                if tr.tag == TR_TAG:
+                    headers.extend(th.text for th in tr if th.tag == TH_TAG)
+        elif tag == TBODY_TAG:
+            for tr in element:
+                if tr.tag != TR_TAG:
+                    continue
+                row_index = len(cells_by_row)
+                cells = []
+                for td in tr.iter(TD_TAG):
+                    text = td.text
+                    if text == "None Recorded":
+                        none_recorded = True
+
+                    if readable:
+                        cells.append(text if text else ' '.join(td.itertext()))
+                        continue
+
+                    content = next(td.iter(CONTENT_TAG), None)
+                    if content is not None and content.text is not None:
+                        cells.append(content.text.strip())
+                    elif text:
+                        cells.append(text.strip())
+                    else:
+                        fallback_cells.append((row_index, len(cells)))
+                        cells.append(' '.join(td.itertext()))
+                cells_by_row.append(cells)
+
+    widths = [len(cells) for cells in cells_by_row]
+    column_count = max(widths) if widths else 0
+    columns = [[cells[column] if column < len(cells) else None for cells in cells_by_row]
+               for column in range(column_count)]
+    return ColumnarTable(headers, columns, widths, fallback_cells, none_recorded, mode)
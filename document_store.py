@@ -0,0 +1,340 @@
+import io
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Document ids are hex content hashes; anything else is rejected before touching the filesystem
+DOCUMENT_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class DocumentStore:
+    """
+    Storage for uploaded CCDA files, addressed by document id. Every document has
+    a lifetime (ttl seconds from its last upload); expired documents are treated
+    as missing and removed by purge_expired().
+    """
+
+    def save(self, doc_id, data, filename=None):
+        return self.save_file(doc_id, io.BytesIO(data), filename)
+
+    def save_file(self, doc_id, fileobj, filename=None):
+        raise NotImplementedError
+
+    def begin_save(self, filename=None):
+        """
+        Return a PendingDocument to write an upload into while it is being read; its
+        id (the content hash) is only known at the end, when it is committed.
+        """
+        raise NotImplementedError
+
+    def open(self, doc_id):
+        """Return a binary file object for the document, or None if it is missing or expired."""
+        raise NotImplementedError
+
+    def read(self, doc_id):
+        xml_file = self.open(doc_id)
+        if xml_file is None:
+            return None
+        with xml_file:
+            return xml_file.read()
+
+    def exists(self, doc_id):
+        raise NotImplementedError
+
+    def snapshot_path(self, doc_id):
+        """Local path of the document's extracted snapshot, or None if the store keeps no snapshots."""
+        return None
+
+    def save_snapshot(self, doc_id, data):
+        pass
+
+    def delete(self, doc_id):
+        raise NotImplementedError
+
+    def purge_expired(self):
+        raise NotImplementedError
+
+
+class LocalDocumentStore(DocumentStore):
+    """
+    Stores each document as <id>.xml with an <id>.json metadata sidecar in one
+    directory, and its extracted snapshot (see ccda_snapshot) as <id>.snap.
+    """
+
+    def __init__(self, directory, ttl=24 * 3600):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def xml_path(self, doc_id):
+        return os.path.join(self._document_directory(doc_id), doc_id + ".xml")
+
+    def metadata_path(self, doc_id):
+        return os.path.join(self._document_directory(doc_id), doc_id + ".json")
+
+    def snapshot_path(self, doc_id):
+        if not self._valid_id(doc_id):
+            return None
+        return os.path.join(self._document_directory(doc_id), doc_id + ".snap")
+
+    def save_file(self, doc_id, fileobj, filename=None):
+        self._check_id(doc_id)
+        os.makedirs(self._document_directory(doc_id), exist_ok=True)
+        size = self._write_atomic(self.xml_path(doc_id), fileobj)
+        return self._write_metadata(doc_id, filename, size)
+
+    def begin_save(self, filename=None):
+        return PendingDocument(self, filename)
+
+    def _write_metadata(self, doc_id, filename, size):
+        now = time.time()
+        metadata = {
+            "document_id": doc_id,
+            "filename": filename,
+            "size": size,
+            "uploaded_at": now,
+            "expires_at": now + self.ttl if self.ttl > 0 else None
+        }
+        self._write_atomic(self.metadata_path(doc_id), io.BytesIO(json.dumps(metadata).encode("utf-8")))
+        return metadata
+
+    def save_snapshot(self, doc_id, data):
+        self._check_id(doc_id)
+        os.makedirs(self._document_directory(doc_id), exist_ok=True)
+        self._write_atomic(self.snapshot_path(doc_id), io.BytesIO(data))
+
+    def open(self, doc_id):
+        if not self.exists(doc_id):
+            return None
+        try:
+            return open(self.xml_path(doc_id), "rb")
+        except FileNotFoundError:
+            return None
+
+    def metadata(self, doc_id):
+        if not self._valid_id(doc_id):
+            return None
+        try:
+            with open(self.metadata_path(doc_id), "r") as metadata_file:
+                return json.load(metadata_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def exists(self, doc_id):
+        metadata = self.metadata(doc_id)
+        return metadata is not None and not self._expired(metadata, time.time())
+
+    def delete(self, doc_id):
+        if not self._valid_id(doc_id):
+            return
+        for path in (self.metadata_path(doc_id), self.xml_path(doc_id), self.snapshot_path(doc_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def document_ids(self):
+        for _, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                doc_id, extension = os.path.splitext(filename)
+                if extension == ".json" and self._valid_id(doc_id):
+                    yield doc_id
+
+    def purge_expired(self):
+        """Delete expired documents and return their ids."""
+        now = time.time()
+        purged = []
+        for doc_id in list(self.document_ids()):
+            metadata = self.metadata(doc_id)
+            if metadata is not None and self._expired(metadata, now):
+                self.delete(doc_id)
+                purged.append(doc_id)
+        self._purge_abandoned(now)
+        return purged
+
+    def _purge_abandoned(self, now, max_age=3600):
+        # Temporary files left behind by uploads and writes that never completed (killed
+        # workers), in the store directory and in the shard directories of a shared store
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(".tmp"):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    if now - os.path.getmtime(path) > max_age:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _document_directory(self, doc_id):
+        return self.directory
+
+    def _write_atomic(self, path, fileobj):
+        # Write to a temporary file and rename it so readers never see a partial document
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                shutil.copyfileobj(fileobj, temp_file, 1024 * 1024)
+                size = temp_file.tell()
+                self._flush(temp_file)
+            os.replace(temp_path, path)
+            return size
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _flush(self, temp_file):
+        pass
+
+    def _expired(self, metadata, now):
+        expires_at = metadata.get("expires_at")
+        return expires_at is not None and now >= expires_at
+
+    def _valid_id(self, doc_id):
+        return isinstance(doc_id, str) and DOCUMENT_ID_PATTERN.match(doc_id) is not None
+
+    def _check_id(self, doc_id):
+        if not self._valid_id(doc_id):
+            raise ValueError("Invalid document id: %r" % (doc_id,))
+
+
+class PendingDocument:
+    """
+    An upload being written to a temporary file in a local store, typically fed by
+    the parser as it reads the request (see CCDADocument.from_stream's tee).
+    commit() moves it under its document id; leaving the with block without
+    committing removes the temporary file.
+    """
+
+    def __init__(self, store, filename=None):
+        self.store = store
+        self.filename = filename
+        self.size = 0
+        fd, self.temp_path = tempfile.mkstemp(dir=store.directory, suffix=".tmp")
+        self.file = os.fdopen(fd, "wb")
+        self.committed = False
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def commit(self, doc_id):
+        self.store._check_id(doc_id)
+        self.store._flush(self.file)
+        self.file.close()
+        os.makedirs(self.store._document_directory(doc_id), exist_ok=True)
+        os.replace(self.temp_path, self.store.xml_path(doc_id))
+        self.committed = True
+        return self.store._write_metadata(doc_id, self.filename, self.size)
+
+    def abort(self):
+        self.file.close()
+        if not self.committed and os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.abort()
+
+
+class SharedDocumentStore(LocalDocumentStore):
+    """
+    Variant for a directory on a shared filesystem (NFS, EFS) mounted by every worker
+    and host. Documents are sharded into subdirectories by id prefix, fsynced before
+    the rename, and only one process at a time purges expired documents.
+    """
+
+    def __init__(self, directory, ttl=24 * 3600, purge_lock_timeout=300):
+        super().__init__(directory, ttl)
+        self.purge_lock_timeout = purge_lock_timeout
+
+    def purge_expired(self):
+        lock_path = os.path.join(self.directory, ".purge.lock")
+
+        # Break a lock left behind by a process that died while purging
+        try:
+            if time.time() - os.path.getmtime(lock_path) > self.purge_lock_timeout:
+                os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another process is already purging
+            return []
+        try:
+            os.close(fd)
+            return super().purge_expired()
+        finally:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+
+    def _document_directory(self, doc_id):
+        return os.path.join(self.directory, doc_id[:2])
+
+    def _flush(self, temp_file):
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+
+
+# Function to create the configured document store
+def create_document_store(kind, directory, ttl):
+    if kind == "local":
+        return LocalDocumentStore(directory, ttl)
+    if kind == "shared":
+        return SharedDocumentStore(directory, ttl)
+    raise ValueError("Unknown document store: %r" % (kind,))
+
+
+class DocumentReaper:
+    """
+    Background thread that purges expired documents from the store every interval
+    seconds, keeping the cleanup off the request path. on_expired is called with
+    the ids of the documents removed on each pass.
+    """
+
+    def __init__(self, store, interval=300, on_expired=None):
+        self.store = store
+        self.interval = interval
+        self.on_expired = on_expired
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # Starting again is a no-op while the thread runs; in a process forked from one
+        # with a running reaper, the thread is gone and a new one is started
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="document-reaper", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join()
+
+    def reap(self):
+        expired_ids = self.store.purge_expired()
+        if expired_ids and self.on_expired is not None:
+            self.on_expired(expired_ids)
+        return expired_ids
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.reap()
+            except Exception:
+                logger.exception("Purging expired documents failed")
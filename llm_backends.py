@@ -0,0 +1,297 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+
+# httpx is imported by the first async backend request, so importing the app does not pay for it
+@functools.lru_cache(maxsize=None)
+def load_httpx():
+    try:
+        import httpx
+    except ImportError:  # Optional: without it the async methods run the sync client in a thread
+        return None
+    return httpx
+
+
+class BackendError(Exception):
+    pass
+
+
+class SummarizerBackend:
+    """
+    A text completion backend used by generate_summary. Implementations provide
+    complete(); stream() falls back to returning the whole completion at once.
+    The async variants used by the ASGI entry point default to running complete()
+    in a thread.
+    """
+
+    name = None
+    model = None
+
+    def complete(self, prompt, max_tokens, temperature):
+        raise NotImplementedError
+
+    def stream(self, prompt, max_tokens, temperature):
+        yield self.complete(prompt, max_tokens, temperature)
+
+    async def acomplete(self, prompt, max_tokens, temperature):
+        return await asyncio.to_thread(self.complete, prompt, max_tokens, temperature)
+
+    async def astream(self, prompt, max_tokens, temperature):
+        yield await self.acomplete(prompt, max_tokens, temperature)
+
+
+class OpenAIChatBackend(SummarizerBackend):
+    """
+    OpenAI chat completions over a pooled keep-alive HTTP session. Connection errors,
+    429s and 5xx responses are retried with exponential backoff and full jitter,
+    honouring Retry-After when the API sends it. The async methods use a pooled
+    httpx.AsyncClient per event loop, with up to async_pool_size requests in flight
+    and the same retries, so a request waiting on the API holds no thread.
+    """
+
+    name = "openai"
+
+    def __init__(self, api_key, model="gpt-3.5-turbo", base_url="https://api.openai.com/v1",
+                 timeout=60, max_retries=5, backoff_base=0.5, backoff_max=20, pool_size=32,
+                 async_pool_size=256):
+        self.model = model
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.embeddings_url = base_url.rstrip("/") + "/embeddings"
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.async_pool_size = async_pool_size
+        self._api_key = api_key
+        # httpx clients are bound to the event loop they were first used on
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+
+    def _http_session(self):
+        # Created on first use in each process, so workers forked after the app was
+        # imported never share the parent's pooled connections
+        if self._session_pid != os.getpid():
+            with self._session_lock:
+                if self._session_pid != os.getpid():
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    session.headers.update({
+                        "Authorization": "Bearer %s" % self._api_key,
+                        "Content-Type": "application/json"
+                    })
+                    self._session, self._session_pid = session, os.getpid()
+        return self._session
+
+    def complete(self, prompt, max_tokens, temperature):
+        response = self._post(self._payload(prompt, max_tokens, temperature))
+        with response:
+            body = response.json()
+        return body["choices"][0]["message"]["content"].strip()
+
+    def stream(self, prompt, max_tokens, temperature):
+        payload = self._payload(prompt, max_tokens, temperature)
+        payload["stream"] = True
+        response = self._post(payload, stream=True)
+        with response:
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                text = json.loads(data)["choices"][0]["delta"].get("content")
+                if text:
+                    yield text
+
+    async def acomplete(self, prompt, max_tokens, temperature):
+        if load_httpx() is None:
+            return await super().acomplete(prompt, max_tokens, temperature)
+
+        response = await self._apost(self._payload(prompt, max_tokens, temperature))
+        return response.json()["choices"][0]["message"]["content"].strip()
+
+    async def astream(self, prompt, max_tokens, temperature):
+        if load_httpx() is None:
+            yield await super().acomplete(prompt, max_tokens, temperature)
+            return
+
+        payload = self._payload(prompt, max_tokens, temperature)
+        payload["stream"] = True
+        response = await self._apost(payload, stream=True)
+        try:
+            async for line in response.aiter_lines():
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                text = json.loads(data)["choices"][0]["delta"].get("content")
+                if text:
+                    yield text
+        finally:
+            await response.aclose()
+
+    def embed(self, texts, model, dimensions=None):
+        payload = {"model": model, "input": texts}
+        if dimensions:
+            payload["dimensions"] = dimensions
+        response = self._post(payload, url=self.embeddings_url)
+        with response:
+            body = response.json()
+        return [item["embedding"] for item in sorted(body["data"], key=lambda item: item["index"])]
+
+    def _payload(self, prompt, max_tokens, temperature):
+        return {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": max_tokens,
+            "temperature": temperature
+        }
+
+    def _post(self, payload, stream=False, url=None):
+        import requests
+
+        session = self._http_session()
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = session.post(url or self.url, json=payload, timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                failure = "%s: %s" % (type(error).__name__, error)
+            else:
+                if response.status_code < 400:
+                    return response
+                failure = "HTTP %d: %s" % (response.status_code, response.text[:200])
+                retryable = response.status_code == 429 or response.status_code >= 500
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+                if not retryable:
+                    raise BackendError(failure)
+
+            time.sleep(self._retry_delay(attempt, failure, retry_after))
+
+    def _async_client(self):
+        httpx = load_httpx()
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.async_pool_size,
+                                    max_keepalive_connections=self.async_pool_size),
+                headers={"Authorization": "Bearer %s" % self._api_key, "Content-Type": "application/json"}
+            )
+        return client
+
+    async def _apost(self, payload, stream=False):
+        httpx = load_httpx()
+        client = self._async_client()
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            try:
+                response = await client.send(client.build_request("POST", self.url, json=payload), stream=stream)
+            except httpx.TransportError as error:
+                failure = "%s: %s" % (type(error).__name__, error)
+            else:
+                if response.status_code < 400:
+                    return response
+                await response.aread()
+                failure = "HTTP %d: %s" % (response.status_code, response.text[:200])
+                retryable = response.status_code == 429 or response.status_code >= 500
+                retry_after = response.headers.get("Retry-After")
+                await response.aclose()
+                if not retryable:
+                    raise BackendError(failure)
+
+            await asyncio.sleep(self._retry_delay(attempt, failure, retry_after))
+
+    # Function to compute the wait before retrying a failed request: exponential backoff with
+    # full jitter, at least Retry-After. Raises BackendError after the last attempt.
+    def _retry_delay(self, attempt, failure, retry_after=None):
+        if attempt == self.max_retries:
+            raise BackendError("Giving up after %d attempts: %s" % (attempt + 1, failure))
+
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            try:
+                delay = max(delay, float(retry_after))
+            except ValueError:
+                pass
+        logger.warning("OpenAI request failed (%s), retrying in %.2f seconds", failure, delay)
+        return delay
+
+
+class MockBackend(SummarizerBackend):
+    """
+    Offline, deterministic extractive backend for load tests and benchmarks. The
+    "summary" is the first words of the prompt's data lines, returned after a
+    configurable latency (plus optional random jitter) to imitate network time.
+    """
+
+    name = "mock"
+
+    def __init__(self, latency=0.0, jitter=0.0, model="mock-extractive"):
+        self.model = model
+        self.latency = latency
+        self.jitter = jitter
+
+    def complete(self, prompt, max_tokens, temperature):
+        self._wait()
+        return ' '.join(self._words(prompt, max_tokens))
+
+    def stream(self, prompt, max_tokens, temperature):
+        self._wait()
+        for index, word in enumerate(self._words(prompt, max_tokens)):
+            yield word if index == 0 else ' ' + word
+
+    async def acomplete(self, prompt, max_tokens, temperature):
+        await asyncio.sleep(self._delay())
+        return ' '.join(self._words(prompt, max_tokens))
+
+    async def astream(self, prompt, max_tokens, temperature):
+        await asyncio.sleep(self._delay())
+        for index, word in enumerate(self._words(prompt, max_tokens)):
+            yield word if index == 0 else ' ' + word
+
+    def _delay(self):
+        return self.latency + (random.uniform(0, self.jitter) if self.jitter else 0.0)
+
+    def _wait(self):
+        delay = self._delay()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _words(self, prompt, max_tokens):
+        # Keep the rendered table rows, or every non-instruction line if there are none
+        lines = [line for line in prompt.split('\n') if ' | ' in line]
+        if not lines:
+            lines = [line for line in prompt.split('\n') if line and not line.endswith(':')]
+        words = re.findall(r"\S+", ' '.join(lines))
+        return words[:max_tokens]
+
+
+# Function to create the configured summarizer backend
+def create_backend(name, model=None, api_key=None, **options):
+    if name == "openai":
+        return OpenAIChatBackend(api_key, model=model or "gpt-3.5-turbo", **options)
+    if name == "mock":
+        return MockBackend(model=model or "mock-extractive", **options)
+    raise ValueError("Unknown summarizer backend: %r" % (name,))
@@ -0,0 +1,202 @@
+import contextvars
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Request tracing and process metrics. Stages of the request path are timed with
+# span(); every span feeds the ccda_stage_seconds histogram and, while a request
+# trace is active, the request's Server-Timing header. Metrics are kept per process,
+# so with several gunicorn workers each worker reports its own.
+
+# Histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metrics:
+    """
+    Thread-safe counters and histograms, plus gauges read from callbacks when the
+    metrics are rendered in the Prometheus text exposition format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._kinds = {}
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_text):
+        self._kinds[name] = kind
+        self._help[name] = help_text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._kinds.setdefault(name, "counter")
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._kinds.setdefault(name, "histogram")
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts, then the sum and count of the observations
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def gauge(self, name, help_text, read_fn):
+        """Register a gauge; read_fn returns a list of (labels dict, value) when rendering."""
+        self.describe(name, "gauge", help_text)
+        self._gauges[name] = read_fn
+
+    def render(self):
+        samples = {}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples.setdefault(name, []).append("%s%s %s" % (name, _labels(labels), _number(value)))
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for index, bound in enumerate(self.buckets):
+                    lines.append("%s_bucket%s %d" % (name, _labels(labels + (("le", _number(bound)),)),
+                                                     histogram[index]))
+                lines.append("%s_bucket%s %d" % (name, _labels(labels + (("le", "+Inf"),)), histogram[-1]))
+                lines.append("%s_sum%s %s" % (name, _labels(labels), _number(histogram[-2])))
+                lines.append("%s_count%s %d" % (name, _labels(labels), histogram[-1]))
+        for name, read_fn in self._gauges.items():
+            samples[name] = ["%s%s %s" % (name, _labels(tuple(sorted(labels.items()))), _number(value))
+                             for labels, value in read_fn()]
+
+        output = []
+        for name in sorted(samples):
+            if name in self._help:
+                output.append("# HELP %s %s" % (name, self._help[name]))
+            output.append("# TYPE %s %s" % (name, self._kinds.get(name, "untyped")))
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                          .replace("\n", "\\n")) for key, value in labels)
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+# The process-wide registry
+metrics = Metrics()
+metrics.describe("ccda_stage_seconds", "histogram", "Time spent in each stage of the request path.")
+
+
+class Trace:
+    """The spans of one request, summed per stage for the Server-Timing header."""
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            total, count = self.stages.get(stage, (0.0, 0))
+            self.stages[stage] = (total + seconds, count + 1)
+
+    def server_timing(self):
+        with self._lock:
+            return ", ".join('%s;dur=%.2f;desc="%d"' % (stage, total * 1000, count)
+                             for stage, (total, count) in self.stages.items())
+
+
+_current_trace = contextvars.ContextVar("ccda_trace", default=None)
+
+
+# Function to start recording the spans of the current request; returns the trace and a reset token
+def start_trace():
+    trace = Trace()
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+
+# Time a stage of the request path
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe("ccda_stage_seconds", elapsed, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every interval seconds from a background thread
+    and counts the collapsed stacks ("outer;inner;leaf"), the input format of
+    flamegraph tools. The profiled thread itself runs unmodified.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.samples
+
+    def collapsed(self):
+        return "".join("%s %d\n" % (stack, count) for stack, count in self.samples.most_common())
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+
+# Function to wrap fn so that it records its spans in the current request's trace
+# when it runs on another thread (executor and pool workers)
+def with_trace(fn):
+    trace = _current_trace.get()
+    if trace is None:
+        return fn
+
+    def run(*args, **kwargs):
+        token = _current_trace.set(trace)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_trace.reset(token)
+    return run
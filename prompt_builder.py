@@ -0,0 +1,81 @@
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Words and punctuation, used to approximate tokens when tiktoken is unavailable
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+_encoding = None
+
+
+# Function to count the tokens of a text locally
+def count_tokens(text):
+    global _encoding
+
+    if tiktoken is not None and _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # The encoding could not be loaded (e.g. offline); fall back to the approximation
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(TOKEN_PATTERN.findall(text))
+
+
+# Function to render table rows compactly, one " | "-separated line per row
+def render_rows(rows, headers=None):
+    lines = []
+    if headers:
+        lines.append(' | '.join(header or '' for header in headers))
+    for row in rows:
+        if isinstance(row, (list, tuple)):
+            # Without headers empty cells carry no information, so they are dropped
+            cells = row if headers else [cell for cell in row if cell != '']
+            lines.append(' | '.join(str(cell) for cell in cells))
+        else:
+            lines.append(str(row))
+    return '\n'.join(lines)
+
+
+# Function to split rendered text into chunks of at most max_tokens, breaking between lines
+def chunk_text(text, max_tokens):
+    chunks = []
+    current = []
+    current_tokens = 0
+
+    for line in text.split('\n'):
+        line_tokens = count_tokens(line) + 1
+
+        # A single line over the budget is split on its own by characters
+        if line_tokens > max_tokens:
+            if current:
+                chunks.append('\n'.join(current))
+                current, current_tokens = [], 0
+            chunks.extend(_split_long_line(line, max_tokens))
+            continue
+
+        if current and current_tokens + line_tokens > max_tokens:
+            chunks.append('\n'.join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += line_tokens
+
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+
+def _split_long_line(line, max_tokens):
+    pieces = []
+    while line:
+        # Start from a conservative 3 characters per token and shrink until it fits
+        size = max(1, max_tokens * 3)
+        while size > 1 and count_tokens(line[:size]) > max_tokens:
+            size = size * 3 // 4
+        pieces.append(line[:size])
+        line = line[size:]
+    return pieces
@@ -0,0 +1,102 @@
+import gzip
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+from metrics import span
+
+try:
+    import orjson
+except ImportError:  # Optional: fall back to the standard library encoder
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # Optional: only gzip is offered
+    brotli = None
+
+# Content types worth compressing
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson", "text/plain", "text/html", "text/csv")
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Flask's JSON provider, timed as the "serialize" stage. With fast=True and orjson
+    installed, responses are encoded with orjson (keys still sorted, non-ASCII text
+    sent as UTF-8 instead of escaped); anything orjson cannot encode goes through
+    Flask's default conversion.
+    """
+
+    def __init__(self, app, fast=True):
+        super().__init__(app)
+        self.fast = fast and orjson is not None
+
+    def dumps(self, obj, **kwargs):
+        with span("serialize"):
+            try:
+                return super().dumps(obj, **kwargs)
+            except TypeError:
+                if not kwargs.get("sort_keys", self.sort_keys):
+                    raise
+                # Sorted keys cannot mix None (an empty header cell) with text
+                return super().dumps(string_keys(obj), **kwargs)
+
+    def response(self, *args, **kwargs):
+        if not self.fast or self._app.debug or self.compact is False:
+            return super().response(*args, **kwargs)
+
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(encode_json(obj, default=self.default), mimetype=self.mimetype)
+
+
+# Function to encode a JSON response body as bytes (compact, sorted keys, trailing newline),
+# with orjson when it is installed and fast is set. Keys that are not strings are written
+# as their JSON text (None as "null") by both encoders.
+def encode_json(obj, default=None, fast=True):
+    with span("serialize"):
+        if fast and orjson is not None:
+            return orjson.dumps(obj, default=default,
+                                option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        try:
+            text = json.dumps(obj, default=default, sort_keys=True, separators=(",", ":"))
+        except TypeError:
+            text = json.dumps(string_keys(obj), default=default, sort_keys=True, separators=(",", ":"))
+        return (text + "\n").encode("utf-8")
+
+
+# Function to copy nested dicts and lists with every non-string key replaced by its JSON
+# text, as json.dumps writes it when the keys are not sorted
+def string_keys(obj):
+    if isinstance(obj, dict):
+        return {key if isinstance(key, str) else json.dumps(key): string_keys(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [string_keys(value) for value in obj]
+    return obj
+
+
+# Function to compress a response body with the best encoding the client accepts (br, then gzip).
+# Streamed responses, small bodies and already encoded or non-text content are left as they are.
+def compress_response(response, accept_encodings, min_size=1024, level=6):
+    if response.direct_passthrough or response.is_streamed or "Content-Encoding" in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.status_code < 200 or response.status_code == 204:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    encoding = accept_encodings.best_match(offered)
+    if encoding is None:
+        return response
+
+    with span("compress"):
+        if encoding == "br":
+            compressed = brotli.compress(body, quality=min(level, 11))
+        else:
+            compressed = gzip.compress(body, compresslevel=min(level, 9))
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    return response
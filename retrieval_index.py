@@ -0,0 +1,409 @@
+import functools
+import logging
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+
+# Question words that carry no meaning for BM25 ranking
+STOP_WORDS = frozenset("a an and are at be did do does for from had has have he her his how in is it of on or "
+                       "she the their they this to was were what when where which who with".split())
+
+
+# numpy and faiss are imported when vectors are first needed, so the app can import this
+# module (BM25, row chunks) without paying for them when search is disabled
+@functools.lru_cache(maxsize=None)
+def load_faiss():
+    try:
+        import faiss
+    except ImportError:  # Optional: searched with numpy instead
+        return None
+    return faiss
+
+
+# Function to split the rows of every titled section into indexable chunks, one per row.
+# Rows are numbered like extract_all_table_data: first table of each section with the
+# title, in document order.
+def document_chunks(document):
+    chunks = []
+    for section_name in dict.fromkeys(document.section_names()):
+        row_number = 0
+        for section in document.find_sections(section_name):
+            if not section.tables:
+                continue
+            table = section.tables[0]
+            for row in table.rows:
+                cells = ["%s: %s" % (header, cell) if header else cell
+                         for header, cell in zip(table.headers, row) if cell]
+                if cells:
+                    chunks.append((section_name, row_number, "%s | %s" % (section_name, "; ".join(cells))))
+                row_number += 1
+    return chunks
+
+
+# Function to split text into lowercase word and number tokens
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25:
+    """Okapi BM25 ranking over a small fixed set of texts, such as the rows of one document."""
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_counts = [Counter(tokenize(text)) for text in texts]
+        self.lengths = [sum(counts.values()) for counts in self.term_counts]
+        self.average_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        document_frequency = Counter(term for counts in self.term_counts for term in counts)
+        total = len(texts)
+        self.idf = {term: math.log(1 + (total - frequency + 0.5) / (frequency + 0.5))
+                    for term, frequency in document_frequency.items()}
+
+    def rank(self, query, k=10):
+        """Return (score, position) of the k best matching texts, best first; texts sharing no term are left out."""
+        terms = [term for term in dict.fromkeys(tokenize(query)) if term in self.idf and term not in STOP_WORDS]
+        scores = []
+        for position, counts in enumerate(self.term_counts):
+            score = 0.0
+            length_norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / (self.average_length or 1))
+            for term in terms:
+                frequency = counts.get(term)
+                if frequency:
+                    score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + length_norm)
+            if score > 0:
+                scores.append((score, position))
+        scores.sort(key=lambda item: (-item[0], item[1]))
+        return scores[:k]
+
+
+class HashingEmbedder:
+    """
+    Offline embedder: words, word bigrams and character trigrams are hashed into a
+    fixed number of signed buckets with sublinear term frequency, and the vector is
+    L2-normalized, so that the inner product is the cosine similarity.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+
+    @property
+    def signature(self):
+        return "%s-%d" % (self.name, self.dim)
+
+    def embed(self, texts):
+        import numpy as np
+
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for index, text in enumerate(texts):
+            tokens = tokenize(text)
+            features = Counter(tokens)
+            features.update(" ".join(pair) for pair in zip(tokens, tokens[1:]))
+            trigrams = Counter("#" + token[position:position + 3]
+                               for token in tokens if len(token) > 3 for position in range(len(token) - 2))
+            for feature, count in features.items():
+                self._add(vectors[index], feature, 1.0 + math.log(count))
+            for feature, count in trigrams.items():
+                self._add(vectors[index], feature, 0.5 * (1.0 + math.log(count)))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def _add(self, vector, feature, weight):
+        # crc32 is stable across processes, unlike hash()
+        code = zlib.crc32(feature.encode("utf-8"))
+        vector[code % self.dim] += weight if code & 0x80000000 else -weight
+
+
+class OpenAIEmbedder:
+    """Embeddings from the OpenAI embeddings API, through the summarizer's OpenAI backend."""
+
+    name = "openai"
+
+    def __init__(self, backend, model="text-embedding-3-small", dim=512, batch_size=256):
+        self.backend = backend
+        self.model = model
+        self.dim = dim
+        self.batch_size = batch_size
+
+    @property
+    def signature(self):
+        return "%s-%s-%d" % (self.name, self.model, self.dim)
+
+    def embed(self, texts):
+        import numpy as np
+
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            vectors.extend(self.backend.embed(texts[start:start + self.batch_size], self.model, self.dim))
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dim)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+
+# Function to create the configured embedder
+def create_embedder(name, backend=None, **options):
+    if name == "hashing":
+        return HashingEmbedder(**options)
+    if name == "openai":
+        if backend is None or not hasattr(backend, "embed"):
+            raise ValueError("The openai embedder needs the openai summarizer backend")
+        return OpenAIEmbedder(backend, **options)
+    raise ValueError("Unknown embedder: %r" % (name,))
+
+
+class _NumpyVectors:
+    # Exact inner product search over a dense matrix, used when faiss is not installed
+
+    def __init__(self, dim):
+        import numpy as np
+
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+
+    @property
+    def ntotal(self):
+        return len(self.ids)
+
+    def add(self, ids, vectors):
+        import numpy as np
+
+        self.vectors = np.vstack([self.vectors, vectors])
+        self.ids = np.concatenate([self.ids, ids])
+
+    def remove(self, ids):
+        import numpy as np
+
+        keep = ~np.isin(self.ids, ids)
+        self.vectors = self.vectors[keep]
+        self.ids = self.ids[keep]
+
+    def search(self, query, k):
+        if not self.ntotal:
+            return []
+        import numpy as np
+
+        scores = self.vectors @ query
+        k = min(k, self.ntotal)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return list(zip(scores[top].tolist(), self.ids[top].tolist()))
+
+
+class _FaissVectors:
+    # Exact inner product search with faiss (IndexFlatIP behind an id map for deletes)
+
+    def __init__(self, dim):
+        faiss = load_faiss()
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal
+
+    def add(self, ids, vectors):
+        self.index.add_with_ids(vectors, ids)
+
+    def remove(self, ids):
+        import numpy as np
+
+        self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def search(self, query, k):
+        if not self.ntotal:
+            return []
+        scores, ids = self.index.search(query.reshape(1, -1), min(k, self.ntotal))
+        return [(score, chunk_id) for score, chunk_id in zip(scores[0].tolist(), ids[0].tolist()) if chunk_id >= 0]
+
+
+class RowIndex:
+    """
+    Cross-document search over the rows of extracted sections. Chunks (one per
+    table row) are stored with their document, patient and section in a SQLite
+    database shared by every worker on the host, together with their vectors; each
+    process searches an in-memory faiss index (numpy without faiss) that follows
+    the database, picking up documents added or deleted by other workers.
+    """
+
+    def __init__(self, path, embedder):
+        self.path = path
+        self.embedder = embedder
+
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self._vectors = None
+        self._max_id = 0
+        self._data_version = None
+
+    @property
+    def _connection(self):
+        # Opened on first use in each process (a SQLite connection must not cross a fork);
+        # the vectors are loaded by the first _sync after that
+        if self._db_pid != os.getpid():
+            with self._open_lock:
+                if self._db_pid != os.getpid():
+                    self._db = self._connect()
+                    self._db_pid = os.getpid()
+                    self._data_version = None
+                    self._check_embedder()
+        return self._db
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, doc_id TEXT NOT NULL, patient TEXT, patient_name TEXT, "
+            "section TEXT NOT NULL, row INTEGER NOT NULL, text TEXT NOT NULL, vector BLOB NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS chunks_doc_id ON chunks (doc_id)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, patient TEXT, indexed REAL NOT NULL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        connection.commit()
+        return connection
+
+    def add_document(self, document):
+        """Index the rows of a document, replacing any earlier version of it; returns the chunk count."""
+        chunks = document_chunks(document)
+        vectors = self.embedder.embed([text for _, _, text in chunks]) if chunks else None
+        patient = document.patient_key
+        patient_name = document.personal_info.get("Name")
+
+        with self._lock:
+            self._delete(document.doc_id)
+            self._connection.executemany(
+                "INSERT INTO chunks (doc_id, patient, patient_name, section, row, text, vector) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(document.doc_id, patient, patient_name, section_name, row_number, text, vector.tobytes())
+                 for (section_name, row_number, text), vector in zip(chunks, vectors if chunks else [])])
+            self._connection.execute("INSERT OR REPLACE INTO documents (doc_id, patient, indexed) VALUES (?, ?, ?)",
+                                     (document.doc_id, patient, time.time()))
+            self._connection.commit()
+            self._sync(force=True)
+        return len(chunks)
+
+    def delete_document(self, doc_id):
+        with self._lock:
+            deleted = self._delete(doc_id)
+            self._connection.commit()
+            self._sync(force=True)
+        return deleted
+
+    def __contains__(self, doc_id):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT 1 FROM documents WHERE doc_id = ?", (doc_id,)).fetchone() is not None
+
+    def search(self, query, k=10, section=None, patient=None, doc_id=None):
+        """Return the k rows most similar to the query, optionally restricted by section, patient or document."""
+        query_vector = self.embedder.embed([query])[0]
+        filtered = section is not None or patient is not None or doc_id is not None
+
+        with self._lock:
+            self._sync()
+            # Filters are applied to a larger candidate list
+            candidates = self._vectors.search(query_vector, max(k * 20, 200) if filtered else k)
+            if not candidates:
+                return []
+            rows = self._connection.execute(
+                "SELECT id, doc_id, patient, patient_name, section, row, text FROM chunks WHERE id IN (%s)"
+                % ",".join("?" * len(candidates)), [chunk_id for _, chunk_id in candidates]).fetchall()
+
+        chunks = {row[0]: row for row in rows}
+        results = []
+        for score, chunk_id in candidates:
+            chunk = chunks.get(chunk_id)
+            if chunk is None:
+                continue
+            _, chunk_doc_id, chunk_patient, patient_name, section_name, row_number, text = chunk
+            if ((section is not None and section_name != section) or (patient is not None and chunk_patient != patient)
+                    or (doc_id is not None and chunk_doc_id != doc_id)):
+                continue
+            results.append({"score": round(score, 4), "document_id": chunk_doc_id, "patient": chunk_patient,
+                            "patient_name": patient_name, "section": section_name, "row": row_number, "text": text})
+            if len(results) == k:
+                break
+        return results
+
+    def stats(self):
+        with self._lock:
+            documents, = self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()
+            chunks, = self._connection.execute("SELECT COUNT(*) FROM chunks").fetchone()
+        return {"documents": documents, "chunks": chunks, "embedder": self.embedder.signature,
+                "engine": "faiss" if load_faiss() is not None else "numpy"}
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM chunks")
+            self._connection.execute("DELETE FROM documents")
+            self._connection.commit()
+            self._sync(force=True)
+
+    def _delete(self, doc_id):
+        cursor = self._connection.execute("DELETE FROM chunks WHERE doc_id = ?", (doc_id,))
+        self._connection.execute("DELETE FROM documents WHERE doc_id = ?", (doc_id,))
+        return cursor.rowcount
+
+    def _sync(self, force=False):
+        # Bring the in-memory vectors up to date with the database: new chunks have
+        # higher ids, deleted ones are missing from the table. data_version only
+        # changes on commits from other connections, so our own writes force it.
+        import numpy as np
+
+        data_version, = self._connection.execute("PRAGMA data_version").fetchone()
+        if self._vectors is None:
+            self._vectors = (_FaissVectors(self.embedder.dim) if load_faiss() is not None
+                             else _NumpyVectors(self.embedder.dim))
+            self._max_id = 0
+        elif data_version == self._data_version and not force:
+            return
+
+        rows = self._connection.execute("SELECT id, vector FROM chunks WHERE id > ? ORDER BY id",
+                                        (self._max_id,)).fetchall()
+        if self._vectors.ntotal:
+            current_ids = np.fromiter((row[0] for row in self._connection.execute("SELECT id FROM chunks")),
+                                      dtype=np.int64)
+            loaded_ids = self._loaded_ids()
+            removed = np.setdiff1d(loaded_ids, current_ids)
+            if len(removed):
+                self._vectors.remove(removed)
+        if rows:
+            ids = np.asarray([row[0] for row in rows], dtype=np.int64)
+            vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+            self._vectors.add(ids, vectors)
+            self._max_id = int(ids[-1])
+        self._data_version = data_version
+
+    def _loaded_ids(self):
+        if isinstance(self._vectors, _NumpyVectors):
+            return self._vectors.ids
+        return load_faiss().vector_to_array(self._vectors.index.id_map)
+
+    def _check_embedder(self):
+        # Vectors from another embedder (or dimension) are recomputed from the stored text
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'embedder'").fetchone()
+        if row is not None and row[0] == self.embedder.signature:
+            return
+        chunks = self._connection.execute("SELECT id, text FROM chunks").fetchall()
+        if chunks:
+            logger.info("Re-embedding %d indexed rows with %s", len(chunks), self.embedder.signature)
+            vectors = self.embedder.embed([text for _, text in chunks])
+            self._connection.executemany("UPDATE chunks SET vector = ? WHERE id = ?",
+                                         [(vector.tobytes(), chunk_id) for (chunk_id, _), vector in zip(chunks, vectors)])
+        self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('embedder', ?)",
+                                 (self.embedder.signature,))
+        self._connection.commit()
@@ -0,0 +1,596 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from metrics import with_trace
+
+try:
+    import fcntl
+except ImportError:  # Windows: the budget is only shared between threads of one process
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_FAILED_MESSAGE = "Summary could not be generated for this section."
+SUMMARY_TIMEOUT_MESSAGE = "Summary timed out for this section."
+
+
+class RateLimiter:
+    """
+    Requests-per-minute / tokens-per-minute token bucket. The bucket state lives in
+    a small file guarded by an exclusive lock, so every gunicorn worker on the host
+    draws from the same budget. A limit of 0 disables that budget.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, state_path=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.state_path = state_path or os.path.join(tempfile.gettempdir(), "ccda_openai_budget.json")
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.requests_per_minute > 0 or self.tokens_per_minute > 0
+
+    def acquire(self, tokens=1):
+        """Block until one request and the given number of tokens fit in the budget."""
+        if not self.enabled:
+            return
+
+        # A single request larger than the whole per-minute budget would never fit
+        if self.tokens_per_minute > 0:
+            tokens = min(tokens, self.tokens_per_minute)
+
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(min(wait, 1.0))
+
+    async def acquire_async(self, tokens=1):
+        """acquire() for coroutines: waits with asyncio.sleep instead of blocking a thread."""
+        if not self.enabled:
+            return
+
+        if self.tokens_per_minute > 0:
+            tokens = min(tokens, self.tokens_per_minute)
+
+        while True:
+            # The state file lock can be held by another worker, so it is taken off the event loop
+            wait = await asyncio.to_thread(self._try_acquire, tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(min(wait, 1.0))
+
+    def _try_acquire(self, tokens):
+        with self._lock, open(self.state_path, "a+") as state_file:
+            if fcntl is not None:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                try:
+                    state = json.loads(state_file.read() or "{}")
+                except ValueError:
+                    state = {}
+
+                now = time.time()
+                elapsed = max(0.0, now - state.get("updated", now))
+                request_budget = min(self.requests_per_minute,
+                                     state.get("requests", self.requests_per_minute)
+                                     + elapsed * self.requests_per_minute / 60.0)
+                token_budget = min(self.tokens_per_minute,
+                                   state.get("tokens", self.tokens_per_minute)
+                                   + elapsed * self.tokens_per_minute / 60.0)
+
+                wait = 0.0
+                if self.requests_per_minute > 0 and request_budget < 1:
+                    wait = max(wait, (1 - request_budget) * 60.0 / self.requests_per_minute)
+                if self.tokens_per_minute > 0 and token_budget < tokens:
+                    wait = max(wait, (tokens - token_budget) * 60.0 / self.tokens_per_minute)
+
+                if wait <= 0:
+                    request_budget -= 1
+                    token_budget -= tokens
+
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps({"requests": request_budget, "tokens": token_budget, "updated": now}))
+                return wait
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(state_file, fcntl.LOCK_UN)
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls that are in flight at the same time: the first caller
+    for a key runs the function, and every caller that arrives before it finishes
+    waits for and shares its result (or its exception). Threads and coroutines of
+    one process share the same calls.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn):
+        """Call fn() unless an identical call is in flight; returns (result, shared)."""
+        future, leader = self._join(key)
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as error:
+            self._finish(key, future, error=error)
+            raise
+        self._finish(key, future, result)
+        return result, False
+
+    async def do_async(self, key, fn):
+        """do() for coroutines: fn() returns a coroutine, and followers wait without blocking the loop."""
+        future, leader = self._join(key)
+        if leader:
+            # The call runs as its own task, so cancelling the leader does not cancel it for the followers
+            task = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda task: self._finish_task(key, future, task))
+        return await asyncio.shield(asyncio.wrap_future(future)), not leader
+
+    def _finish_task(self, key, future, task):
+        if task.cancelled():
+            self._finish(key, future, error=asyncio.CancelledError())
+        elif task.exception() is not None:
+            self._finish(key, future, error=task.exception())
+        else:
+            self._finish(key, future, task.result())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._calls)
+
+
+class AdmissionRejected(Exception):
+    """A request turned away by admission control; retry_after is a hint in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__("Request rejected (%s), retry after %d seconds" % (reason, retry_after))
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    __slots__ = ("client", "granted", "notify", "queued_at")
+
+    def __init__(self, client, notify):
+        self.client = client
+        self.granted = False
+        self.notify = notify
+        self.queued_at = time.monotonic()
+
+
+class AdmissionQueue:
+    """
+    Admission control for requests that call the summarizer: at most max_active run
+    at once and up to max_queued wait for a slot (max_queued_per_client from any one
+    client). Anything beyond that, or a request that waited max_wait seconds, is
+    rejected at once with AdmissionRejected and a Retry-After estimate from the
+    recent service time. Waiting requests are admitted round-robin across clients,
+    so one client sending many requests cannot starve the others. max_active=0
+    admits everything. Limits are per process.
+    """
+
+    def __init__(self, max_active=16, max_queued=64, max_queued_per_client=8, max_wait=30):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_queued_per_client = max_queued_per_client
+        self.max_wait = max_wait
+        self.active = 0
+        self.queued = 0
+        # Waiting tickets by client, in round-robin order
+        self._waiting = OrderedDict()
+        # Moving average of how long an admitted request holds its slot
+        self._service_time = 1.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_active > 0
+
+    def retry_after(self):
+        """Seconds until the current queue is likely to have drained, at least 1."""
+        with self._lock:
+            return self._retry_after()
+
+    def _retry_after(self):
+        return max(1, int(self._service_time * (self.queued + 1) / max(self.max_active, 1) + 0.999))
+
+    def _enqueue(self, client, notify):
+        # Returns None when admitted right away, else the ticket to wait on
+        with self._lock:
+            if self.active < self.max_active and not self.queued:
+                self.active += 1
+                return None
+            if self.queued >= self.max_queued:
+                raise AdmissionRejected("queue_full", self._retry_after())
+            tickets = self._waiting.get(client)
+            if tickets is not None and len(tickets) >= self.max_queued_per_client:
+                raise AdmissionRejected("client_queue_full", self._retry_after())
+            ticket = _Ticket(client, notify)
+            self._waiting.setdefault(client, deque()).append(ticket)
+            self.queued += 1
+            return ticket
+
+    def _abandon(self, ticket):
+        # Called when a waiter gives up; False if it was admitted in the meantime
+        with self._lock:
+            if ticket.granted:
+                return False
+            tickets = self._waiting[ticket.client]
+            tickets.remove(ticket)
+            if not tickets:
+                del self._waiting[ticket.client]
+            self.queued -= 1
+            return True
+
+    def release(self, held):
+        """Free a slot held for the given number of seconds and admit the next waiting client."""
+        with self._lock:
+            self._service_time = 0.9 * self._service_time + 0.1 * held
+            self.active -= 1
+            while self._waiting and self.active < self.max_active:
+                client, tickets = next(iter(self._waiting.items()))
+                ticket = tickets.popleft()
+                if tickets:
+                    self._waiting.move_to_end(client)
+                else:
+                    del self._waiting[client]
+                self.queued -= 1
+                self.active += 1
+                ticket.granted = True
+                ticket.notify()
+
+    def acquire(self, client):
+        """Wait for a slot; returns the seconds spent queued or raises AdmissionRejected."""
+        if not self.enabled:
+            return 0.0
+        granted = threading.Event()
+        ticket = self._enqueue(client, granted.set)
+        if ticket is None:
+            return 0.0
+        if not granted.wait(self.max_wait) and self._abandon(ticket):
+            raise AdmissionRejected("timeout", self.retry_after())
+        return time.monotonic() - ticket.queued_at
+
+    async def acquire_async(self, client):
+        """acquire() for coroutines: waits on the event loop instead of blocking a thread."""
+        if not self.enabled:
+            return 0.0
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        ticket = self._enqueue(client, notify)
+        if ticket is None:
+            return 0.0
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), self.max_wait)
+        except asyncio.TimeoutError:
+            if self._abandon(ticket):
+                raise AdmissionRejected("timeout", self.retry_after())
+        except asyncio.CancelledError:
+            # The client went away: give up the place in the queue, or the slot if it was granted
+            if not self._abandon(ticket):
+                self.release(time.monotonic() - ticket.queued_at)
+            raise
+        return time.monotonic() - ticket.queued_at
+
+    def stats(self):
+        with self._lock:
+            return {"active": self.active, "queued": self.queued, "clients_waiting": len(self._waiting),
+                    "max_active": self.max_active, "max_queued": self.max_queued,
+                    "service_seconds": round(self._service_time, 3)}
+
+
+class SummaryExecutor:
+    """
+    Bounded thread pool that summarizes several sections at once. Results come back
+    in request order; a section that fails or times out gets a placeholder message
+    instead of failing the whole request. The async variants run coroutine functions
+    as tasks on the event loop instead, with the same results, deadline and request
+    accounting, so an ASGI request holds no pool thread while it waits on the backend.
+    """
+
+    def __init__(self, max_workers=8, timeout=60):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summary")
+        # Number of requests currently summarizing, so background work can yield to them
+        self._active = 0
+        self._idle = threading.Condition()
+
+    @contextmanager
+    def _request(self):
+        with self._idle:
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._idle:
+                self._active -= 1
+                if self._active == 0:
+                    self._idle.notify_all()
+
+    def wait_idle(self, timeout=None):
+        """Wait until no request is summarizing; returns False if the timeout passed first."""
+        with self._idle:
+            return self._idle.wait_for(lambda: self._active == 0, timeout)
+
+    def summarize(self, summarize_fn, items):
+        with self._request():
+            futures = self._submit(summarize_fn, items)
+
+            # One deadline for the whole request, not one timeout per section in turn
+            done, _ = wait(futures, timeout=self.timeout)
+            return self._results(futures, done)
+
+    async def summarize_async(self, summarize_fn, items):
+        """summarize() for a coroutine function: every section is a task on the running event loop."""
+        with self._request():
+            tasks = [asyncio.ensure_future(summarize_fn(item)) for item in items]
+            try:
+                done = set()
+                if tasks:
+                    done, _ = await asyncio.wait(tasks, timeout=self.timeout)
+                return self._results(tasks, done)
+            finally:
+                # Cancelled (the client went away): stop the sections still running
+                for task in tasks:
+                    task.cancel()
+
+    def _submit(self, summarize_fn, items):
+        summarize_fn = with_trace(summarize_fn)
+        return [self._pool.submit(summarize_fn, item) for item in items]
+
+    def _results(self, futures, done):
+        results = []
+        for future in futures:
+            if future not in done:
+                future.cancel()
+                logger.warning("Section summary timed out after %s seconds", self.timeout)
+                results.append(SUMMARY_TIMEOUT_MESSAGE)
+                continue
+            try:
+                results.append(future.result())
+            except Exception:
+                logger.exception("Section summary failed")
+                results.append(SUMMARY_FAILED_MESSAGE)
+        return results
+
+    def stream(self, summarize_fn, items, tokens=False):
+        """
+        Summarize the items concurrently and yield events as they happen:
+        ("summary", index, summary) when a section finishes, and with tokens=True
+        also ("token", index, text) for every piece of text the model produces.
+        summarize_fn is called as summarize_fn(item, on_token) when tokens is set.
+        If no event arrives for timeout seconds, the unfinished sections time out.
+        """
+        with self._request():
+            events = queue.Queue()
+            futures = self._submit_stream(summarize_fn, items, tokens, events.put)
+            finished = set()
+            try:
+                while len(finished) < len(futures):
+                    try:
+                        event = events.get(timeout=self.timeout)
+                    except queue.Empty:
+                        yield from self._timed_out(futures, finished)
+                        return
+                    event = self._stream_event(event, finished)
+                    if event is not None:
+                        yield event
+            finally:
+                # Closed early (the client went away): drop the sections not started yet
+                for future in futures:
+                    future.cancel()
+
+    async def stream_async(self, summarize_fn, items, tokens=False):
+        """stream() for a coroutine function: every section is a task on the running event loop."""
+        with self._request():
+            loop = asyncio.get_running_loop()
+            events = asyncio.Queue()
+
+            def put(event):
+                loop.call_soon_threadsafe(events.put_nowait, event)
+
+            def run(index, item):
+                if tokens:
+                    return summarize_fn(item, lambda text: put(("token", index, text)))
+                return summarize_fn(item)
+
+            futures = []
+            for index, item in enumerate(items):
+                task = asyncio.ensure_future(run(index, item))
+                task.add_done_callback(lambda task, index=index: put(("done", index, task)))
+                futures.append(task)
+            finished = set()
+            try:
+                while len(finished) < len(futures):
+                    try:
+                        event = await asyncio.wait_for(events.get(), self.timeout)
+                    except asyncio.TimeoutError:
+                        for event in self._timed_out(futures, finished):
+                            yield event
+                        return
+                    event = self._stream_event(event, finished)
+                    if event is not None:
+                        yield event
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def _submit_stream(self, summarize_fn, items, tokens, put):
+        # put receives ("token", index, text) events and ("done", index, future) when a section ends
+        def run(index, item):
+            if tokens:
+                return summarize_fn(item, lambda text: put(("token", index, text)))
+            return summarize_fn(item)
+
+        run = with_trace(run)
+        futures = []
+        for index, item in enumerate(items):
+            future = self._pool.submit(run, index, item)
+            future.add_done_callback(lambda future, index=index: put(("done", index, future)))
+            futures.append(future)
+        return futures
+
+    def _stream_event(self, event, finished):
+        # The event to yield for a queued event, None for tokens of finished sections
+        kind, index, payload = event
+        if kind == "token":
+            return event if index not in finished else None
+
+        finished.add(index)
+        try:
+            return "summary", index, payload.result()
+        except Exception:
+            logger.exception("Section summary failed")
+            return "summary", index, SUMMARY_FAILED_MESSAGE
+
+    def _timed_out(self, futures, finished):
+        logger.warning("Section summaries timed out after %s seconds", self.timeout)
+        for index, future in enumerate(futures):
+            if index not in finished:
+                future.cancel()
+                yield "summary", index, SUMMARY_TIMEOUT_MESSAGE
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Prefetcher:
+    """
+    Background summaries of freshly uploaded documents, so that the follow-up
+    requests find them in the summary cache. Prefetch runs on its own small pool
+    and only starts a section while no interactive request is summarizing. Each
+    document gets a token budget (the estimated prompt tokens of the sections it
+    summarizes); sections that would exceed it are skipped. Status is kept in the
+    process that accepted the upload.
+    """
+
+    def __init__(self, summarize_fn, cost_fn, summary_executor, max_workers=1, token_budget=20000,
+                 max_documents=256):
+        self.summarize_fn = summarize_fn
+        self.cost_fn = cost_fn
+        self.summary_executor = summary_executor
+        self.token_budget = token_budget
+        self.max_documents = max_documents
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, doc_id, load_items):
+        """
+        Queue a document for prefetching. load_items is called on the prefetch pool
+        and returns the (section name, section data) pairs to summarize; cost_fn and
+        summarize_fn are called with (doc_id, section name, section data).
+        """
+        with self._lock:
+            job = self._jobs.get(doc_id)
+            if job is not None and job["state"] in ("queued", "running"):
+                return job
+            job = {"state": "queued", "sections": {}, "tokens_used": 0, "token_budget": self.token_budget,
+                   "cancelled": threading.Event()}
+            self._jobs[doc_id] = job
+            # Forget the oldest finished jobs
+            for old_id in list(self._jobs):
+                if len(self._jobs) <= self.max_documents:
+                    break
+                if self._jobs[old_id]["state"] not in ("queued", "running"):
+                    del self._jobs[old_id]
+
+        self._pool.submit(self._run, doc_id, job, load_items)
+        return job
+
+    def cancel(self, doc_id):
+        with self._lock:
+            job = self._jobs.get(doc_id)
+        if job is None:
+            return False
+        job["cancelled"].set()
+        return job["state"] in ("queued", "running")
+
+    def status(self, doc_id):
+        with self._lock:
+            job = self._jobs.get(doc_id)
+            if job is None:
+                return None
+            return {key: value for key, value in job.items() if key != "cancelled"}
+
+    def _run(self, doc_id, job, load_items):
+        cancelled = job["cancelled"]
+        if cancelled.is_set():
+            job["state"] = "cancelled"
+            return
+
+        job["state"] = "running"
+        try:
+            items = load_items()
+            for name, _ in items:
+                job["sections"][name] = "queued"
+
+            for name, data in items:
+                # Give way to interactive requests, checking for cancellation meanwhile
+                while not self.summary_executor.wait_idle(timeout=0.5):
+                    if cancelled.is_set():
+                        break
+                if cancelled.is_set():
+                    job["state"] = "cancelled"
+                    return
+
+                cost = self.cost_fn(doc_id, name, data)
+                if cost == 0:
+                    job["sections"][name] = "cached"
+                    continue
+                if job["tokens_used"] + cost > self.token_budget:
+                    job["sections"][name] = "over_budget"
+                    continue
+
+                job["tokens_used"] += cost
+                try:
+                    self.summarize_fn(doc_id, name, data)
+                    job["sections"][name] = "done"
+                except Exception:
+                    logger.exception("Prefetch of %s for document %s failed", name, doc_id)
+                    job["sections"][name] = "failed"
+            job["state"] = "completed"
+        except Exception:
+            logger.exception("Prefetch of document %s failed", doc_id)
+            job["state"] = "failed"
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+# Function to normalize section data so that formatting-only differences hash the same
+def normalize_data(data):
+    if isinstance(data, str):
+        return " ".join(data.split())
+    if isinstance(data, (list, tuple)):
+        return [normalize_data(item) for item in data]
+    if isinstance(data, dict):
+        return {str(key): normalize_data(value) for key, value in data.items()}
+    return data
+
+
+# Function to compute the cache key of a summary request
+def summary_cache_key(data, model, template, **params):
+    payload = json.dumps({
+        "data": normalize_data(data),
+        "model": model,
+        "template": template,
+        "params": params
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+# Function to fingerprint each row of section data
+def row_fingerprints(rows):
+    return [hashlib.sha256(json.dumps(normalize_data(row), ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+            for row in rows]
+
+
+# Function to find the rows added since a previous version of a table. Returns None
+# if any previous row is gone, i.e. the table was not only appended to.
+def appended_rows(previous_fingerprints, rows, fingerprints):
+    remaining = Counter(previous_fingerprints)
+    added = []
+    for row, fingerprint in zip(rows, fingerprints):
+        if remaining[fingerprint] > 0:
+            remaining[fingerprint] -= 1
+        else:
+            added.append(row)
+    if any(count > 0 for count in remaining.values()):
+        return None
+    return added
+
+
+class SummaryCache:
+    """
+    Two-tier summary cache: an in-memory LRU in front of a SQLite table that is
+    shared by every worker on the host. Entries expire after ttl seconds and the
+    table is trimmed to max_entries, least recently used first.
+
+    The same database keeps the latest summary of every (patient, section) with
+    the section's fingerprint and row fingerprints, so a re-uploaded CCDA only
+    re-summarizes the sections that changed.
+    """
+
+    def __init__(self, path, memory_size=1024, ttl=7 * 24 * 3600, max_entries=10000):
+        self.path = path
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+
+    @property
+    def _connection(self):
+        # Opened on first use in each process, so a cache created before gunicorn forks
+        # its workers never hands them the parent's SQLite connection
+        if self._db_pid != os.getpid():
+            with self._open_lock:
+                if self._db_pid != os.getpid():
+                    self._db = self._connect()
+                    self._db_pid = os.getpid()
+        return self._db
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "key TEXT PRIMARY KEY, summary TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS summaries_accessed ON summaries (accessed)")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS section_summaries ("
+            "patient TEXT NOT NULL, section TEXT NOT NULL, fingerprint TEXT NOT NULL, rows TEXT NOT NULL, "
+            "summary TEXT NOT NULL, updated REAL NOT NULL, PRIMARY KEY (patient, section))"
+        )
+        connection.commit()
+        return connection
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[1], now):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return entry[0]
+
+            row = self._connection.execute(
+                "SELECT summary, created FROM summaries WHERE key = ?", (key,)).fetchone()
+            if row is None or self._expired(row[1], now):
+                if row is not None:
+                    self._connection.execute("DELETE FROM summaries WHERE key = ?", (key,))
+                    self._connection.commit()
+                self._memory.pop(key, None)
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE summaries SET accessed = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+            self._remember(key, row[0], row[1])
+            self.hits += 1
+            return row[0]
+
+    def __contains__(self, key):
+        # Presence check that does not count as a hit or miss
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[1], now):
+                return True
+            row = self._connection.execute(
+                "SELECT created FROM summaries WHERE key = ?", (key,)).fetchone()
+            return row is not None and not self._expired(row[0], now)
+
+    def put(self, key, summary):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO summaries (key, summary, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, summary, now, now))
+            self._evict(now)
+            self._connection.commit()
+            self._remember(key, summary, now)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._connection.execute("DELETE FROM summaries WHERE key = ?", (key,))
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._connection.execute("DELETE FROM summaries")
+            self._connection.execute("DELETE FROM section_summaries")
+            self._connection.commit()
+
+    def get_section(self, patient, section):
+        """The latest summary of a patient's section: {"fingerprint", "rows", "summary"} or None."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT fingerprint, rows, summary, updated FROM section_summaries WHERE patient = ? AND section = ?",
+                (patient, section)).fetchone()
+        if row is None or self._expired(row[3], time.time()):
+            return None
+        return {"fingerprint": row[0], "rows": json.loads(row[1]), "summary": row[2]}
+
+    def put_section(self, patient, section, fingerprint, rows, summary):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO section_summaries (patient, section, fingerprint, rows, summary, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (patient, section, fingerprint, json.dumps(rows), summary, now))
+            if self.ttl > 0:
+                self._connection.execute("DELETE FROM section_summaries WHERE updated < ?", (now - self.ttl,))
+            self._connection.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "memory_hits": self.memory_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "memory_entries": len(self._memory)
+            }
+
+    def _expired(self, created, now):
+        return self.ttl > 0 and now - created > self.ttl
+
+    def _remember(self, key, summary, created):
+        self._memory[key] = (summary, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now):
+        if self.ttl > 0:
+            self._connection.execute("DELETE FROM summaries WHERE created < ?", (now - self.ttl,))
+        if self.max_entries > 0:
+            self._connection.execute(
+                "DELETE FROM summaries WHERE key IN ("
+                "SELECT key FROM summaries ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
@@ -0,0 +1,23 @@
+import os
+import sys
+import tempfile
+
+# The modules live at the repository root
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+SAMPLES_DIRECTORY = os.path.join(REPOSITORY, "files")
+
+# app.py reads its configuration at import: use the offline summarizer and keep every
+# file it writes out of the repository
+work_directory = tempfile.mkdtemp(prefix="ccda-tests-")
+os.environ.update({
+    "SUMMARY_BACKEND": "mock",
+    "CCDA_STORE_DIR": os.path.join(work_directory, "uploads"),
+    "SUMMARY_CACHE_PATH": os.path.join(work_directory, "summary_cache.sqlite3"),
+    "SEARCH_INDEX_PATH": os.path.join(work_directory, "search_index.sqlite3"),
+    "BATCH_JOBS_DIR": os.path.join(work_directory, "batch_jobs"),
+    "OPENAI_RATE_LIMIT_FILE": os.path.join(work_directory, "budget.json"),
+    "BATCH_INPUT_ROOT": SAMPLES_DIRECTORY,
+    "CCDA_REAPER_INTERVAL": "0",
+})
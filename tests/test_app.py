@@ -0,0 +1,613 @@
+import asyncio
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+import app as ccda
+from ccda_document import document_id_for
+from conftest import REPOSITORY, SAMPLES_DIRECTORY
+from llm_backends import BackendError
+from summarizer import SUMMARY_FAILED_MESSAGE, AdmissionQueue
+
+
+@pytest.fixture
+def client():
+    return ccda.app.test_client()
+
+
+def read_sample(name):
+    with open(os.path.join(SAMPLES_DIRECTORY, name), "rb") as sample:
+        return sample.read()
+
+
+def upload(client, name):
+    return upload_data(client, read_sample(name), name)
+
+
+def upload_data(client, data, name="sample.xml"):
+    response = client.post("/upload", data={"xml_file": (io.BytesIO(data), name)},
+                           content_type="multipart/form-data")
+    assert response.status_code == 200
+    return response.get_json()["document_id"]
+
+
+# Function to store a sample without the upload's validation (Thompson_Minnie has too
+# many empty sections to be accepted)
+def store(name):
+    data = read_sample(name)
+    doc_id = document_id_for(data)
+    ccda.document_store.save(doc_id, data, filename=name)
+    return doc_id
+
+
+# ************************************ DOCUMENTS ****************************************
+
+def test_routes_share_the_document_parsed_at_upload(client, monkeypatch):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    parses = []
+    from_stream = ccda.CCDADocument.from_stream
+    monkeypatch.setattr(ccda.CCDADocument, "from_stream", lambda *args, **kwargs: parses.append(1) or from_stream(
+        *args, **kwargs))
+
+    for route in ("/get_sections_with_data", "/extract_personal_details", "/extract_key_value_data",
+                  "/extract_dynamic_data", "/extract_medical_data"):
+        assert client.get(route + "?document_id=" + doc_id).status_code == 200
+    assert parses == []
+
+
+def test_unknown_document(client):
+    assert ccda.get_document("0" * 64) is None
+    assert client.get("/extract_dynamic_data?document_id=unknown").get_json() == {
+        "message": "No uploaded XML file found."}
+
+
+def test_document_is_reloaded_from_its_snapshot_then_its_xml(monkeypatch):
+    doc_id = store("CCDA_Williams_Suzanne.xml")
+    parsed = ccda.get_document(doc_id)
+
+    ccda.document_cache.pop(doc_id)
+    monkeypatch.setattr(ccda.CCDADocument, "from_stream", None)
+    snapshot = ccda.get_document(doc_id)
+    assert snapshot is not parsed and snapshot is ccda.get_document(doc_id)
+    monkeypatch.undo()
+
+    # A corrupt snapshot is a miss: the XML is parsed and the snapshot written again
+    ccda.document_cache.pop(doc_id)
+    with open(ccda.document_store.snapshot_path(doc_id), "r+b") as snapshot_file:
+        snapshot_file.truncate(100)
+    reparsed = ccda.get_document(doc_id)
+    assert [section.title for section in reparsed.sections] == [section.title for section in parsed.sections]
+    assert os.path.getsize(ccda.document_store.snapshot_path(doc_id)) > 100
+
+
+def test_routes_work_from_the_snapshot_without_the_xml(client):
+    data = append_row(read_sample("CCDA_Williams_Suzanne.xml"), "Vitals",
+                      b"<tr><td>02/01/2020</td><td>157.48 cm</td><td>30 kg/m2</td><td>74000 g</td></tr>")
+    doc_id = upload_data(client, data)
+    ccda.document_cache.pop(doc_id)
+    os.remove(ccda.document_store.xml_path(doc_id))
+
+    assert client.get("/extract_dynamic_data?document_id=" + doc_id).status_code == 200
+    # The section fingerprints are computed from the snapshot's tables
+    request = {"document_id": doc_id, "selected_sections": ["Problems", "Vitals"]}
+    first = client.post("/summarize_selected_sections", json=request).get_json()
+    second = client.post("/summarize_selected_sections", json=request).get_json()
+    assert second["section_summaries"] == first["section_summaries"] and second["recomputed_sections"] == []
+
+
+# ************************************ UPLOAD ROUTE ****************************************
+
+def test_each_upload_is_read_by_its_own_id(client):
+    first = upload(client, "CCDA_Williams_Suzanne.xml")
+    second = upload(client, "CCDA_Williams_Carl.xml")
+    assert first != second
+    assert upload(client, "CCDA_Williams_Suzanne.xml") == first
+
+    first_name = client.get("/extract_personal_details?document_id=" + first).get_json()
+    second_name = client.get("/extract_personal_details?document_id=" + second).get_json()
+    assert first_name != second_name
+    # The id can also be sent in the JSON body
+    response = client.post("/summarize_selected_sections", json={"document_id": second, "selected_sections": []})
+    assert response.get_json()["section_summaries"] == {}
+
+
+def test_upload_rejects_missing_and_non_xml_files(client):
+    assert client.post("/upload", data={}, content_type="multipart/form-data").status_code == 400
+    response = client.post("/upload", data={"xml_file": (io.BytesIO(b"text"), "notes.txt")},
+                           content_type="multipart/form-data")
+    assert response.status_code == 400
+
+
+def test_expired_document_is_gone(client, monkeypatch):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    monkeypatch.setattr(ccda.document_store, "exists", lambda doc_id: False)
+    assert client.get("/get_sections_with_data?document_id=" + doc_id).get_json() == {
+        "message": "No uploaded XML file found."}
+    assert doc_id not in ccda.document_cache
+
+
+# ************************************ EXTRACT KEY VALUE DETAILS ****************************************
+
+def test_key_value_data_has_one_value_per_row(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    first = client.get("/extract_key_value_data?document_id=" + doc_id).get_json()
+    assert client.get("/extract_key_value_data?document_id=" + doc_id).get_json() == first
+
+    assert first["Vitals"][0] == ["11/21/2019", ["28.9 kg/m2"]]
+    for pairs in first.values():
+        assert all(len(values) == 1 for _, values in pairs)
+
+
+# ************************************ EXTRACT DETAILS DYNAMICALLY ****************************************
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_extraction_routes_encode_empty_headers(client, monkeypatch, fast):
+    monkeypatch.setattr(ccda.app.json, "fast", fast)
+    doc_id = store("CCDA_Thompson_Minnie.xml")
+
+    for route in ("/extract_dynamic_data", "/extract_structured_data"):
+        response = client.get(route + "?document_id=" + doc_id)
+        assert response.status_code == 200
+    assert any("null" in record for record in response.get_json()["Plan of Treatment"]["records"])
+
+
+def test_streamed_sections_match_with_either_encoder(client, monkeypatch):
+    doc_id = store("CCDA_Thompson_Minnie.xml")
+    expected = client.get("/extract_dynamic_data?document_id=" + doc_id).get_json()
+
+    for fast in (True, False):
+        monkeypatch.setattr(ccda.app.json, "fast", fast)
+        response = client.get("/extract_dynamic_data?stream=1&document_id=" + doc_id)
+        assert response.status_code == 200
+        assert response.mimetype == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.get_data().splitlines()]
+        assert {line["section"]: line["data"] for line in lines} == expected
+
+
+def test_columnar_format_and_pagination(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    full = client.get("/extract_dynamic_data?document_id=" + doc_id).get_json()
+
+    response = client.get("/extract_dynamic_data?format=columnar&offset=1&limit=2&document_id=" + doc_id)
+    page = response.get_json()
+    assert response.headers["X-Total-Sections"] == str(len(full))
+    assert response.headers["X-Next-Offset"] == "3"
+    assert len(page) == 2
+    for section_name, value in page.items():
+        if not value["tables"]:
+            assert full[section_name] == {}
+            continue
+        # The default format keeps the last table of a section
+        table = value["tables"][-1]
+        rows = [{header if header is not None else "null": cell for header, cell in zip(table["headers"], row)}
+                for row in table["rows"]]
+        assert full[section_name][section_name] == rows
+
+
+def test_pages_past_the_end_and_negative_limits(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    total = len(client.get("/extract_dynamic_data?document_id=" + doc_id).get_json())
+
+    response = client.get("/extract_dynamic_data?offset=%d&limit=5&document_id=%s" % (total, doc_id))
+    assert response.get_json() == {} and "X-Next-Offset" not in response.headers
+    response = client.get("/extract_dynamic_data?offset=1&limit=-1&document_id=" + doc_id)
+    assert response.status_code == 400 and "X-Next-Offset" not in response.headers
+
+
+# ************************************ EXTRACT STRUCTURED DETAILS ****************************************
+
+def test_structured_data_from_entries_filtered_by_period(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    full = client.get("/extract_structured_data?sections=Vitals,Notes&document_id=" + doc_id).get_json()
+    assert list(full) == ["Notes", "Vitals"]
+    assert full["Vitals"]["source"] == "entries" and full["Notes"]["source"] == "narrative"
+
+    since = client.get("/extract_structured_data?sections=Vitals,Notes&since=2020-01-01&document_id="
+                       + doc_id).get_json()
+    assert 0 < len(since["Vitals"]["records"]) < len(full["Vitals"]["records"])
+    assert all(record["start"] is None or record["start"] >= "2020-01-01" for record in since["Vitals"]["records"])
+    # Narrative rows have no dates to filter on
+    assert since["Notes"] == full["Notes"]
+    assert client.get("/extract_structured_data?since=soon&document_id=" + doc_id).status_code == 400
+
+
+def test_analytics_for_a_period(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    full = client.get("/extract_analytics?document_id=" + doc_id).get_json()
+    assert sorted(full) == ["diagnoses", "encounters", "procedures", "vitals"]
+    weight = [trend for trend in full["vitals"] if trend["measure"] == "Body weight"]
+    assert weight and all(trend["unit"] == "kg" for trend in weight)
+
+    since = client.get("/extract_analytics?since=2020-01-01&document_id=" + doc_id).get_json()
+    assert sum(trend["readings"] for trend in since["vitals"]) < sum(trend["readings"] for trend in full["vitals"])
+    assert all(trend["first_date"] >= "2020-01-01" for trend in since["vitals"])
+    assert client.get("/extract_analytics?until=later&document_id=" + doc_id).status_code == 400
+
+
+# ************************************ SUMMARIES ****************************************
+
+def test_oversized_section_is_summarized_in_chunks_then_reduced(monkeypatch):
+    monkeypatch.setattr(ccda, "SUMMARY_PROMPT_TOKEN_LIMIT", 200)
+    prompts = []
+
+    def complete_prompt(prompt, on_token=None):
+        prompts.append(prompt)
+        return "summary %d" % len(prompts)
+
+    monkeypatch.setattr(ccda, "complete_prompt", complete_prompt)
+    rows = [["Problem %d" % index, "active", "01/01/2020"] for index in range(100)]
+    summary = ccda.summarize_text(ccda.render_rows(rows))
+
+    assert len(prompts) > 2
+    assert all(ccda.count_tokens(prompt) <= 200 for prompt in prompts)
+    map_prompts = [prompt for prompt in prompts if "Problem" in prompt]
+    assert sum(prompt.count("Problem ") for prompt in map_prompts) == 100
+    # The reduce prompt comes last and its summary is the answer
+    assert "Problem" not in prompts[-1] and summary == "summary %d" % len(prompts)
+
+
+def test_chunked_summaries_send_the_same_prompts_when_awaited(monkeypatch):
+    monkeypatch.setattr(ccda, "SUMMARY_PROMPT_TOKEN_LIMIT", 200)
+    text = ccda.render_rows([["Problem %d" % index, "active", "01/01/2020"] for index in range(100)])
+    prompts, awaited = [], []
+
+    async def complete_prompt_async(prompt, on_token=None):
+        awaited.append(prompt)
+        return "summary %d" % len(prompt)
+
+    monkeypatch.setattr(ccda, "complete_prompt", lambda prompt, on_token=None: prompts.append(prompt) or
+                        "summary %d" % len(prompt))
+    monkeypatch.setattr(ccda, "complete_prompt_async", complete_prompt_async)
+    summary = ccda.summarize_text(text)
+    assert asyncio.run(ccda.run_steps_async(ccda.summarize_text_steps(text))) == summary
+    assert sorted(awaited) == sorted(prompts) and len(prompts) > 2
+
+
+# ************************************ SUMMARIZE SELECTED SECTIONS ****************************************
+
+SECTIONS = ["Problems", "Medications", "Allergies"]
+
+
+def test_a_failed_section_does_not_fail_the_others(client, monkeypatch):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    ccda.summary_cache.clear()
+    complete = ccda.llm_backend.complete
+
+    def fail_on_medications(prompt, *args):
+        if "atorvastatin" in prompt:
+            raise BackendError("backend down")
+        return complete(prompt, *args)
+
+    monkeypatch.setattr(ccda.llm_backend, "complete", fail_on_medications)
+    response = client.post("/summarize_selected_sections",
+                           json={"document_id": doc_id, "selected_sections": SECTIONS}).get_json()
+    assert sorted(response["section_summaries"]) == sorted(SECTIONS)
+    assert response["section_summaries"]["Medications"] == SUMMARY_FAILED_MESSAGE
+    assert all(response["section_summaries"][name] for name in ("Problems", "Allergies"))
+
+
+def test_medical_data_summarizes_the_default_sections(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    ccda.summary_cache.clear()
+    response = client.get("/extract_medical_data?document_id=" + doc_id)
+    summaries = response.get_json()
+    assert sorted(summaries) == sorted(name.replace(" ", "_") for name in ccda.DEFAULT_SUMMARY_SECTIONS)
+    recomputed = response.headers["X-Recomputed-Sections"].split(", ")
+    assert recomputed and all(summaries[name.replace(" ", "_")] != "No data available in this section."
+                              for name in recomputed)
+
+
+NEW_ROWS = {
+    "Vitals": b"<tr><td>01/15/2020</td><td>157.48 cm</td><td>29.5 kg/m2</td><td>73200 g</td></tr>",
+    "Past Encounters": b"<tr><td>3099999</td><td>Christopher J Walsh</td><td>Newnan</td><td>01/15/2020</td>"
+                       b"<td>Follow-up visit</td></tr>"
+}
+
+
+# Function to add a row at the end of the first table of a section
+def append_row(data, section_name, row):
+    end = data.index(b"</tbody>", data.index(b"<title>" + section_name.encode() + b"</title>"))
+    return data[:end] + row + data[end:]
+
+
+def summarize(document, section_name):
+    return ccda.summarize_section(document, section_name, ccda.summary_rows(section_name, document))
+
+
+def test_reupload_only_recomputes_the_changed_sections(client):
+    ccda.summary_cache.clear()
+    data = read_sample("CCDA_Williams_Suzanne.xml")
+    first = upload_data(client, data)
+    request = {"document_id": first, "selected_sections": SECTIONS}
+    assert sorted(client.post("/summarize_selected_sections", json=request).get_json()["recomputed_sections"]) == (
+        sorted(SECTIONS))
+    assert client.post("/summarize_selected_sections", json=request).get_json()["recomputed_sections"] == []
+
+    changed = upload_data(client, append_row(data, "Problems", b"<tr><td>Migraine</td><td>active</td></tr>"))
+    assert changed != first
+    response = client.post("/summarize_selected_sections", json=dict(request, document_id=changed)).get_json()
+    assert response["recomputed_sections"] == ["Problems"]
+    assert "Migraine" in response["section_summaries"]["Problems"]
+
+
+@pytest.mark.parametrize("section_name", ["Vitals", "Past Encounters"])
+def test_appended_rows_of_an_analytics_section_are_summarized_as_a_delta(monkeypatch, section_name):
+    assert section_name in ccda.ANALYTICS_SECTIONS and section_name in ccda.APPEND_ONLY_SECTIONS
+    ccda.summary_cache.clear()
+    data = read_sample("CCDA_Williams_Suzanne.xml")
+    assert summarize(ccda.CCDADocument.from_bytes(data), section_name)[1] == "full"
+    assert summarize(ccda.CCDADocument.from_bytes(data), section_name)[1] == "unchanged"
+
+    prompts = []
+    monkeypatch.setattr(ccda, "complete_prompt", lambda prompt, on_token=None: prompts.append(prompt) or "updated")
+    appended = ccda.CCDADocument.from_bytes(append_row(data, section_name, NEW_ROWS[section_name]))
+    assert summarize(appended, section_name) == ("updated", "delta")
+    assert "01/15/2020" in prompts[0]
+    # Only the new table row is sent, not the section's analytics facts
+    assert prompts[0].split("New data:")[1].count("\n") == 1
+
+
+def test_prefetch_summarizes_the_rows_the_route_summarizes():
+    doc_id = store("CCDA_Williams_Suzanne.xml")
+    document = ccda.get_document(doc_id)
+    for section_name, data in ccda.prefetch_items(doc_id):
+        assert data == ccda.summary_rows(section_name, document)
+
+
+def read_events(body):
+    events = []
+    for block in body.decode().strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append(dict(json.loads(lines["data"]), event=lines["event"]))
+    return events
+
+
+@pytest.mark.parametrize("stream_format", ["sse", "ndjson"])
+def test_stream_sends_each_summary_then_done(client, stream_format):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    ccda.summary_cache.clear()
+    request = {"document_id": doc_id, "selected_sections": SECTIONS}
+    expected = client.post("/summarize_selected_sections", json=request).get_json()["section_summaries"]
+
+    response = client.post("/summarize_selected_sections/stream?tokens=1&format=" + stream_format, json=request)
+    assert response.headers["Cache-Control"] == "no-cache"
+    body = response.get_data()
+    if stream_format == "ndjson":
+        assert response.mimetype == "application/x-ndjson"
+        events = [json.loads(line) for line in body.splitlines()]
+    else:
+        assert response.mimetype == "text/event-stream"
+        events = read_events(body)
+
+    summaries = {event["section"]: event["summary"] for event in events if event["event"] == "summary"}
+    assert summaries == expected
+    assert all(not event["recomputed"] for event in events if event["event"] == "summary")
+    assert events[-1] == {"event": "done"}
+
+
+def test_streamed_tokens_make_up_the_summary(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    ccda.summary_cache.clear()
+    response = client.post("/summarize_selected_sections/stream?tokens=1&format=ndjson",
+                           json={"document_id": doc_id, "selected_sections": ["Problems"]})
+    events = [json.loads(line) for line in response.get_data().splitlines()]
+    tokens = "".join(event["text"] for event in events if event["event"] == "token")
+    summary = [event for event in events if event["event"] == "summary"][0]
+    assert tokens and tokens.strip() == summary["summary"] and summary["recomputed"]
+
+
+def test_concurrent_identical_prompts_share_one_completion(monkeypatch):
+    calls = []
+    release = threading.Event()
+    complete = ccda.llm_backend.complete
+
+    def slow_complete(*args):
+        calls.append(1)
+        release.wait(5)
+        return complete(*args)
+
+    monkeypatch.setattr(ccda.llm_backend, "complete", slow_complete)
+    summaries, tokens = [], []
+    threads = [threading.Thread(target=lambda: summaries.append(ccda.complete_prompt("Summarize: a | b"))),
+               threading.Thread(target=lambda: summaries.append(
+                   ccda.complete_prompt("Summarize: a | b", on_token=tokens.append)))]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert summaries[0] == summaries[1] and "".join(tokens).strip() == summaries[0]
+
+
+def test_rejected_requests_get_retry_after(client, monkeypatch):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    queue = AdmissionQueue(max_active=1, max_queued=0)
+    monkeypatch.setattr(ccda, "admission_queue", queue)
+    request = {"document_id": doc_id, "selected_sections": ["Problems"]}
+
+    queue.acquire("other client")
+    response = client.post("/summarize_selected_sections", json=request)
+    assert response.status_code == 429
+    assert response.get_json()["reason"] == "queue_full"
+    assert int(response.headers["Retry-After"]) >= 1
+
+    queue.release(0.1)
+    assert client.post("/summarize_selected_sections", json=request).status_code == 200
+    # A streamed response holds its slot until the whole body is sent
+    response = client.post("/summarize_selected_sections/stream?format=ndjson", json=request)
+    assert queue.active == 1
+    response.get_data()
+    response.close()
+    assert queue.active == 0
+
+
+# ************************************ SUMMARY CACHE ****************************************
+
+def test_identical_section_data_is_summarized_once(client, monkeypatch):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    client.delete("/summary_cache")
+    calls = []
+    complete = ccda.llm_backend.complete
+    monkeypatch.setattr(ccda.llm_backend, "complete", lambda *args: calls.append(1) or complete(*args))
+
+    request = {"document_id": doc_id, "selected_sections": ["Problems"]}
+    first = client.post("/summarize_selected_sections", json=request).get_json()
+    second = client.post("/summarize_selected_sections", json=request).get_json()
+    assert len(calls) == 1
+    assert second["section_summaries"] == first["section_summaries"]
+    assert client.get("/summary_cache").get_json()["entries"] == 1
+
+
+# ************************************ BATCH PROCESSING ****************************************
+
+def test_batch_job_runs_in_the_background(client):
+    response = client.post("/batch", json={"source": "CCDA_Williams_Carl.xml"})
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+
+    deadline = time.monotonic() + 30
+    status = client.get("/batch/" + job_id).get_json()
+    while status["state"] in ("queued", "running") and time.monotonic() < deadline:
+        time.sleep(0.1)
+        status = client.get("/batch/" + job_id).get_json()
+    assert status["state"] == "completed"
+    assert (status["total"], status["processed"], status["failed"]) == (1, 1, 0)
+    with open(status["output"]) as output:
+        assert json.loads(output.readline())["path"].endswith("CCDA_Williams_Carl.xml")
+    with open(status["analytics"]) as analytics:
+        assert analytics.readline().startswith("patient,measure,unit,readings")
+
+
+@pytest.mark.parametrize("source", [None, "missing.xml", "../outside.xml", "relative.txt", "absolute.txt"])
+def test_batch_source_must_be_under_the_input_root(client, monkeypatch, tmp_path, source):
+    root = tmp_path / "root"
+    root.mkdir()
+    outside = tmp_path / "outside.xml"
+    outside.write_bytes(read_sample("CCDA_Williams_Carl.xml"))
+    # Manifests under the root cannot list files outside it either
+    (root / "relative.txt").write_text("../outside.xml\n")
+    (root / "absolute.txt").write_text(str(outside) + "\n")
+    monkeypatch.setattr(ccda, "BATCH_INPUT_ROOT", str(root))
+    assert client.post("/batch", json={"source": source}).status_code == 400
+
+
+def test_unknown_batch_job(client):
+    assert client.get("/batch/unknown").status_code == 404
+
+
+# ************************************ METRICS ****************************************
+
+def test_server_timing_and_request_metrics(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    response = client.get("/extract_dynamic_data?timing=1&document_id=" + doc_id)
+    stages = [stage.split(";")[0] for stage in response.headers["Server-Timing"].split(", ")]
+    assert "document" in stages and stages[-1] == "total"
+    assert "Server-Timing" not in client.get("/extract_dynamic_data?document_id=" + doc_id).headers
+
+    rendered = client.get("/metrics").get_data(as_text=True)
+    assert 'ccda_requests_total{method="GET",route="/extract_dynamic_data",status="200"}' in rendered
+    assert 'ccda_stage_seconds_count{stage="parse"}' in rendered
+
+
+# ************************************ RESPONSE COMPRESSION ****************************************
+
+def test_large_responses_are_compressed(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    plain = client.get("/extract_dynamic_data?document_id=" + doc_id)
+    compressed = client.get("/extract_dynamic_data?document_id=" + doc_id, headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in plain.headers
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(compressed.get_data()) == plain.get_data()
+
+
+# ************************************ SEARCH ****************************************
+
+def test_uploads_are_indexed_for_search(client):
+    doc_id = upload(client, "CCDA_Williams_Carl.xml")
+    # Indexing runs on a one-thread pool: wait for it
+    ccda.index_pool.submit(lambda: None).result()
+    assert doc_id in ccda.row_index
+
+    response = client.get("/search?q=medications&k=2&section=Medications")
+    results = response.get_json()["results"]
+    assert len(results) == 2 and {result["section"] for result in results} == {"Medications"}
+    answered = client.post("/search", json={"q": "medications", "answer": True}).get_json()
+    assert answered["answer"]
+
+    assert client.get("/search").status_code == 400
+    assert client.get("/search?q=x&k=many").status_code == 400
+    assert client.delete("/search?document_id=" + doc_id).status_code == 200
+    assert client.delete("/search?document_id=" + doc_id).status_code == 404
+
+
+# ************************************ ASK ****************************************
+
+def test_answers_cite_the_best_matching_rows(client, monkeypatch):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    ccda.summary_cache.clear()
+    prompts = []
+    monkeypatch.setattr(ccda, "complete_prompt", lambda prompt, on_token=None: prompts.append(prompt) or "answer")
+
+    request = {"document_id": doc_id, "question": "Is atorvastatin active?", "sections": ["Medications"]}
+    response = client.post("/ask", json=request).get_json()
+    assert response["answer"] == "answer"
+    citations = response["citations"]
+    assert citations[0]["section"] == "Medications" and "atorvastatin" in citations[0]["text"]
+    assert [citation["id"] for citation in citations] == list(range(1, len(citations) + 1))
+    assert "[1] " + citations[0]["text"] in prompts[0]
+
+    # The same question over the same rows is answered from the cache
+    assert client.post("/ask", json=request).get_json()["answer"] == "answer"
+    assert len(prompts) == 1
+
+
+def test_question_without_matching_rows(client):
+    doc_id = upload(client, "CCDA_Williams_Suzanne.xml")
+    response = client.post("/ask", json={"document_id": doc_id, "question": "zebra"}).get_json()
+    assert response["citations"] == []
+    assert client.post("/ask", json={"document_id": doc_id}).status_code == 400
+
+
+# ************************************ APP FACTORY ****************************************
+
+# Function to run Python code in a fresh process with the test configuration; returns its output
+def run_python(code, **env):
+    return subprocess.run([sys.executable, "-c", code], cwd=REPOSITORY, env=dict(os.environ, **env),
+                          capture_output=True, text=True, check=True).stdout.split()
+
+
+def test_import_leaves_per_process_work_to_the_first_request():
+    code = ("import sys, threading, app; "
+            "print(*[name in sys.modules for name in ('pandas', 'numpy', 'faiss', 'requests', 'httpx')], "
+            "threading.active_count(), app.summary_cache._db is None, app.row_index._db is None)")
+    assert run_python(code, CCDA_REAPER_INTERVAL="60") == ["False"] * 5 + ["1", "True", "True"]
+
+
+@pytest.mark.parametrize("preload", ["1", "0"])
+def test_wsgi_preload_imports_the_heavy_modules(preload):
+    code = "import gc, sys, wsgi; print('ccda_analytics' in sys.modules, gc.get_freeze_count() > 0)"
+    assert run_python(code, WSGI_PRELOAD=preload) == [str(preload == "1")] * 2
+
+
+def test_background_services_start_once_per_process(client, monkeypatch):
+    starts = []
+    monkeypatch.setattr(ccda, "REAPER_INTERVAL", 60)
+    monkeypatch.setattr(ccda, "services_pid", None)
+    monkeypatch.setattr(ccda.document_reaper, "start", lambda: starts.append(os.getpid()))
+
+    client.get("/metrics")
+    client.get("/metrics")
+    assert len(starts) == 1
+    # A worker forked after the import starts its own
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    client.get("/metrics")
+    assert starts[1:] == [-1]
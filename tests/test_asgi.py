@@ -0,0 +1,148 @@
+import asyncio
+import io
+import json
+import os
+import threading
+
+import pytest
+
+import app as ccda
+import asgi
+from conftest import SAMPLES_DIRECTORY
+
+SECTIONS = ["Problems", "Medications", "Plan of Treatment"]
+
+
+# Function to send one request to the ASGI application: (status, headers, body)
+async def call(method, path, body=b"", query=b"", headers=()):
+    scope = {"type": "http", "http_version": "1.1", "method": method, "path": path, "query_string": query,
+             "client": ("127.0.0.1", 1), "headers": [(b"content-type", b"application/json")] + list(headers)}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+    disconnected = asyncio.Event()
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi.application(scope, receive, send)
+    disconnected.set()
+    start = sent[0]
+    return (start["status"], {name.decode(): value.decode() for name, value in start["headers"]},
+            b"".join(message.get("body", b"") for message in sent[1:]))
+
+
+@pytest.fixture(scope="module")
+def doc_id():
+    with open(os.path.join(SAMPLES_DIRECTORY, "CCDA_Williams_Suzanne.xml"), "rb") as sample:
+        data = sample.read()
+    response = ccda.app.test_client().post("/upload", data={"xml_file": (io.BytesIO(data), "sample.xml")},
+                                           content_type="multipart/form-data")
+    return response.get_json()["document_id"]
+
+
+def summary_request(doc_id, **options):
+    return json.dumps(dict(options, document_id=doc_id, selected_sections=SECTIONS)).encode()
+
+
+def test_summaries_match_the_flask_route(doc_id):
+    flask_summaries = ccda.app.test_client().post(
+        "/summarize_selected_sections", json={"document_id": doc_id, "selected_sections": SECTIONS}).get_json()
+    status, headers, body = asyncio.run(call("POST", "/summarize_selected_sections", summary_request(doc_id)))
+    assert status == 200
+    assert headers["content-type"] == "application/json"
+    assert json.loads(body)["section_summaries"] == flask_summaries["section_summaries"]
+
+
+def test_backend_requests_are_awaited_on_the_event_loop(doc_id, monkeypatch):
+    ccda.summary_cache.clear()
+    loop_threads = []
+    acomplete = ccda.llm_backend.acomplete
+
+    async def record_thread(*args):
+        loop_threads.append(threading.current_thread() is main_thread)
+        return await acomplete(*args)
+
+    def blocking_complete(*args):
+        raise AssertionError("the blocking backend call was used")
+
+    main_thread = threading.current_thread()
+    monkeypatch.setattr(ccda.llm_backend, "acomplete", record_thread)
+    monkeypatch.setattr(ccda.llm_backend, "complete", blocking_complete)
+    status, _, body = asyncio.run(call("POST", "/summarize_selected_sections", summary_request(doc_id)))
+    assert status == 200
+    assert loop_threads and all(loop_threads)
+    assert sorted(json.loads(body)["recomputed_sections"]) == sorted(SECTIONS)
+
+
+def test_admission_limits_are_sized_for_the_event_loop():
+    assert ccda.admission_queue.max_active >= 256
+    assert ccda.admission_queue.max_queued >= 1024
+
+
+def test_extraction_runs_off_the_event_loop(doc_id, monkeypatch):
+    loop_threads = []
+    summary_rows = ccda.summary_rows
+
+    def record_thread(*args):
+        loop_threads.append(threading.current_thread() is main_thread)
+        return summary_rows(*args)
+
+    main_thread = threading.current_thread()
+    monkeypatch.setattr(ccda, "summary_rows", record_thread)
+    asyncio.run(call("POST", "/summarize_selected_sections", summary_request(doc_id)))
+    assert loop_threads == [False] * len(SECTIONS)
+
+
+def test_stream_sends_every_section_then_done(doc_id):
+    status, headers, body = asyncio.run(call("POST", "/summarize_selected_sections/stream", summary_request(doc_id),
+                                             query=b"format=ndjson&tokens=1"))
+    assert status == 200
+    assert headers["content-type"] == "application/x-ndjson"
+    events = [json.loads(line) for line in body.splitlines()]
+    assert sorted(event["section"] for event in events if event["event"] == "summary") == sorted(SECTIONS)
+    assert events[-1] == {"event": "done"}
+
+
+def test_other_routes_are_served_by_flask(doc_id):
+    status, _, body = asyncio.run(call("GET", "/get_sections_with_data", query=b"document_id=" + doc_id.encode()))
+    assert status == 200
+    assert "Problems" in json.loads(body)["sections_with_data"]
+
+
+def test_invalid_period_is_a_bad_request(doc_id):
+    status, _, body = asyncio.run(call("POST", "/summarize_selected_sections",
+                                       summary_request(doc_id, since="yesterday")))
+    assert status == 400
+    assert "error" in json.loads(body)
+
+
+def test_cancelled_request_is_recorded():
+    async def slow(request):
+        await asyncio.sleep(10)
+
+    async def cancel():
+        receive_queue = [{"type": "http.request", "body": b"", "more_body": False}]
+
+        async def receive():
+            if receive_queue:
+                return receive_queue.pop(0)
+            await asyncio.sleep(10)
+
+        async def send(message):
+            pass
+
+        task = asyncio.create_task(asgi.handle(slow, {"type": "http", "method": "POST", "path": "/slow"},
+                                               receive, send))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel())
+    assert 'ccda_requests_total{method="POST",route="/slow",status="499"} 1' in ccda.metrics.render()
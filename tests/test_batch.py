@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+
+import pandas as pd
+import pytest
+
+import batch
+from batch import discover_inputs, load_checkpoint, process_file, run_batch, write_analytics
+from conftest import SAMPLES_DIRECTORY
+
+SAMPLE = os.path.join(SAMPLES_DIRECTORY, "CCDA_Thompson_Minnie.xml")
+
+
+def read_records(path):
+    with open(path) as results:
+        return [json.loads(line) for line in results]
+
+
+def test_discover_inputs_from_a_directory_and_a_manifest(tmp_path):
+    (tmp_path / "nested").mkdir()
+    for name in ("b.xml", "nested/a.XML", "notes.txt"):
+        (tmp_path / name).write_text("")
+    assert discover_inputs(str(tmp_path)) == [str(tmp_path / "b.xml"), str(tmp_path / "nested" / "a.XML")]
+
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_text("# archive\nb.xml\n\nnested/a.XML\n")
+    assert discover_inputs(str(manifest)) == [str(tmp_path / "b.xml"), str(tmp_path / "nested" / "a.XML")]
+    assert discover_inputs(str(tmp_path / "b.xml")) == [str(tmp_path / "b.xml")]
+
+
+def test_discovered_inputs_must_resolve_inside_the_root(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    (root / "a.xml").write_text("")
+    (tmp_path / "outside.xml").write_text("")
+    (root / "link.xml").symlink_to(tmp_path / "outside.xml")
+
+    with pytest.raises(ValueError):
+        discover_inputs(str(root), root=str(root))
+    (root / "link.xml").unlink()
+    assert discover_inputs(str(root), root=str(root)) == [str(root / "a.xml")]
+
+    manifest = root / "manifest.txt"
+    manifest.write_text("a.xml\n../outside.xml\n")
+    with pytest.raises(ValueError):
+        discover_inputs(str(manifest), root=str(root))
+
+
+def test_process_file_extracts_a_document():
+    record = process_file(SAMPLE)
+    assert record["path"] == SAMPLE
+    assert "error" not in record
+    assert record["personal_details"]["Name"]
+    assert set(record["sections"]) == set(record["tables"])
+    assert "vitals" in record["analytics"]
+
+
+def test_process_file_reports_an_extraction_failure(monkeypatch):
+    def fail(section_name, document):
+        raise KeyError(section_name)
+
+    monkeypatch.setattr(batch, "extract_data_from_table_section_two", fail)
+    record = process_file(SAMPLE)
+    assert record["path"] == SAMPLE
+    assert record["error"].startswith("KeyError")
+
+
+def test_run_batch_records_failures_and_resumes(tmp_path):
+    shutil.copy(SAMPLE, str(tmp_path / "good.xml"))
+    (tmp_path / "broken.xml").write_text("<ClinicalDocument")
+    paths = discover_inputs(str(tmp_path))
+    output = str(tmp_path / "results.jsonl")
+
+    progress = []
+    assert run_batch(paths, output, workers=1, progress=lambda *counts: progress.append(counts)) == (2, 1, 2)
+    assert progress[0] == (0, 0, 2) and progress[-1] == (2, 1, 2)
+    records = {os.path.basename(record["path"]): record for record in read_records(output)}
+    assert records["broken.xml"]["error"].startswith("ParseError")
+    assert records["good.xml"]["document_id"]
+    assert load_checkpoint(output + ".checkpoint") == set(paths)
+
+    # Finished files are not processed again
+    assert run_batch(paths, output, workers=1) == (2, 0, 2)
+    assert len(read_records(output)) == 2
+
+
+def test_run_batch_summarizes_the_selected_sections(tmp_path):
+    output = str(tmp_path / "results.jsonl")
+    run_batch([SAMPLE], output, workers=1, summarize_fn=lambda rows: "%d rows" % len(rows),
+              summary_sections=["Plan of Treatment", "Problems"])
+    record = read_records(output)[0]
+    assert record["summaries"] == {"Plan of Treatment": "7 rows"}
+
+
+def test_analytics_trend_each_patient_across_files(tmp_path):
+    with open(os.path.join(SAMPLES_DIRECTORY, "CCDA_Williams_Suzanne.xml"), "rb") as sample:
+        data = sample.read()
+    # A later document of the same patient repeats her earlier vitals and adds a weight
+    end = data.index(b"</tbody>", data.index(b"<title>Vitals</title>"))
+    later = data[:end] + b"<tr><td>01/15/2021</td><td></td><td></td><td>73 kg</td></tr>" + data[end:]
+    (tmp_path / "earlier.xml").write_bytes(data)
+    (tmp_path / "later.xml").write_bytes(later)
+    shutil.copy(os.path.join(SAMPLES_DIRECTORY, "CCDA_Williams_Carl.xml"), str(tmp_path / "carl.xml"))
+    output = str(tmp_path / "results.jsonl")
+    run_batch(discover_inputs(str(tmp_path)), output, workers=1)
+
+    write_analytics(output, str(tmp_path / "trends.csv"))
+    trends = pd.read_csv(str(tmp_path / "trends.csv"))
+    assert trends["patient"].nunique() == 2
+    suzanne = trends[trends["patient"] == "2.16.840.1.113883.3.564^a-15749.E-125346228"].set_index("measure")
+    weight = suzanne.loc["Body weight"]
+    assert (weight["readings"], weight["last"], weight["last_date"]) == (2, 73, "2021-01-15")
+    assert suzanne.loc["Body height", "readings"] == 7
+
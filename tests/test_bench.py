@@ -0,0 +1,58 @@
+import os
+
+# Imported with the test configuration first, so import_app only sets the environment
+import app  # noqa: F401
+from benchmarks.bench import SYNTHETIC_SAMPLE, compare, import_app, measure
+from benchmarks.synthetic import scale_ccda
+from ccda_document import CCDADocument
+from conftest import SAMPLES_DIRECTORY
+
+ENVIRONMENT = ["CCDA_STORE_DIR", "SUMMARY_CACHE_PATH", "SEARCH_INDEX", "SEARCH_INDEX_PATH",
+               "BATCH_JOBS_DIR", "OPENAI_RATE_LIMIT_FILE"]
+
+
+def test_import_app_keeps_every_file_in_the_work_directory(tmp_path, monkeypatch):
+    for name in ENVIRONMENT:
+        monkeypatch.setenv(name, "unchanged")
+    work_directory = str(tmp_path)
+
+    import_app(work_directory)
+    assert os.environ["SEARCH_INDEX"] == "0"
+    for name in ENVIRONMENT:
+        if name != "SEARCH_INDEX":
+            assert os.environ[name].startswith(work_directory + os.sep)
+
+    import_app(work_directory, search_index=True)
+    assert os.environ["SEARCH_INDEX"] == "1"
+
+
+def test_scaled_documents_repeat_sections_and_rows():
+    sample_path = os.path.join(SAMPLES_DIRECTORY, SYNTHETIC_SAMPLE)
+    with open(sample_path, "rb") as sample:
+        original = CCDADocument.from_bytes(sample.read())
+
+    sections = CCDADocument.from_bytes(scale_ccda(sample_path, sections=3))
+    assert len(sections.sections) == 3 * len(original.sections)
+    assert sections.find_sections("Problems #3")
+
+    rows = CCDADocument.from_bytes(scale_ccda(sample_path, rows=3))
+    assert [len(table) for section in rows.sections for table in section.tables] == [
+        3 * len(table) for section in original.sections for table in section.tables]
+
+
+def test_measure_runs_setup_before_every_run():
+    calls = []
+    result = measure(lambda: calls.append("run"), 3, setup=lambda: calls.append("setup"))
+    assert calls == ["setup", "run"] * 4
+    assert result["repeat"] == 3 and result["wall_min_s"] <= result["wall_median_s"]
+
+
+def test_compare_reports_slowdowns_over_the_threshold_and_noise_floor():
+    def result(name, seconds):
+        return {"name": name, "input": "sample", "wall_median_s": seconds}
+
+    baseline = {"results": [result("slower", 0.1), result("noise", 0.0001), result("faster", 0.1)]}
+    current = [result("slower", 0.2), result("noise", 0.0005), result("faster", 0.05), result("new", 1.0)]
+    regressions = compare(current, baseline, 0.25)
+    assert [regression["name"] for regression in regressions] == ["slower"]
+    assert regressions[0]["ratio"] == 2.0
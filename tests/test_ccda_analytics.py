@@ -0,0 +1,92 @@
+import datetime
+
+import pytest
+
+from ccda_analytics import cohort_vital_trends, document_analytics, facts, vital_trends, vitals_frame
+from ccda_document import CCDADocument
+
+
+def table_section(title, headers, rows):
+    head = "".join("<th>%s</th>" % header for header in headers)
+    body = "".join("<tr>%s</tr>" % "".join("<td>%s</td>" % cell for cell in row) for row in rows)
+    return ("<component><section><title>%s</title><text><table><thead><tr>%s</tr></thead><tbody>%s</tbody>"
+            "</table></text></section></component>" % (title, head, body))
+
+
+def document(patient, sections):
+    header = ('<recordTarget><patientRole><id root="2.16" extension="%s"/><patient><name><given>A</given>'
+              '<family>B</family></name><administrativeGenderCode displayName="Female"/><birthTime value="1970"/>'
+              '<maritalStatusCode displayName="Single"/></patient></patientRole></recordTarget>' % patient)
+    return CCDADocument.from_bytes(('<ClinicalDocument xmlns="urn:hl7-org:v3">%s<component><structuredBody>%s'
+                                    '</structuredBody></component></ClinicalDocument>'
+                                    % (header, "".join(sections))).encode("utf-8"))
+
+
+VITALS = table_section("Vitals", ["Date Recorded", "Body weight", "BMI"], [
+    ["01/01/2020", "70000 g", "24"],
+    ["01/01/2021", "165.35 lb", "26.5"],
+    ["bad date", "80 kg", "30"],
+])
+ENCOUNTERS = table_section("Past Encounters", ["Encounter date", "Diagnosis/Indication", "Performer"], [
+    ["01/01/2020", "Asthma", "Dr A"],
+    ["01/11/2020", "Asthma", "Dr A"],
+    ["03/01/2020", "Flu", "Dr B"],
+])
+
+
+@pytest.fixture(scope="module")
+def patient():
+    return document("1", [VITALS, ENCOUNTERS])
+
+
+def test_readings_are_converted_to_common_units(patient):
+    vitals = vitals_frame(patient)
+    weights = vitals[vitals["measure"] == "Body weight"]
+    # The reading without a date is left out
+    assert list(weights["unit"]) == ["kg", "kg"]
+    assert list(weights["value"].round(2)) == [70.0, 75.0]
+
+
+def test_trends_changes_and_flags(patient):
+    trends = vital_trends(vitals_frame(patient)).set_index("measure")
+    weight = trends.loc["Body weight"]
+    assert weight["readings"] == 2 and round(weight["change"], 2) == 5.0
+    assert round(weight["slope_per_year"], 1) == 5.0
+    bmi = trends.loc["BMI"]
+    assert (bmi["low"], bmi["high"], bmi["out_of_range"], bmi["last_flag"]) == (18.5, 24.9, 1, "high")
+
+
+def test_facts_are_short_deterministic_rows(patient):
+    vitals = dict(facts(patient, "Vitals"))
+    # 2020 is a leap year, so the weight went up by 5 kg in slightly more than a year
+    assert vitals["Body weight"] == ("75 kg on 2021-01-01, 70 kg on 2020-01-01, change +5 kg over 2 readings, "
+                                     "trend +4.99 kg/year")
+    assert vitals["BMI"].endswith("last reading high (reference 18.5-24.9), 1 of 2 readings out of range")
+    assert facts(patient, "Past Encounters") == [
+        ["Encounters", "3 from 2020-01-01 to 2020-03-01, median 30 days apart"],
+        ["Diagnosis", "Asthma (2 encounters, last 2020-01-11)"],
+        ["Diagnosis", "Flu (1 encounter, last 2020-03-01)"],
+    ]
+    assert facts(patient, "Problems") is None
+
+
+def test_analytics_for_a_period_and_without_the_sections(patient):
+    analytics = document_analytics(patient, since=datetime.datetime(2020, 2, 1))
+    assert analytics["encounters"][0]["encounters"] == 1
+    assert {trend["measure"]: trend["readings"] for trend in analytics["vitals"]} == {"Body weight": 1, "BMI": 1}
+
+    empty = document_analytics(document("2", []))
+    assert empty == {"vitals": [], "encounters": [], "diagnoses": [], "procedures": []}
+
+
+def test_cohort_trends_are_computed_per_patient(patient):
+    # A later document of the same patient repeats one reading and adds another
+    later = document("1", [table_section("Vitals", ["Date Recorded", "BMI"], [["01/01/2021", "26.5"],
+                                                                              ["01/01/2022", "27"]])])
+    other = document("2", [table_section("Vitals", ["Date Recorded", "BMI"], [["01/01/2020", "20"]])])
+    trends = cohort_vital_trends(vitals_frame(document) for document in [patient, later, other, document("3", [])])
+    bmi = trends[trends["measure"] == "BMI"].set_index("patient")
+    assert sorted(bmi.index) == ["2.16^1", "2.16^2"]
+    assert bmi.loc["2.16^1", "readings"] == 3 and bmi.loc["2.16^1", "last"] == 27
+    assert bmi.loc["2.16^2", "readings"] == 1
+    assert cohort_vital_trends([]).empty
@@ -0,0 +1,126 @@
+import io
+import os
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from ccda_document import CCDADocument, DocumentCache, TooManyEmptySections, document_id_for
+from conftest import SAMPLES_DIRECTORY
+
+SAMPLE = os.path.join(SAMPLES_DIRECTORY, "CCDA_Williams_Suzanne.xml")
+
+
+def section_xml(title, rows=1, text=None):
+    if text is not None:
+        return "<component><section><title>%s</title><text>%s</text></section></component>" % (title, text)
+    body = "".join("<tr><td>%s %d</td><td>value %d</td></tr>" % (title, row, row) for row in range(rows))
+    return ("<component><section><title>%s</title><text><table><thead><tr><th>Name</th><th>Value</th></tr>"
+            "</thead><tbody>%s</tbody></table></text></section></component>" % (title, body))
+
+
+def document_xml(sections, header=""):
+    return ('<ClinicalDocument xmlns="urn:hl7-org:v3">%s<component><structuredBody>%s</structuredBody>'
+            '</component></ClinicalDocument>' % (header, "".join(sections))).encode("utf-8")
+
+
+def sections_summary(document):
+    return [(section.title, [table.rows for table in section.tables], section.has_data_one, section.none_recorded)
+            for section in document.sections]
+
+
+def test_stream_matches_the_whole_tree():
+    with open(SAMPLE, "rb") as sample:
+        data = sample.read()
+    streamed = CCDADocument.from_bytes(data)
+    parsed = CCDADocument.from_root(ET.fromstring(data))
+
+    assert sections_summary(streamed) == sections_summary(parsed)
+    assert streamed.personal_info == parsed.personal_info
+    assert streamed.doc_id == document_id_for(data)
+    assert streamed.source_size == len(data)
+
+
+def test_nested_sections_keep_document_order():
+    nested = ("<component><section><title>Outer</title><component><section><title>Inner</title>"
+              "<text>None Recorded</text></section></component></section></component>")
+    document = CCDADocument.from_bytes(document_xml([nested, section_xml("Last")]))
+    assert document.section_names() == ["Outer", "Inner", "Last"]
+
+
+def test_rejects_as_soon_as_the_threshold_is_reached():
+    data = document_xml([section_xml("Empty %d" % index, text="Nothing") for index in range(3)]
+                        + ["<broken"])
+    # The file is not even well-formed after the third empty section
+    with pytest.raises(TooManyEmptySections) as error:
+        CCDADocument.from_stream(io.BytesIO(data), empty_section_threshold=3)
+    assert error.value.sections_without_data == ["Empty 0", "Empty 1", "Empty 2"]
+
+
+def test_tee_receives_every_byte():
+    with open(SAMPLE, "rb") as sample:
+        data = sample.read()
+    copy = io.BytesIO()
+    CCDADocument.from_stream(io.BytesIO(data), tee=copy)
+    assert copy.getvalue() == data
+
+
+def test_elements_outside_sections_are_not_kept():
+    # A megabyte of header elements around a small body
+    header = "".join("<author><assignedAuthor><name>%s</name></assignedAuthor></author>" % ("x" * 1000)
+                     for _ in range(1000))
+    data = document_xml([section_xml("Problems", rows=3)], header=header)
+
+    tracemalloc.start()
+    try:
+        document = CCDADocument.from_stream(io.BytesIO(data))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert document.section_names() == ["Problems"]
+    assert peak < len(data) / 4
+
+
+def cached_document(doc_id, size):
+    return CCDADocument(doc_id, [], {}, approx_size=size)
+
+
+def test_cache_evicts_the_least_recently_used_document():
+    cache = DocumentCache(max_documents=2)
+    cache.put(cached_document("a", 1))
+    cache.put(cached_document("b", 1))
+    assert cache.get("a").doc_id == "a"
+    cache.put(cached_document("c", 1))
+    assert "a" in cache and "c" in cache and "b" not in cache
+
+
+def test_cache_is_bounded_by_size_but_keeps_the_newest_document():
+    cache = DocumentCache(max_bytes=100)
+    cache.put(cached_document("a", 60))
+    cache.put(cached_document("a", 30))
+    cache.put(cached_document("b", 60))
+    assert len(cache) == 2
+    cache.put(cached_document("large", 500))
+    assert len(cache) == 1 and "large" in cache
+    assert cache.pop("large").doc_id == "large"
+    assert cache.pop("large") is None and len(cache) == 0
+
+
+
+def test_sections_and_tables_are_looked_up_by_title_and_header():
+    document = CCDADocument.from_bytes(document_xml([section_xml("Problems", rows=2), section_xml("Vitals"),
+                                                     section_xml("Problems", rows=1)]))
+    assert [len(section.tables[0]) for section in document.find_sections("Problems")] == [2, 1]
+    assert document.find_sections("Missing") == []
+    tables = document.find_tables_with_headers("Problems", "Value", "Name")
+    assert [positions for _, positions in tables] == [[1, 0], [1, 0]]
+    assert document.find_tables_with_headers("Problems", "Name", "Missing") == []
+    assert [section.title for section, _ in document.find_tables("Value")] == ["Problems", "Vitals", "Problems"]
+
+
+def test_a_repeated_header_resolves_to_its_first_column():
+    text = ("<table><thead><tr><th>Date</th><th>Date</th></tr></thead>"
+            "<tbody><tr><td>first</td><td>second</td></tr></tbody></table>")
+    document = CCDADocument.from_bytes(document_xml([section_xml("Vitals", text=text)]))
+    ((table, position),) = document.find_columns("Vitals", "Date")
+    assert table.column(position) == ["first"]
@@ -0,0 +1,84 @@
+import datetime
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from ccda_entries import parse_hl7_time, parse_period_bound, section_entries
+
+NAMESPACES = 'xmlns="urn:hl7-org:v3" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+
+
+def section(template, text, entries):
+    return ET.fromstring('<section %s><templateId root="%s"/><text>%s</text>%s</section>'
+                         % (NAMESPACES, template, text, "".join("<entry>%s</entry>" % entry for entry in entries)))
+
+
+VITALS = section("2.16.840.1.113883.10.20.22.2.4.1", "", [
+    '<organizer><effectiveTime value="20200115"/>'
+    '<component><observation><code code="8867-4" displayName="Heart rate"/>'
+    '<value xsi:type="PQ" value="72" unit="/min"/></observation></component>'
+    '<component><observation><code code="8302-2" displayName="Body height"/>'
+    '<effectiveTime value="20200116103000+0500"/><value xsi:type="PQ" value="157.48" unit="cm"/></observation>'
+    '</component></organizer>'])
+
+PROBLEMS = section("2.16.840.1.113883.10.20.22.2.5.1", '<content ID="problem1">Essential hypertension</content>', [
+    '<act><effectiveTime><low value="2019"/></effectiveTime><entryRelationship><observation>'
+    '<code code="ASSERTION"/><statusCode code="completed"/>'
+    '<value xsi:type="CD" code="59621000"><originalText><reference value="#problem1"/></originalText></value>'
+    '</observation></entryRelationship></act>',
+    '<act><entryRelationship><observation negationInd="true"><code code="ASSERTION"/>'
+    '<value xsi:type="CD" code="195967001" displayName="Asthma"/></observation></entryRelationship></act>'])
+
+MEDICATIONS = section("2.16.840.1.113883.10.20.22.2.1.1", "", [
+    '<substanceAdministration><effectiveTime><low value="20190801"/><high value="20200801"/></effectiveTime>'
+    '<doseQuantity value="1" unit="tablet"/><consumable><manufacturedProduct><manufacturedMaterial>'
+    '<code code="617310" codeSystemName="RxNorm"><translation displayName="atorvastatin 40 mg tablet"/></code>'
+    '</manufacturedMaterial></manufacturedProduct></consumable></substanceAdministration>'])
+
+
+def test_vital_signs_are_dated_by_their_panel():
+    heart_rate, height = section_entries(VITALS)
+    assert (heart_rate.kind, heart_rate.display, heart_rate.value, heart_rate.unit) == ("vitals", "Heart rate",
+                                                                                        72.0, "/min")
+    assert heart_rate.start == datetime.datetime(2020, 1, 15)
+    assert height.start == datetime.datetime(2020, 1, 16, 10, 30)
+    assert heart_rate.to_row() == ["Heart rate", "72 /min", "2020-01-15"]
+
+
+def test_problems_come_from_their_concern_acts():
+    hypertension, asthma = section_entries(PROBLEMS)
+    assert hypertension.display == "Essential hypertension" and hypertension.value is None
+    assert hypertension.status == "completed" and hypertension.start == datetime.datetime(2019, 1, 1)
+    assert asthma.negated and asthma.to_row() == ["no Asthma"]
+
+
+def test_medications_are_named_by_their_product():
+    (medication,) = section_entries(MEDICATIONS)
+    assert (medication.code, medication.code_system, medication.display) == ("617310", "RxNorm",
+                                                                             "atorvastatin 40 mg tablet")
+    assert (medication.value, medication.unit) == (1.0, "tablet")
+    assert medication.to_dict()["end"] == "2020-08-01T00:00:00"
+
+
+def test_other_sections_have_no_entries():
+    assert section_entries(section("2.16.840.1.113883.10.20.22.2.65", "", [])) is None
+    assert section_entries(section("2.16.840.1.113883.10.20.22.2.5.1", "", [])) == []
+
+
+def test_entries_in_a_period():
+    hypertension, asthma = section_entries(PROBLEMS)
+    assert hypertension.in_period(since=parse_period_bound("2018-12-31"), until=parse_period_bound("2019-01-01",
+                                                                                                    end=True))
+    assert not hypertension.in_period(since=parse_period_bound("2019-01-02"))
+    # Undated entries are always kept
+    assert asthma.in_period(since=parse_period_bound("2030-01-01"))
+
+
+def test_time_parsing():
+    assert parse_hl7_time("2019") == datetime.datetime(2019, 1, 1)
+    assert parse_hl7_time("20191301") is None
+    assert parse_hl7_time(None) is None
+    assert parse_period_bound("2020-01-01", end=True) == datetime.datetime(2020, 1, 1, 23, 59, 59, 999999)
+    assert parse_period_bound("") is None
+    with pytest.raises(ValueError):
+        parse_period_bound("yesterday")
@@ -0,0 +1,96 @@
+import marshal
+import os
+
+import pytest
+
+from ccda_document import CCDADocument
+from ccda_snapshot import HEADER, SNAPSHOT_MAGIC, SnapshotColumns, dump_snapshot, load_snapshot
+from conftest import SAMPLES_DIRECTORY
+
+
+@pytest.fixture(scope="module")
+def document():
+    with open(os.path.join(SAMPLES_DIRECTORY, "CCDA_Williams_Suzanne.xml"), "rb") as sample:
+        return CCDADocument.from_bytes(sample.read())
+
+
+def write_snapshot(tmp_path, data):
+    path = str(tmp_path / "document.snap")
+    with open(path, "wb") as snapshot_file:
+        snapshot_file.write(data)
+    return path
+
+
+def data_offset(data):
+    return HEADER.size + HEADER.unpack_from(data, 0)[3]
+
+
+def test_round_trip_keeps_every_table_and_entry(document, tmp_path):
+    loaded = load_snapshot(write_snapshot(tmp_path, dump_snapshot(document)), document.doc_id)
+
+    assert loaded.doc_id == document.doc_id
+    assert loaded.personal_info == document.personal_info
+    assert [section.title for section in loaded.sections] == [section.title for section in document.sections]
+    for section, original in zip(loaded.sections, document.sections):
+        assert [table.rows for table in section.tables] == [table.rows for table in original.tables]
+        assert [table.plain_rows for table in section.tables] == [table.plain_rows for table in original.tables]
+        if original.entries is None:
+            assert section.entries is None
+        else:
+            assert [entry.to_dict() for entry in section.entries] == [entry.to_dict() for entry in original.entries]
+
+
+def test_snapshot_of_another_document_or_version_is_a_miss(document, tmp_path):
+    data = dump_snapshot(document)
+    assert load_snapshot(write_snapshot(tmp_path, data), "another document") is None
+
+    other_version = HEADER.pack(SNAPSHOT_MAGIC, 0, *HEADER.unpack_from(data, 0)[2:]) + data[HEADER.size:]
+    assert load_snapshot(write_snapshot(tmp_path, other_version)) is None
+    assert load_snapshot(str(tmp_path / "missing.snap")) is None
+    assert load_snapshot(write_snapshot(tmp_path, b"")) is None
+
+
+@pytest.mark.parametrize("removed", [1, 100])
+def test_truncated_snapshot_is_a_miss(document, tmp_path, removed):
+    data = dump_snapshot(document)
+    assert load_snapshot(write_snapshot(tmp_path, data[:-removed])) is None
+    # Cut inside the structure block
+    assert load_snapshot(write_snapshot(tmp_path, data[:HEADER.size + 10])) is None
+
+
+def test_structure_with_the_wrong_cell_count_is_a_miss(document, tmp_path):
+    data = dump_snapshot(document)
+    structure = marshal.loads(data[HEADER.size:data_offset(data)])
+    table = next(table for section in structure["sections"] for table in section[5])
+    start, length, cells = table[5][0]
+    table[5][0] = (start, length, cells + 1)
+    changed = marshal.dumps(structure)
+    header = HEADER.pack(*HEADER.unpack_from(data, 0)[:3], len(changed))
+    assert load_snapshot(write_snapshot(tmp_path, header + changed + data[data_offset(data):])) is None
+
+
+def test_loading_leaves_the_cells_unread_until_a_column_is_decoded(document, tmp_path):
+    data = dump_snapshot(document)
+    # Without its separators, no column with more than one cell matches its rows
+    corrupt = data[:data_offset(data)] + data[data_offset(data):].replace(b"\0", b"x")
+    loaded = load_snapshot(write_snapshot(tmp_path, corrupt))
+    assert loaded is not None
+    table = next(table for section in loaded.sections for table in section.tables if len(table.widths) > 1)
+    with pytest.raises(ValueError):
+        table.rows
+
+
+def test_columns_are_decoded_on_first_read():
+    columns = SnapshotColumns(b"a\0b" + "é".encode(), [(0, 3), (3, 2)], [2, 1])
+    assert columns._decoded == [None, None]
+    assert columns[1] == ["é", None]
+    assert columns._decoded[0] is None
+    assert list(columns) == [["a", "b"], ["é", None]]
+
+
+def test_column_that_does_not_match_its_rows_raises_value_error():
+    columns = SnapshotColumns(b"a\0b", [(0, 3)], [1, 1, 1])
+    with pytest.raises(ValueError):
+        columns[0]
+    with pytest.raises(ValueError):
+        SnapshotColumns(b"a", [(0, 1)], [0])[0]
@@ -0,0 +1,53 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from ccda_tables import read_table
+
+TABLE = """<table xmlns="urn:hl7-org:v3">
+<thead><tr><th>Name</th><th>Status</th><th>Date</th></tr></thead>
+<tbody>
+<tr><td><content ID="a"> Asthma </content></td><td> active </td><td>01/01/2020</td></tr>
+<tr><td>None Recorded</td><td><paragraph>see</paragraph><paragraph>notes</paragraph></td></tr>
+<tr><td><list><item>nested</item></list></td><td>resolved</td><td>02/02/2020</td></tr>
+</tbody>
+</table>"""
+
+
+def table(mode="content"):
+    return read_table(ET.fromstring(TABLE), mode=mode)
+
+
+def test_rows_in_content_and_plain_mode():
+    content = table()
+    assert content.headers == ["Name", "Status", "Date"]
+    assert content.widths == [3, 2, 3]
+    assert content.none_recorded
+    assert content.rows == [["Asthma", "active", "01/01/2020"], ["None Recorded", "see notes"],
+                            ["nested", "resolved", "02/02/2020"]]
+    # Cells without their own text are empty in plain mode
+    assert content.plain_rows == [["Asthma", "active", "01/01/2020"], ["None Recorded", ""],
+                                  ["", "resolved", "02/02/2020"]]
+    assert content.rows is content.rows
+
+
+def test_readable_mode_keeps_the_cell_text():
+    readable = table("readable")
+    assert readable.rows[0][1] == " active "
+    assert readable.rows[1][1] == "see notes"
+    with pytest.raises(ValueError):
+        readable.plain_rows
+
+
+def test_columns_pad_short_rows():
+    content = table()
+    assert content.column(2) == ["01/01/2020", None, "02/02/2020"]
+    assert content.column(0, mode="plain") == ["Asthma", "None Recorded", ""]
+    assert content.header_positions == {"Name": 0, "Status": 1, "Date": 2}
+    assert len(content) == 3
+
+
+def test_table_without_rows():
+    empty = read_table(ET.fromstring('<table xmlns="urn:hl7-org:v3"><thead><tr><th>Name</th></tr></thead></table>'))
+    assert empty.headers == ["Name"] and empty.rows == [] and len(empty) == 0
+    assert not empty.none_recorded
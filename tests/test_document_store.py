@@ -0,0 +1,130 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+
+from ccda_document import CCDADocument, document_id_for
+from document_store import DocumentReaper, LocalDocumentStore, SharedDocumentStore, create_document_store
+
+DATA = b'<ClinicalDocument xmlns="urn:hl7-org:v3"/>'
+DOC_ID = document_id_for(DATA)
+
+
+@pytest.fixture(params=["local", "shared"])
+def store(request, tmp_path):
+    return create_document_store(request.param, str(tmp_path / "uploads"), ttl=3600)
+
+
+def temp_files(store):
+    return [os.path.join(directory, filename) for directory, _, filenames in os.walk(store.directory)
+            for filename in filenames if filename.endswith(".tmp")]
+
+
+def test_documents_are_kept_by_id(store):
+    store.save(DOC_ID, DATA, filename="sample.xml")
+    assert store.exists(DOC_ID)
+    assert store.read(DOC_ID) == DATA
+    assert store.metadata(DOC_ID)["filename"] == "sample.xml"
+
+    store.delete(DOC_ID)
+    assert not store.exists(DOC_ID)
+    assert store.read(DOC_ID) is None
+
+
+@pytest.mark.parametrize("doc_id", ["../" + DOC_ID, DOC_ID.upper(), "abc", None])
+def test_invalid_ids_are_never_paths(store, doc_id):
+    assert not store.exists(doc_id)
+    assert store.open(doc_id) is None
+    with pytest.raises(ValueError):
+        store.save(doc_id, DATA)
+
+
+def test_upload_is_stored_while_it_is_parsed(store):
+    with store.begin_save(filename="sample.xml") as pending:
+        document = CCDADocument.from_stream(io.BytesIO(DATA), tee=pending)
+        metadata = pending.commit(document.doc_id)
+
+    assert document.doc_id == DOC_ID
+    assert metadata["filename"] == "sample.xml" and metadata["size"] == len(DATA)
+    assert store.read(DOC_ID) == DATA
+    assert temp_files(store) == []
+
+
+def test_abandoned_upload_leaves_nothing_behind(store):
+    with pytest.raises(ValueError):
+        with store.begin_save() as pending:
+            pending.write(DATA[:10])
+            raise ValueError("parse failed")
+    assert temp_files(store) == []
+    assert list(store.document_ids()) == []
+
+
+def test_purge_removes_expired_documents(store):
+    store.save(DOC_ID, DATA)
+    store.ttl = 0.01
+    other = document_id_for(b"other")
+    store.save(other, b"other")
+    time.sleep(0.05)
+
+    # The lifetime is fixed when a document is uploaded
+    assert store.exists(DOC_ID) and not store.exists(other)
+    assert store.purge_expired() == [other]
+    assert list(store.document_ids()) == [DOC_ID]
+
+
+def test_purge_removes_old_temporary_files_in_every_directory(store):
+    store.save(DOC_ID, DATA)
+    document_directory = os.path.dirname(store.xml_path(DOC_ID))
+    old_paths = [os.path.join(store.directory, "upload.tmp"), os.path.join(document_directory, "snapshot.tmp")]
+    recent_path = os.path.join(document_directory, "recent.tmp")
+    for path in old_paths + [recent_path]:
+        with open(path, "wb") as temp_file:
+            temp_file.write(b"partial")
+    for path in old_paths:
+        os.utime(path, (time.time() - 7200, time.time() - 7200))
+
+    store.purge_expired()
+    assert temp_files(store) == [recent_path]
+    assert store.read(DOC_ID) == DATA
+
+
+def test_shared_store_shards_by_id_prefix(tmp_path):
+    store = SharedDocumentStore(str(tmp_path))
+    store.save(DOC_ID, DATA)
+    assert store.xml_path(DOC_ID) == os.path.join(str(tmp_path), DOC_ID[:2], DOC_ID + ".xml")
+    assert list(store.document_ids()) == [DOC_ID]
+
+
+def test_shared_store_skips_a_purge_in_progress(tmp_path):
+    store = SharedDocumentStore(str(tmp_path), ttl=0.01)
+    store.save(DOC_ID, DATA)
+    time.sleep(0.05)
+    open(os.path.join(str(tmp_path), ".purge.lock"), "w").close()
+    assert store.purge_expired() == []
+
+    # A lock older than purge_lock_timeout was left by a dead process
+    store.purge_lock_timeout = 0
+    time.sleep(0.01)
+    assert store.purge_expired() == [DOC_ID]
+
+
+def test_reaper_purges_in_the_background(tmp_path):
+    store = LocalDocumentStore(str(tmp_path), ttl=0.01)
+    store.save(DOC_ID, DATA)
+    expired = threading.Event()
+    reaped = []
+
+    def on_expired(doc_ids):
+        reaped.extend(doc_ids)
+        expired.set()
+
+    reaper = DocumentReaper(store, interval=0.05, on_expired=on_expired)
+    assert reaper.start() is reaper.start()
+    try:
+        assert expired.wait(2)
+    finally:
+        reaper.stop()
+    assert reaped == [DOC_ID]
+    assert not reaper._thread.is_alive()
@@ -0,0 +1,162 @@
+import asyncio
+import json
+import os
+
+import pytest
+import requests
+
+from llm_backends import BackendError, MockBackend, OpenAIChatBackend, create_backend
+
+PROMPT = "Summarize the following data:\nAsthma | active\nFlu | resolved"
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None, lines=()):
+        self.status_code = status_code
+        self.text = json.dumps(body)
+        self.headers = headers or {}
+        self._body = body
+        self._lines = lines
+        self.closed = False
+
+    def json(self):
+        return self._body
+
+    def iter_lines(self, decode_unicode=False):
+        return iter(self._lines)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FakeSession:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.payloads = []
+
+    def post(self, url, json=None, timeout=None, stream=False):
+        self.payloads.append(json)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def openai_backend(responses, **options):
+    backend = OpenAIChatBackend("key", backoff_base=0, **options)
+    backend._session, backend._session_pid = FakeSession(responses), os.getpid()
+    return backend
+
+
+def completion(text):
+    return FakeResponse(200, {"choices": [{"message": {"content": " %s \n" % text}}]})
+
+
+def test_mock_backend_is_deterministic_and_offline():
+    backend = create_backend("mock")
+    assert backend.complete(PROMPT, 200, 0.2) == "Asthma | active Flu | resolved"
+    assert backend.complete(PROMPT, 3, 0.2) == "Asthma | active"
+    assert "".join(backend.stream(PROMPT, 200, 0.2)) == backend.complete(PROMPT, 200, 0.2)
+    assert MockBackend(model="other").model == "other"
+    with pytest.raises(ValueError):
+        create_backend("unknown")
+
+
+def test_openai_retries_rate_limits_and_server_errors():
+    backend = openai_backend([FakeResponse(429, {}, {"Retry-After": "0"}), requests.ConnectionError("reset"),
+                              FakeResponse(503, {}), completion("summary")])
+    assert backend.complete(PROMPT, 200, 0.2) == "summary"
+    assert len(backend._session.payloads) == 4
+    assert backend._session.payloads[0]["messages"] == [{"role": "user", "content": PROMPT}]
+
+
+def test_openai_gives_up_on_client_errors_and_after_max_retries():
+    with pytest.raises(BackendError, match="HTTP 400"):
+        openai_backend([FakeResponse(400, {"error": "bad"}), completion("never")]).complete(PROMPT, 200, 0.2)
+    with pytest.raises(BackendError, match="Giving up after 2 attempts"):
+        openai_backend([FakeResponse(500, {}), FakeResponse(500, {})], max_retries=1).complete(PROMPT, 200, 0.2)
+
+
+def test_openai_streams_the_content_deltas():
+    lines = ["", "data: " + json.dumps({"choices": [{"delta": {"content": "Asthma"}}]}),
+             "data: " + json.dumps({"choices": [{"delta": {}}]}),
+             "data: " + json.dumps({"choices": [{"delta": {"content": " is active"}}]}), "data: [DONE]"]
+    backend = openai_backend([FakeResponse(200, lines=lines)])
+    assert list(backend.stream(PROMPT, 200, 0.2)) == ["Asthma", " is active"]
+    assert backend._session.payloads[0]["stream"] is True
+
+
+# Function to run an async backend call against canned httpx responses on a fresh event loop
+def run_async(backend, responses, call):
+    httpx = pytest.importorskip("httpx")
+    payloads = []
+
+    def handle(request):
+        payloads.append(json.loads(request.content))
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    async def run():
+        backend._async_clients[asyncio.get_running_loop()] = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+        return await call()
+
+    return asyncio.run(run()), payloads
+
+
+def test_openai_async_client_retries_like_the_sync_client():
+    httpx = pytest.importorskip("httpx")
+    backend = OpenAIChatBackend("key", backoff_base=0)
+    responses = [httpx.Response(429, headers={"Retry-After": "0"}), httpx.ConnectError("reset"),
+                 httpx.Response(503), httpx.Response(200, json={"choices": [{"message": {"content": " summary \n"}}]})]
+    summary, payloads = run_async(backend, responses, lambda: backend.acomplete(PROMPT, 200, 0.2))
+    assert summary == "summary"
+    assert len(payloads) == 4 and payloads[0]["messages"] == [{"role": "user", "content": PROMPT}]
+
+    with pytest.raises(BackendError, match="HTTP 400"):
+        run_async(backend, [httpx.Response(400, json={"error": "bad"})], lambda: backend.acomplete(PROMPT, 200, 0.2))
+    backend.max_retries = 1
+    with pytest.raises(BackendError, match="Giving up after 2 attempts"):
+        run_async(backend, [httpx.Response(500), httpx.Response(500)], lambda: backend.acomplete(PROMPT, 200, 0.2))
+
+
+def test_openai_async_stream_yields_the_content_deltas():
+    httpx = pytest.importorskip("httpx")
+    backend = OpenAIChatBackend("key", backoff_base=0)
+    body = "\n".join(["data: " + json.dumps({"choices": [{"delta": {"content": "Asthma"}}]}),
+                      "data: " + json.dumps({"choices": [{"delta": {"content": " is active"}}]}), "data: [DONE]"])
+
+    async def collect():
+        return [text async for text in backend.astream(PROMPT, 200, 0.2)]
+
+    pieces, payloads = run_async(backend, [httpx.Response(200, text=body)], collect)
+    assert pieces == ["Asthma", " is active"]
+    assert payloads[0]["stream"] is True
+
+
+def test_mock_backend_async_matches_sync():
+    backend = MockBackend()
+
+    async def collect():
+        return await backend.acomplete(PROMPT, 200, 0.2), "".join([text async for text in backend.astream(PROMPT, 200, 0.2)])
+
+    assert asyncio.run(collect()) == (backend.complete(PROMPT, 200, 0.2),) * 2
+
+
+def test_openai_session_is_created_in_each_process(monkeypatch):
+    backend = OpenAIChatBackend("key")
+    assert backend._session is None
+    parent = backend._http_session()
+    assert backend._http_session() is parent
+    assert parent.headers["Authorization"] == "Bearer key"
+
+    # A worker forked from this process never reuses the parent's pooled connections
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    assert backend._http_session() is not parent
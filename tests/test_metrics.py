@@ -0,0 +1,65 @@
+import threading
+import time
+
+from metrics import Metrics, SamplingProfiler, end_trace, span, start_trace, with_trace
+
+
+def test_render_counters_histograms_and_gauges():
+    registry = Metrics(buckets=(0.1, 1))
+    registry.describe("requests_total", "counter", "Requests.")
+    registry.inc("requests_total", route="/a")
+    registry.inc("requests_total", 2, route="/a")
+    registry.observe("latency_seconds", 0.5, route='/"quoted"')
+    registry.gauge("documents", "Documents.", lambda: [({}, 3.0)])
+
+    assert registry.render().splitlines() == [
+        "# HELP documents Documents.",
+        "# TYPE documents gauge",
+        "documents 3",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/\\"quoted\\"",le="0.1"} 0',
+        'latency_seconds_bucket{route="/\\"quoted\\"",le="1"} 1',
+        'latency_seconds_bucket{route="/\\"quoted\\"",le="+Inf"} 1',
+        'latency_seconds_sum{route="/\\"quoted\\""} 0.5',
+        'latency_seconds_count{route="/\\"quoted\\""} 1',
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{route="/a"} 3',
+    ]
+
+
+def test_spans_are_recorded_in_the_trace_across_threads():
+    trace, token = start_trace()
+    try:
+        with span("parse"):
+            pass
+        for _ in range(2):
+            runner = threading.Thread(target=with_trace(lambda: _timed("llm")))
+            runner.start()
+            runner.join()
+    finally:
+        end_trace(token)
+
+    assert trace.stages["parse"][1] == 1
+    assert trace.stages["llm"][1] == 2
+    assert trace.server_timing().startswith('parse;dur=')
+    assert 'llm;dur=' in trace.server_timing() and 'desc="2"' in trace.server_timing()
+    # Outside a request, spans only feed the histogram
+    with span("parse"):
+        pass
+    assert trace.stages["parse"][1] == 1
+
+
+def _timed(stage):
+    with span(stage):
+        time.sleep(0.001)
+
+
+def test_profiler_samples_the_stack_of_a_thread():
+    profiler = SamplingProfiler(threading.get_ident(), interval=0.001).start()
+    deadline = time.monotonic() + 0.1
+    while time.monotonic() < deadline:
+        sum(range(1000))
+    samples = profiler.stop()
+    assert samples
+    assert "test_profiler_samples_the_stack_of_a_thread" in profiler.collapsed()
@@ -0,0 +1,37 @@
+import pytest
+
+import prompt_builder
+from prompt_builder import chunk_text, count_tokens, render_rows
+
+
+@pytest.fixture(params=["tiktoken", "approximation"])
+def tokenizer(request, monkeypatch):
+    if request.param == "approximation":
+        monkeypatch.setattr(prompt_builder, "tiktoken", None)
+        monkeypatch.setattr(prompt_builder, "_encoding", None)
+    elif prompt_builder.tiktoken is None:
+        pytest.skip("tiktoken is not installed")
+    return request.param
+
+
+def test_render_rows_drops_empty_cells_without_headers():
+    rows = [["Asthma", "", "active"], ("Flu", "resolved"), "free text"]
+    assert render_rows(rows) == "Asthma | active\nFlu | resolved\nfree text"
+    assert render_rows([["Asthma", "", "active"]], headers=["Name", None, "Status"]) == (
+        "Name |  | Status\nAsthma |  | active")
+
+
+def test_chunks_stay_within_the_budget_and_keep_every_line(tokenizer):
+    text = "\n".join("row %d | value %d | status active" % (index, index) for index in range(200))
+    chunks = chunk_text(text, 100)
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk) <= 100 for chunk in chunks)
+    assert "\n".join(chunks) == text
+
+
+def test_a_line_over_the_budget_is_split(tokenizer):
+    line = "word " * 500
+    chunks = chunk_text("short\n" + line, 50)
+    assert chunks[0] == "short"
+    assert all(count_tokens(chunk) <= 50 for chunk in chunks)
+    assert "".join(chunks[1:]) == line
@@ -0,0 +1,77 @@
+import gzip
+import json
+
+import pytest
+from flask import Flask, jsonify, request
+
+import responses
+from responses import JSONProvider, compress_response, encode_json, string_keys
+
+PAYLOAD = {"b": [1, 2], "a": {"Name": "value", None: ""}, "text": "é"}
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_encode_json_sorts_keys_and_writes_none_keys_as_null(fast):
+    body = encode_json(PAYLOAD, fast=fast)
+    assert body.endswith(b"\n")
+    assert json.loads(body) == {"a": {"Name": "value", "null": ""}, "b": [1, 2], "text": "é"}
+    assert list(json.loads(body)) == ["a", "b", "text"]
+
+
+def test_encode_json_without_orjson(monkeypatch):
+    monkeypatch.setattr(responses, "orjson", None)
+    assert json.loads(encode_json(PAYLOAD)) == json.loads(encode_json(PAYLOAD, fast=False))
+
+
+def test_string_keys_matches_the_standard_encoder():
+    value = {None: [{True: 1, 2: "two"}], "text": ("a",)}
+    assert json.dumps(string_keys(value)) == json.dumps(value)
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_provider_encodes_none_keys(fast):
+    app = Flask(__name__)
+    app.json = JSONProvider(app, fast=fast)
+
+    @app.route("/")
+    def payload():
+        return jsonify(PAYLOAD)
+
+    response = app.test_client().get("/")
+    assert response.status_code == 200
+    assert response.get_json()["a"] == {"Name": "value", "null": ""}
+
+
+def make_compressing_app(min_size=100):
+    app = Flask(__name__)
+
+    @app.route("/<int:size>")
+    def text(size):
+        return jsonify({"text": "x" * size})
+
+    @app.after_request
+    def compress(response):
+        return compress_response(response, request.accept_encodings, min_size)
+    return app
+
+
+def test_compresses_large_bodies_with_an_accepted_encoding():
+    client = make_compressing_app().test_client()
+    response = client.get("/1000", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert json.loads(gzip.decompress(response.get_data())) == {"text": "x" * 1000}
+    assert "Accept-Encoding" in response.headers["Vary"]
+
+
+def test_small_bodies_and_clients_without_encodings_are_left_alone():
+    client = make_compressing_app().test_client()
+    assert "Content-Encoding" not in client.get("/10", headers={"Accept-Encoding": "gzip"}).headers
+    assert "Content-Encoding" not in client.get("/1000").headers
+
+
+@pytest.mark.skipif(responses.brotli is None, reason="brotli is not installed")
+def test_prefers_brotli():
+    client = make_compressing_app().test_client()
+    response = client.get("/1000", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["Content-Encoding"] == "br"
+    assert json.loads(responses.brotli.decompress(response.get_data())) == {"text": "x" * 1000}
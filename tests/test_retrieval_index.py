@@ -0,0 +1,111 @@
+import os
+
+import numpy as np
+import pytest
+
+from ccda_document import CCDADocument
+from conftest import SAMPLES_DIRECTORY
+from retrieval_index import BM25, HashingEmbedder, RowIndex, document_chunks, tokenize
+
+
+def load_sample(name):
+    with open(os.path.join(SAMPLES_DIRECTORY, name), "rb") as sample:
+        return CCDADocument.from_bytes(sample.read())
+
+
+@pytest.fixture(scope="module")
+def suzanne():
+    return load_sample("CCDA_Williams_Suzanne.xml")
+
+
+@pytest.fixture(scope="module")
+def carl():
+    return load_sample("CCDA_Williams_Carl.xml")
+
+
+def test_chunks_are_the_rows_of_the_first_table_of_each_section(suzanne):
+    chunks = document_chunks(suzanne)
+    problems = [chunk for chunk in chunks if chunk[0] == "Problems"]
+    table = suzanne.find_sections("Problems")[0].tables[0]
+    assert [row_number for _, row_number, _ in problems] == list(range(len(table.rows)))
+    assert problems[0][2].startswith("Problems | %s: " % table.headers[0])
+
+
+def test_hashing_embedder_is_normalized_and_deterministic():
+    embedder = HashingEmbedder(dim=64)
+    vectors = embedder.embed(["blood pressure 120/80", "blood pressure 120/80", ""])
+    assert vectors.shape == (3, 64)
+    assert np.allclose(np.linalg.norm(vectors[:2], axis=1), 1)
+    assert np.array_equal(vectors[0], vectors[1])
+    assert not vectors[2].any()
+    assert embedder.signature == "hashing-64"
+
+
+def test_search_across_documents_with_filters(tmp_path, suzanne, carl):
+    index = RowIndex(str(tmp_path / "index.sqlite3"), HashingEmbedder())
+    assert index.add_document(suzanne) == len(document_chunks(suzanne))
+    index.add_document(carl)
+    assert suzanne.doc_id in index
+    assert index.stats()["documents"] == 2
+
+    query = document_chunks(carl)[0][2]
+    results = index.search(query, k=3)
+    assert results[0]["document_id"] == carl.doc_id and results[0]["text"] == query
+    assert [result["score"] for result in results] == sorted((result["score"] for result in results), reverse=True)
+
+    assert {result["section"] for result in index.search("medication", k=5, section="Medications")} == {
+        "Medications"}
+    assert {result["document_id"] for result in index.search(query, k=5, doc_id=suzanne.doc_id)} == {
+        suzanne.doc_id}
+
+
+def test_workers_sharing_the_database_see_each_others_changes(tmp_path, suzanne, carl):
+    path = str(tmp_path / "index.sqlite3")
+    first, second = RowIndex(path, HashingEmbedder()), RowIndex(path, HashingEmbedder())
+    first.add_document(suzanne)
+    query = document_chunks(suzanne)[0][2]
+    assert second.search(query, k=1)[0]["document_id"] == suzanne.doc_id
+
+    # Re-indexing a document replaces its rows
+    second.add_document(suzanne)
+    assert first.stats()["chunks"] == len(document_chunks(suzanne))
+    assert first.delete_document(suzanne.doc_id)
+    assert second.search(query, k=1) == []
+    assert not first.delete_document(suzanne.doc_id)
+
+
+def test_rows_are_re_embedded_for_another_embedder(tmp_path, suzanne):
+    path = str(tmp_path / "index.sqlite3")
+    RowIndex(path, HashingEmbedder(dim=64)).add_document(suzanne)
+    index = RowIndex(path, HashingEmbedder(dim=128))
+    query = document_chunks(suzanne)[0][2]
+    assert index.search(query, k=1)[0]["text"] == query
+    assert index.stats()["embedder"] == "hashing-128"
+
+
+def test_tokenize_keeps_decimal_numbers():
+    assert tokenize("BMI 28.9 kg/m2, Body-weight") == ["bmi", "28.9", "kg", "m2", "body", "weight"]
+
+
+def test_bm25_ranks_rare_terms_higher_and_ignores_stop_words():
+    texts = ["asthma active", "hypertension active", "hypertension resolved in 2019", "the of and"]
+    ranking = BM25(texts)
+    assert [position for _, position in ranking.rank("what is the asthma status")] == [0]
+    assert [position for _, position in ranking.rank("hypertension active")] == [1, 0, 2]
+    assert ranking.rank("the") == []
+    assert len(ranking.rank("active hypertension", k=1)) == 1
+    assert BM25([]).rank("anything") == []
+
+
+def test_connection_is_opened_in_each_process(tmp_path, suzanne, monkeypatch):
+    path = tmp_path / "index.sqlite3"
+    index = RowIndex(str(path), HashingEmbedder())
+    assert not path.exists()
+    index.add_document(suzanne)
+    parent = index._connection
+
+    # A worker forked from this process opens its own connection and reloads the vectors
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    assert index._connection is not parent
+    query = document_chunks(suzanne)[0][2]
+    assert index.search(query, k=1)[0]["text"] == query
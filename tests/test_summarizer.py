@@ -0,0 +1,371 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from summarizer import (SUMMARY_FAILED_MESSAGE, SUMMARY_TIMEOUT_MESSAGE, AdmissionQueue, AdmissionRejected,
+                        Prefetcher, RateLimiter, SingleFlight, SummaryExecutor)
+
+
+def test_summarize_keeps_request_order():
+    executor = SummaryExecutor(max_workers=4, timeout=5)
+
+    def summarize(item):
+        time.sleep(0.05 * (3 - item))
+        return "summary %d" % item
+
+    assert executor.summarize(summarize, [0, 1, 2]) == ["summary 0", "summary 1", "summary 2"]
+
+
+def test_summarize_replaces_a_failed_section():
+    executor = SummaryExecutor(max_workers=2, timeout=5)
+
+    def summarize(item):
+        if item == "bad":
+            raise RuntimeError("backend down")
+        return item.upper()
+
+    assert executor.summarize(summarize, ["a", "bad", "b"]) == ["A", SUMMARY_FAILED_MESSAGE, "B"]
+
+
+def test_summarize_timeout_is_one_deadline_for_the_request():
+    # One worker: each section waits for the previous one, so a per-section timeout
+    # would let all three finish in about 0.9 seconds
+    executor = SummaryExecutor(max_workers=1, timeout=0.5)
+
+    def summarize(item):
+        time.sleep(0.3)
+        return item
+
+    start = time.monotonic()
+    results = executor.summarize(summarize, ["a", "b", "c"])
+    assert time.monotonic() - start < 0.8
+    assert results[0] == "a"
+    assert results[2] == SUMMARY_TIMEOUT_MESSAGE
+
+
+def test_stream_yields_summaries_as_they_finish():
+    executor = SummaryExecutor(max_workers=2, timeout=5)
+
+    def summarize(item, on_token=None):
+        time.sleep(item)
+        if on_token is not None:
+            on_token("partial")
+        return "done %s" % item
+
+    events = list(executor.stream(summarize, [0.2, 0.0], tokens=True))
+    summaries = [(index, text) for kind, index, text in events if kind == "summary"]
+    assert summaries == [(1, "done 0.0"), (0, "done 0.2")]
+    assert ("token", 0, "partial") in events
+
+
+def test_wait_idle_while_a_request_is_summarizing():
+    executor = SummaryExecutor(max_workers=1, timeout=5)
+    assert executor.wait_idle(timeout=0)
+
+    # A stream counts as a summarizing request until it is exhausted
+    stream = executor.stream(lambda item: item, ["a", "b"])
+    next(stream)
+    assert not executor.wait_idle(timeout=0)
+    list(stream)
+    assert executor.wait_idle(timeout=0)
+
+
+def test_rate_limiter_shares_its_budget_through_the_state_file(tmp_path):
+    state_path = str(tmp_path / "budget.json")
+    first = RateLimiter(requests_per_minute=60, state_path=state_path)
+    second = RateLimiter(requests_per_minute=60, state_path=state_path)
+
+    # The bucket starts full: 60 requests go through at once, the next one has to wait
+    for _ in range(60):
+        assert first._try_acquire(1) <= 0
+    assert second._try_acquire(1) > 0
+
+
+def test_rate_limiter_waits_for_tokens(tmp_path):
+    limiter = RateLimiter(tokens_per_minute=6000, state_path=str(tmp_path / "budget.json"))
+    limiter.acquire(6000)
+
+    start = time.monotonic()
+    limiter.acquire(20)
+    assert 0.1 < time.monotonic() - start < 1.5
+
+
+def test_rate_limiter_waits_on_the_event_loop(tmp_path):
+    limiter = RateLimiter(tokens_per_minute=6000, state_path=str(tmp_path / "budget.json"))
+    limiter.acquire(6000)
+    ticks = []
+
+    async def tick():
+        while True:
+            ticks.append(1)
+            await asyncio.sleep(0.01)
+
+    async def acquire():
+        ticker = asyncio.ensure_future(tick())
+        start = time.monotonic()
+        await limiter.acquire_async(20)
+        ticker.cancel()
+        return time.monotonic() - start
+
+    assert 0.1 < asyncio.run(acquire()) < 1.5
+    # The loop kept running while the limiter waited for tokens
+    assert len(ticks) > 5
+
+
+def test_rate_limiter_without_limits_never_waits(tmp_path):
+    limiter = RateLimiter(state_path=str(tmp_path / "budget.json"))
+    assert not limiter.enabled
+    limiter.acquire(10 ** 9)
+    assert not (tmp_path / "budget.json").exists()
+
+
+def test_summarize_async_counts_as_a_summarizing_request():
+    executor = SummaryExecutor(max_workers=2, timeout=0.5)
+    idle_while_running = []
+
+    async def summarize(item):
+        idle_while_running.append(executor.wait_idle(timeout=0))
+        await asyncio.sleep(item)
+        return item
+
+    results = asyncio.run(executor.summarize_async(summarize, [0.0, 0.1, 1.0]))
+    assert results == [0.0, 0.1, SUMMARY_TIMEOUT_MESSAGE]
+    assert idle_while_running == [False, False, False]
+    assert asyncio.run(executor.summarize_async(summarize, [])) == []
+
+
+def test_stream_async_yields_the_same_events():
+    executor = SummaryExecutor(max_workers=2, timeout=5)
+
+    async def summarize(item, on_token=None):
+        await asyncio.sleep(max(item, 0))
+        if on_token is not None:
+            on_token("partial")
+        if item < 0:
+            raise ValueError(item)
+        return "done %s" % item
+
+    async def collect():
+        return [event async for event in executor.stream_async(summarize, [0.2, -1], tokens=True)]
+
+    events = asyncio.run(collect())
+    assert [event for event in events if event[0] == "summary"] == [("summary", 1, SUMMARY_FAILED_MESSAGE),
+                                                                     ("summary", 0, "done 0.2")]
+    assert ("token", 0, "partial") in events
+    assert executor.wait_idle(timeout=0)
+
+
+# Function to wait until a prefetch job has finished and return its status
+def finished_prefetch(prefetcher, doc_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while prefetcher.status(doc_id)["state"] in ("queued", "running") and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return prefetcher.status(doc_id)
+
+
+def test_prefetch_summarizes_within_the_token_budget():
+    summarized = []
+
+    def summarize(doc_id, name, data):
+        if name == "broken":
+            raise RuntimeError("backend down")
+        summarized.append(name)
+
+    costs = {"cached": 0, "small": 40, "large": 100, "broken": 10, "last": 50}
+    prefetcher = Prefetcher(summarize, lambda doc_id, name, data: costs[name], SummaryExecutor(), token_budget=100)
+    prefetcher.submit("doc", lambda: [(name, None) for name in costs])
+
+    status = finished_prefetch(prefetcher, "doc")
+    assert status["state"] == "completed"
+    assert status["sections"] == {"cached": "cached", "small": "done", "large": "over_budget", "broken": "failed",
+                                  "last": "done"}
+    assert status["tokens_used"] == 100
+    assert summarized == ["small", "last"]
+    assert prefetcher.status("unknown") is None
+
+
+def test_prefetch_gives_way_to_requests_and_can_be_cancelled():
+    executor = SummaryExecutor(max_workers=1)
+    started, release = threading.Event(), threading.Event()
+    request = threading.Thread(target=executor.summarize,
+                               args=(lambda item: started.set() or release.wait(5), ["a"]))
+    request.start()
+    assert started.wait(5)
+    summarized = []
+    prefetcher = Prefetcher(lambda *args: summarized.append(args[1]), lambda *args: 1, executor)
+
+    prefetcher.submit("doc", lambda: [("Problems", None)])
+    time.sleep(0.1)
+    # Nothing is summarized while the request is running
+    assert summarized == []
+    assert prefetcher.cancel("doc")
+    release.set()
+    request.join()
+    assert finished_prefetch(prefetcher, "doc")["state"] == "cancelled"
+    assert summarized == []
+
+
+# Function to wait up to a few seconds for a condition to hold
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+# Function to run calls in threads that all start at once; returns their results in order
+def run_together(calls):
+    results = [None] * len(calls)
+
+    def run(index):
+        try:
+            results[index] = calls[index]()
+        except Exception as error:
+            results[index] = error
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_single_flight_shares_identical_calls_in_flight():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def complete(prompt):
+        calls.append(prompt)
+        release.wait(5)
+        return prompt.upper()
+
+    threads, results = run_together([lambda: flight.do("a", lambda: complete("a")) for _ in range(3)]
+                                    + [lambda: flight.do("b", lambda: complete("b"))])
+    assert wait_until(lambda: len(flight) == 2)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(calls) == ["a", "b"]
+    assert sorted(results) == [("A", False), ("A", True), ("A", True), ("B", False)]
+    assert len(flight) == 0
+    # Once a call has finished, the next one for the key runs again
+    assert flight.do("a", lambda: "again") == ("again", False)
+
+
+def test_single_flight_shares_the_exception():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def fail():
+        started.set()
+        release.wait(5)
+        raise RuntimeError("backend down")
+
+    threads, results = run_together([lambda: flight.do("a", fail)])
+    assert started.wait(5)
+    follower, follower_results = run_together([lambda: flight.do("a", lambda: "not called")])
+    time.sleep(0.05)
+    release.set()
+    for thread in threads + follower:
+        thread.join()
+    assert isinstance(results[0], RuntimeError) and follower_results[0] is results[0]
+
+
+def test_single_flight_shares_calls_between_coroutines_and_threads():
+    flight = SingleFlight()
+    calls = []
+
+    async def complete(prompt):
+        calls.append(prompt)
+        await asyncio.sleep(0.1)
+        return prompt.upper()
+
+    async def run():
+        leader = asyncio.ensure_future(flight.do_async("a", lambda: complete("a")))
+        await asyncio.sleep(0.01)
+        # A thread asking for the same key joins the coroutine's call
+        thread = asyncio.to_thread(flight.do, "a", lambda: "not called")
+        return await asyncio.gather(leader, flight.do_async("a", lambda: complete("a")), thread)
+
+    assert asyncio.run(run()) == [("A", False), ("A", True), ("A", True)]
+    assert calls == ["a"] and len(flight) == 0
+
+
+def test_single_flight_async_shares_the_exception():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise RuntimeError("backend down")
+
+    async def run():
+        return await asyncio.gather(flight.do_async("a", fail), flight.do_async("a", fail), return_exceptions=True)
+
+    first, second = asyncio.run(run())
+    assert isinstance(first, RuntimeError) and second is first
+    assert len(flight) == 0
+
+
+def test_admission_queue_rejects_when_full():
+    queue = AdmissionQueue(max_active=1, max_queued=2, max_queued_per_client=1, max_wait=5)
+    assert queue.acquire("a") == 0.0
+    threads, results = run_together([lambda: queue.acquire("a"), lambda: queue.acquire("b")])
+    assert wait_until(lambda: queue.queued == 2)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        queue.acquire("c")
+    assert rejected.value.reason == "queue_full" and rejected.value.retry_after >= 1
+    queue.max_queued = 3
+    with pytest.raises(AdmissionRejected) as rejected:
+        queue.acquire("a")
+    assert rejected.value.reason == "client_queue_full"
+
+    for _ in range(3):
+        queue.release(0.1)
+    for thread in threads:
+        thread.join()
+    assert all(waited >= 0 for waited in results)
+    assert queue.stats()["active"] == 0 and queue.stats()["queued"] == 0
+
+
+def test_admission_queue_gives_up_after_max_wait():
+    queue = AdmissionQueue(max_active=1, max_wait=0.05)
+    queue.acquire("a")
+    with pytest.raises(AdmissionRejected) as rejected:
+        queue.acquire("b")
+    assert rejected.value.reason == "timeout"
+    assert queue.queued == 0 and queue.active == 1
+
+
+def test_admission_queue_admits_clients_round_robin():
+    queue = AdmissionQueue(max_active=1, max_queued=10, max_queued_per_client=10, max_wait=5)
+    queue.acquire("busy")
+    admitted = []
+
+    def admit(client):
+        queue.acquire(client)
+        admitted.append(client)
+
+    # Client "a" queues three requests before "b" queues one
+    threads = []
+    for client in ["a", "a", "a", "b"]:
+        threads.append(threading.Thread(target=admit, args=(client,)))
+        threads[-1].start()
+        assert wait_until(lambda: queue.queued == len(threads))
+
+    for count in range(1, 5):
+        queue.release(0.1)
+        assert wait_until(lambda: len(admitted) == count)
+    for thread in threads:
+        thread.join()
+    assert admitted == ["a", "b", "a", "a"]
+
+
+def test_admission_queue_disabled_admits_everything():
+    queue = AdmissionQueue(max_active=0)
+    assert not queue.enabled
+    assert [queue.acquire("a") for _ in range(100)] == [0.0] * 100
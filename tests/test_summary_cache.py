@@ -0,0 +1,86 @@
+import os
+import time
+
+from summary_cache import SummaryCache, appended_rows, row_fingerprints, summary_cache_key
+
+ROWS = [["Hypertension", "active"], ["Asthma", "resolved"]]
+
+
+def test_key_ignores_formatting_but_not_the_request():
+    key = summary_cache_key(ROWS, "model", "template", max_tokens=100)
+    assert summary_cache_key([["Hypertension ", "active"], ["Asthma", "  resolved"]], "model", "template",
+                             max_tokens=100) == key
+    assert summary_cache_key(ROWS[:1], "model", "template", max_tokens=100) != key
+    assert summary_cache_key(ROWS, "other model", "template", max_tokens=100) != key
+    assert summary_cache_key(ROWS, "model", "template", max_tokens=200) != key
+
+
+def test_summaries_are_shared_through_the_database(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    first = SummaryCache(path)
+    first.put("key", "summary")
+    assert first.get("key") == "summary"
+
+    second = SummaryCache(path)
+    assert "key" in second and "missing" not in second
+    assert second.get("key") == "summary"
+    assert second.get("missing") is None
+    assert second.stats()["hits"] == 1 and second.stats()["misses"] == 1
+
+    second.invalidate("key")
+    first._memory.clear()
+    assert first.get("key") is None
+
+
+def test_expired_summaries_are_misses(tmp_path):
+    cache = SummaryCache(str(tmp_path / "cache.sqlite3"), ttl=0.05)
+    cache.put("key", "summary")
+    time.sleep(0.1)
+    assert "key" not in cache
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_summaries_are_evicted(tmp_path):
+    cache = SummaryCache(str(tmp_path / "cache.sqlite3"), memory_size=1, max_entries=2)
+    cache.put("a", "summary a")
+    cache.put("b", "summary b")
+    time.sleep(0.01)
+    assert cache.get("a") == "summary a"
+    cache.put("c", "summary c")
+    assert "a" in cache and "c" in cache and "b" not in cache
+    assert cache.stats()["entries"] == 2 and cache.stats()["memory_entries"] == 1
+
+
+def test_appended_rows_are_the_rows_added_at_any_position():
+    previous = row_fingerprints(ROWS)
+    rows = [["Flu", "active"]] + ROWS + [["Asthma", "resolved"]]
+    assert appended_rows(previous, rows, row_fingerprints(rows)) == [["Flu", "active"], ["Asthma", "resolved"]]
+    assert appended_rows(previous, ROWS, previous) == []
+    # A row is gone: the section was not only appended to
+    assert appended_rows(previous, ROWS[:1], row_fingerprints(ROWS[:1])) is None
+
+
+def test_latest_section_summary_per_patient(tmp_path):
+    cache = SummaryCache(str(tmp_path / "cache.sqlite3"))
+    assert cache.get_section("patient", "Problems") is None
+    cache.put_section("patient", "Problems", "first", ["a"], "first summary")
+    cache.put_section("patient", "Problems", "second", ["a", "b"], "second summary")
+    assert cache.get_section("patient", "Problems") == {"fingerprint": "second", "rows": ["a", "b"],
+                                                        "summary": "second summary"}
+    assert cache.get_section("other patient", "Problems") is None
+
+
+def test_connection_is_opened_in_each_process(tmp_path, monkeypatch):
+    path = tmp_path / "cache.sqlite3"
+    cache = SummaryCache(str(path))
+    # Nothing is opened before the first use
+    assert not path.exists()
+    cache.put("key", "summary")
+    parent = cache._connection
+    assert cache._connection is parent
+
+    # A worker forked from this process opens its own connection
+    monkeypatch.setattr(os, "getpid", lambda: -1)
+    assert cache._connection is not parent
+    cache._memory.clear()
+    assert cache.get("key") == "summary"
@@ -0,0 +1,18 @@
+"""
+WSGI entry point for gunicorn.
+
+Usage:
+    gunicorn wsgi:application --preload --workers 4 --bind 0.0.0.0:5000
+
+With --preload the master imports the app once, with its configuration, compiled
+patterns and heavy modules, and forks the workers from it, so they start in
+milliseconds and share that memory copy-on-write. Per-process resources (SQLite
+connections, HTTP sessions, background threads) are only created in the workers,
+on first use. WSGI_PRELOAD=0 leaves the heavy modules to the first request that
+needs them, for the fastest possible import.
+"""
+import os
+
+from app import create_app
+
+application = create_app(preload=os.environ.get("WSGI_PRELOAD", "1") in ("1", "true"))